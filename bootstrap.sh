@@ -68,9 +68,28 @@ function FLYNN_BOOTSTRAP() {
   CLUSTER_DOMAIN="${flynn_domain}" flynn-host bootstrap -t 3600 --min-hosts ${flynn_nodes} --discovery https://discovery.flynn.io/clusters/${discovery_token} --peer-ips=$PEERS
 }
 
+function FETCH_CHUNKED_BACKUP() {
+  # rebuild a chunked backup from its manifest: fetch the chunks in parallel, join them in order, check the sha256
+  rm -rf /tmp/backup-chunks && mkdir -p /tmp/backup-chunks &&
+  aws s3 cp "s3://${flynn_s3}/backup-manifests/$1" /tmp/backup-manifest.json &&
+  jq -r '.chunks[][0]' /tmp/backup-manifest.json | sort -u | xargs -P 8 -I CHUNK sh -c 'aws s3 cp --quiet "s3://${flynn_s3}/backup-chunks/$(echo CHUNK | cut -c1-2)/CHUNK" /tmp/backup-chunks/CHUNK' &&
+  jq -r '.chunks[][0]' /tmp/backup-manifest.json | sed -e 's|^|/tmp/backup-chunks/|' | xargs cat > "$2" &&
+  [[ "$(sha256sum "$2" | awk '{print $1}')" == "$(jq -r '.sha256' /tmp/backup-manifest.json)" ]]
+  RESULT=$?
+  rm -rf /tmp/backup-chunks /tmp/backup-manifest.json
+  return $RESULT
+}
+
 function FLYNN_RESTORE() {
   BACKUP=$(aws s3 ls s3://${flynn_s3}/backup/ | awk '{print $4}' | sort -r | head -n 1)
-  aws s3 cp "s3://${flynn_s3}/backup/$BACKUP" "/tmp/$BACKUP"
+  # BACKUP_MODE=incremental writes chunk manifests instead of backup/ objects, restore whichever is newer
+  MANIFEST=$(aws s3 ls s3://${flynn_s3}/backup-manifests/ | awk '{print $4}' | sort -r | head -n 1)
+  if [[ -n "$MANIFEST" ]] && [[ "$(basename "$MANIFEST" .json)" > "$BACKUP" ]]; then
+    BACKUP=$(basename "$MANIFEST" .json)
+    FETCH_CHUNKED_BACKUP "$MANIFEST" "/tmp/$BACKUP" || return 1
+  else
+    aws s3 cp "s3://${flynn_s3}/backup/$BACKUP" "/tmp/$BACKUP"
+  fi
   GET_ASG_NODES_IP
   PEERS=$(echo $ASG_NODES | sed -e 's/"//g' | tr '\ ' ',')
   flynn-host bootstrap -t 3600 --min-hosts ${flynn_nodes} --from-backup="/tmp/$BACKUP" --peer-ips=$PEERS
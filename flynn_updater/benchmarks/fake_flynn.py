@@ -0,0 +1,54 @@
+"""Stand-in for the flynn CLI, driven by the JSON cluster state in $FAKE_FLYNN_STATE.
+
+It answers the subcommands core/shell.py issues with output shaped like the real CLI.
+Mutating subcommands succeed without changing the state file, apart from deleted job_cache rows.
+"""
+import json
+import os
+import re
+import sys
+
+
+def main(argv):
+    with open(os.environ['FAKE_FLYNN_STATE']) as state_file:
+        state = json.load(state_file)
+    apps = {app['name']: app for app in state['apps']}
+    app = None
+    if argv[:1] == ['-a']:
+        app, argv = apps.get(argv[1]), argv[2:]
+    command = argv[:1]
+
+    if command == ['apps']:
+        print('ID                                NAME')
+        for record in state['apps']:
+            print('%s  %s' % (record['id'], record['name']))
+    elif command == ['meta']:
+        print('KEY               VALUE')
+        print('flynn-system-app  %s' % ('true' if app['system'] else 'false'))
+    elif argv[:2] == ['release', '-q']:
+        print('\n'.join(app['releases']))
+    elif argv[:2] == ['release', 'show']:
+        release_id = argv[3] if len(argv) > 3 else app['releases'][0]
+        print(json.dumps({'id': release_id, 'env': app['env']}))
+    elif command == ['env'] and len(argv) == 1:
+        for name, value in sorted(app['env'].items()):
+            print('%s=%s' % (name, value))
+    elif argv[:2] == ['pg', 'psql']:
+        statements = [argv[argv.index('-c') + 1]] if '-c' in argv else sys.stdin
+        for statement in statements:
+            if statement.startswith('SELECT name, size FROM files'):
+                for name, size in state['blobstore_files']:
+                    print('%s|%d' % (name, size))
+                continue
+            limit = int(re.search(r'LIMIT (\d+)', statement).group(1))
+            deleted = min(limit, state['job_cache_rows'])
+            # the deleted rows are gone for the next psql call too
+            state['job_cache_rows'] -= deleted
+            with open(os.environ['FAKE_FLYNN_STATE'], 'w') as state_file:
+                json.dump(state, state_file)
+            print(deleted, flush=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
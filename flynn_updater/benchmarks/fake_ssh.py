@@ -0,0 +1,96 @@
+import io
+import socket
+import threading
+import time
+import paramiko
+
+
+class _Server(paramiko.ServerInterface):
+
+    def __init__(self, fake):
+        self.fake = fake
+
+    def get_allowed_auths(self, username):
+        return 'publickey'
+
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_exec_request(self, channel, command):
+        self.fake.record(command)
+        threading.Thread(target=self.fake.respond, args=(channel, command), daemon=True).start()
+        return True
+
+
+class FakeSSHServer(object):
+    """Local SSH server accepting any key on every loopback address and answering every command.
+
+    Each command writes `lines` lines of output and exits 0, which is enough to exercise
+    connection setup, fan-out and output streaming in core/ssh.py.
+    """
+
+    def __init__(self, lines=20):
+        self.lines = lines
+        self.commands = 0
+        self.connections = 0
+        self.lock = threading.Lock()
+        self.host_key = paramiko.RSAKey.generate(2048)
+        self.client_key = paramiko.RSAKey.generate(2048)
+        self.transports = []
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('0.0.0.0', 0))
+        self.sock.listen(256)
+        self.port = self.sock.getsockname()[1]
+        self.running = True
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    @property
+    def private_key(self):
+        key = io.StringIO()
+        self.client_key.write_private_key(key)
+        return key.getvalue()
+
+    def record(self, command):
+        with self.lock:
+            self.commands += 1
+
+    def respond(self, channel, command):
+        # the exec reply is sent once check_channel_exec_request returns; output or a close that
+        # overtakes it makes the client fail the command with "Channel closed"
+        time.sleep(0.01)
+        try:
+            for n in range(self.lines):
+                channel.sendall(('%s: line %d\n' % (command, n)).encode('utf-8'))
+            channel.send_exit_status(0)
+        finally:
+            channel.close()
+
+    def _accept(self):
+        while self.running:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            with self.lock:
+                self.connections += 1
+            transport = paramiko.Transport(conn)
+            transport.add_server_key(self.host_key)
+            transport.start_server(server=_Server(self))
+            self.transports.append(transport)
+
+    def reset(self):
+        with self.lock:
+            self.commands = 0
+            self.connections = 0
+
+    def close(self):
+        self.running = False
+        self.sock.close()
+        for transport in self.transports:
+            transport.close()
@@ -0,0 +1,403 @@
+import datetime
+import hashlib
+import io
+import random
+import threading
+import time
+from collections import Counter
+from botocore.exceptions import ClientError
+
+ASG_NAME = 'bench-asg'
+ZONE_ID = 'ZBENCH'
+DOMAIN = 'bench.local'
+ELBS = ['bench-elb-1', 'bench-elb-2']
+SECURITY_GROUP = 'sg-bench'
+DB_PORT = 5432
+VPC_CIDR = '10.0.0.0/16'
+
+
+def private_ip(i):
+    # loopback addresses so every node resolves to the local fake SSH server
+    return '127.10.%d.%d' % (i // 250, i % 250 + 1)
+
+
+def public_ip(i):
+    return '127.20.%d.%d' % (i // 250, i % 250 + 1)
+
+
+class FakePaginator(object):
+
+    def __init__(self, pages):
+        self.pages = pages
+
+    def paginate(self, **kwargs):
+        return self.pages(**kwargs)
+
+
+class FakeService(object):
+    service = None
+
+    def __init__(self, aws):
+        self.aws = aws
+
+    def _call(self, operation):
+        self.aws.record(self.service, operation)
+
+
+class FakeAutoScaling(FakeService):
+    service = 'autoscaling'
+
+    def describe_auto_scaling_groups(self, AutoScalingGroupNames):
+        self._call('DescribeAutoScalingGroups')
+        return {'AutoScalingGroups': [{
+            'AutoScalingGroupName': AutoScalingGroupNames[0],
+            'Instances': [{'InstanceId': i['InstanceId'], 'LifecycleState': 'InService'} for i in self.aws.instances]
+        }]}
+
+    def complete_lifecycle_action(self, **kwargs):
+        self._call('CompleteLifecycleAction')
+        return {}
+
+
+class FakeEC2Client(FakeService):
+    service = 'ec2'
+
+    def get_paginator(self, name):
+        return FakePaginator(self._describe_instances_pages)
+
+    def _describe_instances_pages(self, Filters=(), **kwargs):
+        wanted = set()
+        for instance_filter in Filters:
+            if instance_filter['Name'] == 'instance-id':
+                wanted.update(instance_filter['Values'])
+        matched = [i for i in self.aws.instances if not wanted or i['InstanceId'] in wanted]
+        for start in range(0, max(len(matched), 1), 1000):
+            self._call('DescribeInstances')
+            yield {'Reservations': [{'Instances': matched[start:start + 1000]}]}
+
+    def describe_security_groups(self, GroupIds):
+        self._call('DescribeSecurityGroups')
+        return {'SecurityGroups': [{'GroupId': GroupIds[0], 'IpPermissions': [{
+            'IpProtocol': 'tcp', 'FromPort': DB_PORT, 'ToPort': DB_PORT,
+            'IpRanges': [dict({'CidrIp': cidr}, **({'Description': description} if description else {}))
+                         for cidr, description in sorted(self.aws.security_group.items())]
+        }]}]}
+
+    def authorize_security_group_ingress(self, GroupId, IpPermissions):
+        self._call('AuthorizeSecurityGroupIngress')
+        for permission in IpPermissions:
+            self.aws.security_group.update((r['CidrIp'], r.get('Description')) for r in permission['IpRanges'])
+
+    def update_security_group_rule_descriptions_ingress(self, GroupId, IpPermissions):
+        self._call('UpdateSecurityGroupRuleDescriptionsIngress')
+        for permission in IpPermissions:
+            self.aws.security_group.update((r['CidrIp'], r.get('Description')) for r in permission['IpRanges']
+                                           if r['CidrIp'] in self.aws.security_group)
+
+    def revoke_security_group_ingress(self, GroupId, IpPermissions):
+        self._call('RevokeSecurityGroupIngress')
+        for permission in IpPermissions:
+            for r in permission['IpRanges']:
+                self.aws.security_group.pop(r['CidrIp'], None)
+
+
+class FakeRoute53(FakeService):
+    service = 'route53'
+
+    def list_resource_record_sets(self, HostedZoneId, StartRecordName, StartRecordType, MaxItems):
+        self._call('ListResourceRecordSets')
+        return {'ResourceRecordSets': [{
+            'Name': StartRecordName.rstrip('.') + '.', 'Type': StartRecordType, 'TTL': 60,
+            'ResourceRecords': [{'Value': addr} for addr in self.aws.dns_records]
+        }]}
+
+    def change_resource_record_sets(self, HostedZoneId, ChangeBatch):
+        self._call('ChangeResourceRecordSets')
+        for change in ChangeBatch['Changes']:
+            self.aws.dns_records = [r['Value'] for r in change['ResourceRecordSet']['ResourceRecords']]
+        return {'ChangeInfo': {'Status': 'PENDING'}}
+
+
+class FakeRDS(FakeService):
+    service = 'rds'
+
+    def describe_db_instances(self, DBInstanceIdentifier):
+        self._call('DescribeDBInstances')
+        return {'DBInstances': [{'Endpoint': {'Address': 'bench.rds.local'},
+                                 'VpcSecurityGroups': [{'VpcSecurityGroupId': SECURITY_GROUP}]}]}
+
+
+class FakeELB(FakeService):
+    service = 'elb'
+
+    def describe_load_balancers(self, LoadBalancerNames):
+        self._call('DescribeLoadBalancers')
+        return {'LoadBalancerDescriptions': [{
+            'LoadBalancerName': name, 'Instances': [{'InstanceId': i} for i in sorted(self.aws.elb_members[name])]
+        } for name in LoadBalancerNames]}
+
+    def register_instances_with_load_balancer(self, LoadBalancerName, Instances):
+        self._call('RegisterInstancesWithLoadBalancer')
+        self.aws.elb_members[LoadBalancerName].update(i['InstanceId'] for i in Instances)
+
+    def deregister_instances_from_load_balancer(self, LoadBalancerName, Instances):
+        self._call('DeregisterInstancesFromLoadBalancer')
+        self.aws.elb_members[LoadBalancerName].difference_update(i['InstanceId'] for i in Instances)
+
+
+class FakeS3(FakeService):
+    service = 's3'
+
+    def __init__(self, aws):
+        super(FakeS3, self).__init__(aws)
+        self.objects = {}
+        self.uploads = {}
+        self.lock = threading.Lock()
+
+    def _store(self, key, data):
+        with self.lock:
+            self.objects[key] = (data, datetime.datetime.now(datetime.timezone.utc))
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self._call('PutObject')
+        self._store(Key, Body if isinstance(Body, bytes) else Body.read())
+        return {'ETag': '"%s"' % hashlib.md5(self.objects[Key][0]).hexdigest()}
+
+    def get_object(self, Bucket, Key):
+        self._call('GetObject')
+        if Key not in self.objects:
+            raise ClientError({'Error': {'Code': 'NoSuchKey', 'Message': Key}}, 'GetObject')
+        return {'Body': io.BytesIO(self.objects[Key][0])}
+
+    def create_multipart_upload(self, Bucket, Key, **kwargs):
+        self._call('CreateMultipartUpload')
+        upload_id = '%s-%s' % (Key, time.time())
+        self.uploads[upload_id] = {}
+        return {'UploadId': upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body, **kwargs):
+        self._call('UploadPart')
+        with self.lock:
+            self.uploads[UploadId][PartNumber] = hashlib.md5(Body).digest()
+        return {'ETag': '"%s"' % hashlib.md5(Body).hexdigest()}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        self._call('CompleteMultipartUpload')
+        digests = self.uploads.pop(UploadId)
+        parts = [digests[part['PartNumber']] for part in MultipartUpload['Parts']]
+        self._store(Key, b'')
+        return {'ETag': '"%s-%d"' % (hashlib.md5(b''.join(parts)).hexdigest(), len(parts))}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self._call('AbortMultipartUpload')
+        self.uploads.pop(UploadId, None)
+
+    def delete_objects(self, Bucket, Delete):
+        self._call('DeleteObjects')
+        with self.lock:
+            for obj in Delete['Objects']:
+                self.objects.pop(obj['Key'], None)
+        return {}
+
+    def get_paginator(self, name):
+        return FakePaginator(self._list_pages)
+
+    def _list_pages(self, Bucket, Prefix=''):
+        self._call('ListObjectsV2')
+        yield {'Contents': [{'Key': key, 'LastModified': modified, 'Size': len(data)}
+                            for key, (data, modified) in sorted(self.objects.items()) if key.startswith(Prefix)]}
+
+
+class FakeSQS(FakeService):
+    service = 'sqs'
+
+    def receive_message(self, QueueUrl, **kwargs):
+        self._call('ReceiveMessage')
+        messages, self.aws.messages = self.aws.messages[:10], self.aws.messages[10:]
+        return {'Messages': [{'ReceiptHandle': str(n), 'Body': body} for n, body in enumerate(messages)]}
+
+    def delete_message_batch(self, QueueUrl, Entries):
+        self._call('DeleteMessageBatch')
+        return {}
+
+
+class FakeAWS(object):
+    """In-process stand-in for the AWS services used by core/utils.py, sized to `nodes` instances.
+
+    The starting state is deliberately stale (old DNS records, missing ELB members, departed
+    security group entries) so reconcile tasks have real work to do.
+    """
+
+    def __init__(self, nodes, latency=0.0):
+        self.latency = latency
+        self.calls = Counter()
+        self.lock = threading.Lock()
+        dead = max(1, nodes // 20)
+        self.instances = [{
+            'InstanceId': 'i-%08x' % i,
+            'State': {'Name': 'running' if i < nodes else 'terminated'}
+        } for i in range(nodes + dead)]
+        # like EC2, only the running instances still report their addresses
+        for i, instance in enumerate(self.instances[:nodes]):
+            instance.update(PrivateIpAddress=private_ip(i), PublicIpAddress=public_ip(i))
+        # the private IPs an earlier reconcile recorded while the terminated nodes were still running
+        self.known_private_ips = {'i-%08x' % i: private_ip(i) for i in range(nodes + dead)}
+        running = [i['InstanceId'] for i in self.instances[:nodes]]
+        self.dns_records = [public_ip(i) for i in range(max(1, nodes - dead), nodes + dead)]
+        self.elb_members = {name: set(running[:int(nodes * 0.9)]) | set(i['InstanceId'] for i in self.instances[nodes:])
+                            for name in ELBS}
+        # node rules an earlier run authorized, and a VPC range an operator added by hand
+        self.security_group = {'%s/32' % public_ip(i): 'flynn-updater node'
+                               for i in range(int(nodes * 0.8), nodes + dead)}
+        self.security_group[VPC_CIDR] = None
+        self.messages = ['{"Event": "autoscaling:EC2_INSTANCE_LAUNCH", "EC2InstanceId": "i-%08x", '
+                         '"AutoScalingGroupName": "%s"}' % (i, ASG_NAME) for i in range(max(1, nodes // 50))]
+        self.autoscaling = FakeAutoScaling(self)
+        self.ec2 = FakeEC2Client(self)
+        self.route53 = FakeRoute53(self)
+        self.rds = FakeRDS(self)
+        self.elb = FakeELB(self)
+        self.s3 = FakeS3(self)
+        self.sqs = FakeSQS(self)
+
+    def record(self, service, operation):
+        with self.lock:
+            self.calls[(service, operation)] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def total_calls(self):
+        return sum(self.calls.values())
+
+
+class FakeRedis(object):
+    """Dict-backed subset of the redis client API used by the updater."""
+
+    def __init__(self):
+        self.data = {}
+        self.expiry = {}
+        self.lock = threading.RLock()
+
+    def _expired(self, key):
+        if key in self.expiry and self.expiry[key] <= time.time():
+            self.data.pop(key, None)
+            self.expiry.pop(key, None)
+
+    def get(self, key):
+        with self.lock:
+            self._expired(key)
+            value = self.data.get(key)
+            return value if value is None or isinstance(value, str) else str(value)
+
+    def set(self, key, value, ex=None, px=None, nx=False, xx=False):
+        with self.lock:
+            self._expired(key)
+            if (nx and key in self.data) or (xx and key not in self.data):
+                return None
+            self.data[key] = str(value)
+            self.expiry.pop(key, None)
+            if ex or px:
+                self.expiry[key] = time.time() + (ex if ex else px / 1000.0)
+            return True
+
+    def delete(self, *keys):
+        with self.lock:
+            for key in keys:
+                self._expired(key)
+                self.expiry.pop(key, None)
+            return sum(1 for key in keys if self.data.pop(key, None) is not None)
+
+    def pexpire(self, key, ms):
+        with self.lock:
+            self._expired(key)
+            if key not in self.data:
+                return 0
+            self.expiry[key] = time.time() + int(ms) / 1000.0
+            return 1
+
+    def hgetall(self, key):
+        with self.lock:
+            self._expired(key)
+            return dict(self.data.get(key, {}))
+
+    def hmset(self, key, mapping):
+        with self.lock:
+            self._expired(key)
+            self.data.setdefault(key, {}).update((field, str(value)) for field, value in mapping.items())
+            return True
+
+    def hdel(self, key, *fields):
+        with self.lock:
+            self._expired(key)
+            found = self.data.get(key, {})
+            return sum(1 for field in fields if found.pop(field, None) is not None)
+
+    def _renew(self, keys, args):
+        with self.lock:
+            return self.pexpire(keys[0], args[1]) if self.get(keys[0]) == args[0] else 0
+
+    def _release(self, keys, args):
+        with self.lock:
+            return self.delete(keys[0]) if self.get(keys[0]) == args[0] else 0
+
+    def register_script(self, script):
+        """Return the Python equivalent of one of the Lua scripts in core/locks.py."""
+        from flynn_updater.core.locks import RENEW_SCRIPT, RELEASE_SCRIPT
+        scripts = {RENEW_SCRIPT: self._renew, RELEASE_SCRIPT: self._release}
+        if script not in scripts:
+            raise ValueError('FakeRedis has no equivalent for script %r' % script)
+        implementation = scripts[script]
+
+        def run(keys=(), args=()):
+            return implementation(list(keys), list(args))
+        return run
+
+    def incr(self, key, amount=1):
+        with self.lock:
+            self._expired(key)
+            self.data[key] = str(int(self.data.get(key, 0)) + amount)
+            return int(self.data[key])
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+
+class FakePipeline(object):
+
+    def __init__(self, redis):
+        self.redis = redis
+        self.commands = []
+
+    def __getattr__(self, name):
+        def queue(*args, **kwargs):
+            self.commands.append((name, args, kwargs))
+            return self
+        return queue
+
+    def execute(self):
+        commands, self.commands = self.commands, []
+        return [getattr(self.redis, name)(*args, **kwargs) for name, args, kwargs in commands]
+
+
+class FakeBackupResponse(object):
+    """Streams `size` bytes of deterministic, mostly unique data like the controller's /backup."""
+
+    status_code = 200
+    headers = {'Content-Disposition': 'attachment; filename="flynn-backup-bench.tar"'}
+
+    def __init__(self, size, seed=0):
+        self.size = size
+        self.block = random.Random(seed).getrandbits(8 * 1024 * 1024).to_bytes(1024 * 1024, 'big')
+
+    def iter_content(self, chunk_size=1024 * 1024):
+        sent = 0
+        n = 0
+        while sent < self.size:
+            offset = (n * 4099) % len(self.block)
+            data = (self.block[offset:] + self.block[:offset])[:min(chunk_size, self.size - sent)]
+            sent += len(data)
+            n += 1
+            yield data
+
+    def close(self):
+        pass
@@ -0,0 +1,253 @@
+import json
+import os
+import shutil
+import stat
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import namedtuple, OrderedDict
+from django.conf import settings
+from flynn_updater.benchmarks import fakes
+from flynn_updater.benchmarks.fake_ssh import FakeSSHServer
+
+Measurement = namedtuple('Measurement', ['task', 'nodes', 'wall', 'aws_calls', 'spawns', 'ssh_connections',
+                                         'ssh_commands', 'queued', 'peak_mb', 'error'])
+
+TASKS = ['flynn_dns_update', 'aws_elb_update', 'flynn_update_discoverd_peers', 'flynn_rds_security_group_update',
+         'flynn_demote_dead_node', 'cluster_reconcile', 'flynn_event_ingest', 'flynn_gc', 'flynn_log_gc',
+         'flynn_s3_store', 'flynn_backup']
+SIZES = (10, 100, 1000)
+METRICS = ('wall', 'aws_calls', 'spawns', 'ssh_connections', 'ssh_commands', 'queued', 'peak_mb')
+# wall time and memory vary between runs; the call counts are deterministic
+NOISY = {'wall': 0.05, 'peak_mb': 1.0}
+
+
+class BenchmarkEnvironment(object):
+    """Points the updater at in-process fakes: AWS, Redis, a local SSH server and a fake flynn CLI.
+
+    Every patched attribute and setting is restored on exit.
+    """
+
+    def __init__(self, latency=0.0, backup_kb_per_node=64):
+        self.latency = latency
+        self.backup_kb_per_node = backup_kb_per_node
+        self.aws = None
+        self.spawns = 0
+        self.queued = 0
+        self._lock = threading.Lock()
+        self._patched = []
+
+    def _patch(self, obj, name, value):
+        self._patched.append((obj, name, getattr(obj, name)))
+        setattr(obj, name, value)
+
+    def __enter__(self):
+        from flynn_updater.celery import worker
+        from flynn_updater.core import backup
+        self.tmp = tempfile.mkdtemp(prefix='flynn-bench-')
+        self.ssh = FakeSSHServer()
+        self.flynn = os.path.join(self.tmp, 'flynn')
+        with open(os.path.join(os.path.dirname(__file__), 'fake_flynn.py')) as source:
+            script = source.read()
+        with open(self.flynn, 'w') as target:
+            target.write('#!%s\n%s' % (sys.executable, script))
+        os.chmod(self.flynn, os.stat(self.flynn).st_mode | stat.S_IEXEC)
+        self.state = os.path.join(self.tmp, 'state.json')
+        os.environ['FAKE_FLYNN_STATE'] = self.state
+
+        overrides = {
+            'AWS_AUTOSCALING_GROUP': fakes.ASG_NAME,
+            'AWS_ROUTE53_ZONE': fakes.ZONE_ID,
+            'AWS_ROUTE53_DOMAIN': fakes.DOMAIN,
+            'ELB': ','.join(fakes.ELBS),
+            'RDS_DB_ID': 'bench-db',
+            'DB_PORT': fakes.DB_PORT,
+            'S3_BLOBSTORE': 'bench-bucket',
+            'FLYNN_BACKEND': 'cli',
+            'FLYNN_PATH': self.flynn,
+            'SSH_PORT': self.ssh.port,
+            'SSH_USER': 'bench',
+            'SSH_KEY': self.ssh.private_key,
+            'EVENT_QUEUE_URL': 'https://sqs.bench.local/queue',
+            'CLUSTER_PRIVATE': False,
+        }
+        for name, value in overrides.items():
+            self._patch(settings, name, value)
+
+        environment = self
+
+        class CountingPopen(subprocess.Popen):
+            def __init__(self, *args, **kwargs):
+                with environment._lock:
+                    environment.spawns += 1
+                super(CountingPopen, self).__init__(*args, **kwargs)
+
+        def send_task(name, *args, **kwargs):
+            with self._lock:
+                self.queued += 1
+
+        self._patch(subprocess, 'Popen', CountingPopen)
+        self._patch(worker, 'send_task', send_task)
+        self._patch(backup, 'get_backup_stream',
+                    lambda: fakes.FakeBackupResponse(self.nodes * self.backup_kb_per_node * 1024))
+        return self
+
+    def __exit__(self, *exc):
+        from flynn_updater.core.ssh import ssh_pool
+        ssh_pool.close_all()
+        for obj, name, value in reversed(self._patched):
+            setattr(obj, name, value)
+        self.ssh.close()
+        shutil.rmtree(self.tmp, ignore_errors=True)
+        os.environ.pop('FAKE_FLYNN_STATE', None)
+
+    def _write_state(self, nodes):
+        names = ['controller', 'discoverd', 'blobstore', 'router', 'postgres']
+        names += ['app-%d' % i for i in range(max(5, nodes // 10))]
+        peers = ','.join('%s:1111' % fakes.private_ip(i) for i in range(int(nodes * 0.8)))
+        apps = [{
+            'id': '%08x-0000-0000-0000-%012x' % (n, n),
+            'name': name,
+            'system': n < 5,
+            'releases': ['%s-release-%d' % (name, r) for r in range(5, 0, -1)],
+            'env': {'DISCOVERD_PEERS': peers} if name == 'discoverd' else {'PORT': '8080'}
+        } for n, name in enumerate(names)]
+        # a blobstore still on the postgres backend, so flynn_s3_store has files to migrate
+        files = [['/%s/%08x.tgz' % (kind, n), 64 * 1024] for kind in ('slugs', 'layers') for n in range(nodes * 10)]
+        with open(self.state, 'w') as state:
+            json.dump({'apps': apps, 'job_cache_rows': nodes * 50, 'blobstore_files': files}, state)
+
+    def reset(self, nodes):
+        """Start a fresh, cold cluster of `nodes` running instances."""
+        from flynn_updater.core import cache, utils, backup, events
+        from flynn_updater.core.shell import app_catalog
+        from flynn_updater.core.ssh import ssh_pool
+        self.nodes = nodes
+        self.aws = fakes.FakeAWS(nodes, self.latency)
+        for module, name, value in ((utils, 'asg', self.aws.autoscaling), (utils, 'ec2', self.aws.ec2),
+                                    (utils, 'dns', self.aws.route53), (utils, 'rds', self.aws.rds),
+                                    (utils, 'elb', self.aws.elb), (utils, 's3', self.aws.s3),
+                                    (utils, 'sqs', self.aws.sqs), (backup, 's3', self.aws.s3),
+                                    (events, 'sqs', self.aws.sqs), (cache, '_redis', fakes.FakeRedis())):
+            self._patch(module, name, value)
+        cache.get_redis().hmset(cache.cache_key('nodes', 'private-ip'), self.aws.known_private_ips)
+        self._write_state(nodes)
+        app_catalog.invalidate()
+        ssh_pool.close_all()
+        self.ssh.reset()
+        self.spawns = 0
+        self.queued = 0
+
+    def measure(self, task_name):
+        from flynn_updater.celery import worker
+        error = None
+        tracemalloc.start()
+        start = time.time()
+        try:
+            worker.tasks[task_name]()
+        except Exception as e:
+            error = repr(e)
+        wall = time.time() - start
+        error = error or self.check(task_name)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return Measurement(task=task_name, nodes=self.nodes, wall=wall, aws_calls=self.aws.total_calls(),
+                           spawns=self.spawns, ssh_connections=self.ssh.connections, ssh_commands=self.ssh.commands,
+                           queued=self.queued, peak_mb=peak / 1024.0 / 1024.0, error=error)
+
+    def check(self, task_name):
+        """Report a run that finished without doing its job, which timings alone would not show."""
+        from flynn_updater.core.cache import get_redis, cache_key
+        if task_name in ('flynn_demote_dead_node', 'cluster_reconcile'):
+            dead = [i['InstanceId'] for i in self.aws.instances if i['State']['Name'] == 'terminated']
+            left = [instance_id for instance_id in dead if get_redis().get(cache_key('demoted', instance_id)) is None]
+            if left:
+                return '%d of %d dead nodes not demoted' % (len(left), len(dead))
+        if task_name == 'flynn_rds_security_group_update' and fakes.VPC_CIDR not in self.aws.security_group:
+            return 'hand-added range %s revoked' % fakes.VPC_CIDR
+        return None
+
+
+def run_benchmarks(sizes=SIZES, tasks=TASKS, latency=0.0, progress=None):
+    results = []
+    with BenchmarkEnvironment(latency=latency) as environment:
+        for nodes in sizes:
+            for task in tasks:
+                environment.reset(nodes)
+                result = environment.measure(task)
+                if progress is not None:
+                    progress(result)
+                results.append(result)
+    return results
+
+
+STARTUP = """
+import time
+start = time.time()
+import django
+django.setup()
+import flynn_updater.celery
+print(time.time() - start)
+"""
+
+
+def measure_startup(runs=5):
+    """Median seconds a fresh interpreter takes to set up Django and import the Celery app."""
+    env = dict(os.environ)
+    env.setdefault('DJANGO_SETTINGS_MODULE', 'flynn_updater.settings')
+    timings = sorted(float(subprocess.check_output([sys.executable, '-c', STARTUP], env=env,
+                                                   cwd=settings.BASE_DIR).split()[-1]) for _ in range(runs))
+    return timings[len(timings) // 2]
+
+
+def format_results(results):
+    lines = ['%-32s %6s %9s %9s %7s %8s %8s %7s %8s' % ('task', 'nodes', 'wall(s)', 'aws', 'spawns', 'ssh conn',
+                                                        'ssh cmd', 'queued', 'peak MB')]
+    for r in results:
+        lines.append('%-32s %6d %9.3f %9d %7d %8d %8d %7d %8.1f%s' % (
+            r.task, r.nodes, r.wall, r.aws_calls, r.spawns, r.ssh_connections, r.ssh_commands, r.queued, r.peak_mb,
+            '  ERROR %s' % r.error if r.error else ''))
+    return '\n'.join(lines)
+
+
+def _key(result):
+    return '%s@%d' % (result.task, result.nodes)
+
+
+def save_baseline(path, results):
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    baseline = OrderedDict((_key(r), OrderedDict((m, getattr(r, m)) for m in METRICS)) for r in results)
+    with open(path, 'w') as baseline_file:
+        json.dump(baseline, baseline_file, indent=2)
+
+
+def load_baseline(path):
+    with open(path) as baseline_file:
+        return json.load(baseline_file)
+
+
+def compare(results, baseline, tolerance=0.25):
+    """Return a description of every metric that got worse than the baseline."""
+    regressions = []
+    for result in results:
+        previous = baseline.get(_key(result))
+        if previous is None:
+            continue
+        if result.error:
+            regressions.append('%s: failed with %s' % (_key(result), result.error))
+        for metric in METRICS:
+            current, before = getattr(result, metric), previous.get(metric)
+            if before is None:
+                continue
+            if metric in NOISY:
+                worse = current > before * (1 + tolerance) and current - before > NOISY[metric]
+            else:
+                worse = current > before
+            if worse:
+                regressions.append('%s: %s %s -> %s' % (_key(result), metric, round(before, 3), round(current, 3)))
+    return regressions
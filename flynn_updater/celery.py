@@ -1,19 +1,30 @@
 from __future__ import absolute_import, unicode_literals
 
 import os
+import time
 
 from celery import Celery
 from celery.schedules import crontab
+from celery.signals import worker_init, worker_process_shutdown, task_prerun, task_postrun
 from celery.utils.log import get_task_logger
 from urllib.parse import urlparse
 from random import randint
 
+# set the default Django settings module for the 'celery' program.
+# set before the core imports so nothing they load can touch settings unconfigured
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'flynn_updater.settings')
+
 from flynn_updater.core.utils import *
 from flynn_updater.core.shell import *
 from flynn_updater.core.ssh import *
-
-# set the default Django settings module for the 'celery' program.
-os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'flynn_updater.settings')
+from flynn_updater.core.releases import gc_releases
+from flynn_updater.core.events import ingest_events
+from flynn_updater.core.reconcile import reconcile
+from flynn_updater.core import metrics
+from flynn_updater.core.locks import cluster_task
+from flynn_updater.core.clusters import get_clusters, use_cluster, DEFAULT_CLUSTER
+from flynn_updater.core.blobstore import migrate_blobstore, MigrationCheckpoint
+from flynn_updater.core.backup import flynn_backup_to_s3, flynn_incremental_backup_to_s3, prune_backups
 
 worker = Celery('flynn_updater', backend=settings.REDIS_URL, broker=settings.REDIS_URL)
 
@@ -24,124 +35,164 @@ worker.config_from_object('django.conf:settings', namespace='CELERY')
 worker.autodiscover_tasks(lambda: settings.INSTALLED_APPS)
 logger = get_task_logger(__name__)
 
+
+@worker_init.connect
+def start_metrics_server(**kwargs):
+    if settings.METRICS_PORT:
+        metrics.serve(settings.METRICS_PORT, settings.METRICS_ADDR)
+        logger.info('Serving metrics on %s:%d' % (settings.METRICS_ADDR, settings.METRICS_PORT))
+
+
+@worker_process_shutdown.connect
+def close_ssh_pool(**kwargs):
+    ssh_pool.close_all()
+    metrics.mark_process_dead(os.getpid())
+
+
+_task_started = {}
+
+
+@task_prerun.connect
+def task_started(task_id=None, **kwargs):
+    _task_started[task_id] = time.time()
+
+
+@task_postrun.connect
+def task_finished(task_id=None, task=None, state=None, **kwargs):
+    started = _task_started.pop(task_id, None)
+    if started is not None:
+        metrics.TASK_DURATION.labels(task.name, state or 'UNKNOWN').observe(time.time() - started)
+
+
+def cluster_schedule():
+    """Beat entries for the active cluster."""
+    # with an event queue configured, node changes trigger reconciles directly and polling is a safety net
+    poll_interval = float(settings.EVENT_SAFETY_INTERVAL) if settings.EVENT_QUEUE_URL else 60.0
+    schedule = {
+        'Flynn DNS update': {
+            'task': 'flynn_dns_update',
+            'schedule': poll_interval,
+            'args': ()
+        },
+        'Flynn ELB update': {
+            'task': 'aws_elb_update',
+            'schedule': poll_interval,
+            'args': ()
+        },
+        'Flynn discoverd update': {
+            'task': 'flynn_update_discoverd_peers',
+            'schedule': poll_interval,
+            'args': ()
+        },
+        'Flynn remote dead node': {
+            'task': 'flynn_demote_dead_node',
+            'schedule': 1800.0,
+            'args': ()
+        },
+        'Flynn backup': {
+            'task': 'flynn_backup',
+            'schedule': 3600.0,
+            'args': ()
+        },
+        'Flynn garbage collection': {
+            'task': 'flynn_gc',
+            'schedule': crontab(hour=6, minute=30, day_of_week=6),
+            'args': ()
+        },
+        'Flynn log GC': {
+            'task': 'flynn_log_gc',
+            'schedule': crontab(hour=7, minute=30, day_of_week=6),
+            'args': ()
+        },
+        'Flynn S3 datastore': {
+            'task': 'flynn_s3_store',
+            'schedule': 300.0,
+            'args': ()
+        },
+        # 'Flynn RDS database': {
+        #     'task': 'flynn_rds_db',
+        #     'schedule': 300.0,
+        #     'args': ()
+        # },
+        # 'Flynn RDS security group update': {
+        #     'task': 'flynn_rds_security_group_update',
+        #     'schedule': 60.0,
+        #     'args': ()
+        # },
+    }
+    if settings.CLUSTER_RECONCILE:
+        # one reconcile per tick replaces the per-resource polling tasks
+        for entry in ('Flynn DNS update', 'Flynn ELB update', 'Flynn discoverd update', 'Flynn remote dead node'):
+            del schedule[entry]
+        schedule['Flynn cluster reconcile'] = {
+            'task': 'cluster_reconcile',
+            'schedule': poll_interval,
+            'args': ()
+        }
+    if settings.EVENT_QUEUE_URL:
+        schedule['Flynn event ingest'] = {
+            'task': 'flynn_event_ingest',
+            'schedule': float(settings.EVENT_POLL_INTERVAL),
+            'args': ()
+        }
+    return schedule
+
+
 worker.conf.timezone = settings.TIMEZONE
 worker.conf.beat_schedule = {
-    'Flynn DNS update': {
-        'task': 'flynn_dns_update',
-        'schedule': 60.0,
-        'args': ()
-    },
-    'Flynn ELB update': {
-        'task': 'aws_elb_update',
-        'schedule': 60.0,
-        'args': ()
-    },
-    'Flynn discoverd update': {
-        'task': 'flynn_update_discoverd_peers',
-        'schedule': 600,
-        'args': ()
-    },
-    'Flynn remote dead node': {
-        'task': 'flynn_demote_dead_node',
-        'schedule': 1800.0,
-        'args': ()
-    },
-    'Flynn backup': {
-        'task': 'flynn_backup',
-        'schedule': 3600.0,
-        'args': ()
-    },
-    'Flynn garbage collection': {
-        'task': 'flynn_gc',
-        'schedule': crontab(hour=6, minute=30, day_of_week=6),
-        'args': ()
-    },
-    'Flynn log GC': {
-        'task': 'flynn_log_gc',
-        'schedule': crontab(hour=7, minute=30, day_of_week=6),
-        'args': ()
-    },
-    'Flynn S3 datastore': {
-        'task': 'flynn_s3_store',
-        'schedule': 300.0,
-        'args': ()
-    },
-    # 'Flynn RDS database': {
-    #     'task': 'flynn_rds_db',
-    #     'schedule': 300.0,
-    #     'args': ()
-    # },
-    # 'Flynn RDS security group update': {
-    #     'task': 'flynn_rds_security_group_update',
-    #     'schedule': 60.0,
-    #     'args': ()
-    # },
     'Flynn CLI update': {
         'task': 'flynn_cli_update',
         'schedule': crontab(hour=0, minute=30, day_of_week='*'),
         'args': ()
     },
 }
+# every cluster gets its own copy of each entry, so beat spreads their runs over the worker pool
+for cluster in get_clusters():
+    with use_cluster(cluster):
+        for entry, options in cluster_schedule().items():
+            name = entry if cluster == DEFAULT_CLUSTER else '%s (%s)' % (entry, cluster)
+            worker.conf.beat_schedule[name] = dict(options, kwargs={'cluster': cluster})
 
 
-@worker.task(name='flynn_dns_update')
-def flynn_dns_update():
-    asg_instances = get_instances([settings.AWS_AUTOSCALING_GROUP])
-    running_instances = get_instances_by_state(asg_instances)
-    if settings.CLUSTER_PRIVATE:
-        addrs = get_instance_private_addr(running_instances)
-    else:
-        addrs = get_instance_public_addr(running_instances)
+def _reconcile_summary(outcomes):
+    for outcome in outcomes:
+        logger.info('Reconcile %s: %s in %.1fs' % (outcome.name, 'ok' if outcome.ok else outcome.error, outcome.duration))
+    return {outcome.name: outcome.ok for outcome in outcomes}
+
 
-    logger.info('DNS update: %s (%s) with record %s' % (settings.AWS_ROUTE53_DOMAIN, settings.AWS_ROUTE53_ZONE, addrs))
-    record_set = []
-    for addr in addrs:
-        record_set.append({'Value': addr})
-    dns_update(zone_id=settings.AWS_ROUTE53_ZONE, domain=settings.AWS_ROUTE53_DOMAIN, records=record_set)
-    logger.info('DNS update complete.')
+@worker.task(name='flynn_dns_update')
+@cluster_task('flynn_dns_update', mode='coalesce')
+def flynn_dns_update(cluster=None):
+    return _reconcile_summary(reconcile(['dns']))
 
 
 @worker.task(name='flynn_gc')
-def flynn_gc():
+@cluster_task('flynn_gc', mode='skip')
+def flynn_gc(cluster=None):
     flynn_cli_init()
     apps = get_apps()
-    asg_instances = get_instances([settings.AWS_AUTOSCALING_GROUP])
-    running_instances = get_instances_by_state(asg_instances)
-    addrs = get_instance_private_addr(running_instances)
+    addrs = get_inventory().private_addrs()
 
-    for app in apps:
-        releases = get_app_release(app)
-        current = get_app_current_release(app)
-        for release in releases:
-            if not release == current:
-                delete_app_release(app, release)
-                logger.info('Release deleted: %s (%s)' % (app, release))
-
-    for host in addrs:
-        logger.info('Volume cleanup: %s' % host)
-        ssh_connect(host, settings.SSH_USER, settings.SSH_KEY)
-        stdout, stder = ssh_execute('sudo flynn-host volume gc')
-        logger.info('Volume deleted: %s' % stdout)
-        logger.error('Volume delete error: %s' % stder)
-        ssh_close()
+    for report in gc_releases(apps):
+        logger.info('Release GC %s: %s releases, %s kept, %s deleted, %s failed in %.1fs'
+                    % (report.app, report.releases, report.kept, report.deleted, report.failed, report.duration))
+
+    logger.info('Volume cleanup: %s' % addrs)
+    for result in run_on_hosts(addrs, 'sudo flynn-host volume gc', on_line=log_line, capture=False):
+        logger.info('Volume cleanup on %s finished in %.1fs (exit %s)' % (result.host, result.duration, result.exit_status))
+        if result.error:
+            logger.error('Volume delete error on %s: %s' % (result.host, result.error))
 
 
 @worker.task(name='flynn_demote_dead_node')
-def flynn_demote_dead_node():
-    asg_instances = get_instances([settings.AWS_AUTOSCALING_GROUP])
-    running_instances = get_instances_by_state(asg_instances)
-    addrs = get_instance_private_addr(running_instances)
-    dead_instances = get_instances_by_state(asg_instances, 'terminated')
-    for dead_instance in dead_instances:
-        logger.info('Dead node detected: %s' % dead_instance['InstanceId'])
-        ssh_connect(addrs[randint(0, len(addrs) - 1)], settings.SSH_USER, settings.SSH_KEY)
-        ssh_execute("sudo flynn-host demote --force %s" % get_instance_private_addr([dead_instance])[0])
-        logger.info('Dead node removed: %s' % dead_instance['InstanceId'])
-        ssh_close()
+@cluster_task('flynn_demote_dead_node', mode='coalesce')
+def flynn_demote_dead_node(cluster=None):
+    return _reconcile_summary(reconcile(['demote']))
 
 
 @worker.task(name='flynn_s3_store')
-def flynn_s3_store():
+@cluster_task('flynn_s3_store', mode='skip')
+def flynn_s3_store(cluster=None):
     flynn_cli_init()
     blobstore = get_app_env('blobstore')
     s3_enabled = False
@@ -155,8 +206,13 @@ def flynn_s3_store():
                      % (settings.AWS_DEFAULT_REGION, settings.S3_BLOBSTORE), 'DEFAULT_BACKEND=s3main']
         logger.info('S3 blobstore is configure to use S3 bucket %s in %s.' % (settings.S3_BLOBSTORE, settings.AWS_DEFAULT_REGION))
         set_app_env('blobstore', s3_params)
+    if not s3_enabled or MigrationCheckpoint().in_progress():
         logger.info('Migrating local blobstore to S3 bucket %s' % settings.S3_BLOBSTORE)
-        execute('%s -a blobstore run /bin/flynn-blobstore migrate --delete' % settings.FLYNN_PATH)
+        result = migrate_blobstore()
+        logger.info('Blobstore migration: %d of %d prefixes migrated, %d failed, %d still in flight, '
+                    '%d objects, %d bytes migrated in total, this run took %.1fs'
+                    % (result.migrated, result.prefixes, result.failed, result.in_flight, result.objects,
+                       result.bytes, result.duration))
 
 
 @worker.task(name='flynn_cli_update')
@@ -166,32 +222,16 @@ def flynn_cli_update():
 
 
 @worker.task(name='flynn_update_discoverd_peers')
-def flynn_update_discoverd_peers():
-    flynn_cli_init()
-    discoverd = get_app_release_json('discoverd')
-    exist_peers = discoverd['env']['DISCOVERD_PEERS'].replace(':1111', '').split(',')
-    asg_instances = get_instances([settings.AWS_AUTOSCALING_GROUP])
-    running_instances = get_instances_by_state(asg_instances)
-    addrs = get_instance_private_addr(running_instances)
-    update_peers = []
-    update_required = False
-    for I in addrs:
-        update_peers.append(I + ':1111')
-        if I not in exist_peers:
-            logger.info('discoverd found new node: %s' % I)
-            update_required = True
-    if update_required:
-        discoverd['env']['DISCOVERD_PEERS'] = ','.join(update_peers)
-        update_app_release('discoverd', discoverd)
-        logger.info('discoverd updated with %s' % update_peers)
+@cluster_task('flynn_update_discoverd_peers', mode='coalesce')
+def flynn_update_discoverd_peers(cluster=None):
+    return _reconcile_summary(reconcile(['discoverd']))
 
 
 @worker.task(name='flynn_rds_db')
-def flynn_rds_db():
+@cluster_task('flynn_rds_db', mode='skip')
+def flynn_rds_db(cluster=None):
     apps = ['blobstore', 'router', 'controller']
-    asg_instances = get_instances([settings.AWS_AUTOSCALING_GROUP])
-    running_instances = get_instances_by_state(asg_instances)
-    addrs = get_instance_public_addr(running_instances)
+    addrs = get_inventory().public_addrs()
     rd_endpoint = get_rds_endpoint(settings.RDS_DB_ID)
     flynn_cli_init()
     for app in apps:
@@ -220,55 +260,56 @@ def flynn_rds_db():
 
 
 @worker.task(name='flynn_rds_security_group_update')
-def flynn_rds_security_group_update():
-    asg_instances = get_instances([settings.AWS_AUTOSCALING_GROUP])
-    running_instances = get_instances_by_state(asg_instances)
-    addrs = get_instance_public_addr(running_instances)
-    dead_instances = get_instances_by_state(asg_instances, 'terminated')
-    dead_addrs = get_instance_public_addr(dead_instances)
-    dns_records = get_route53_records(zone_id=settings.AWS_ROUTE53_ZONE, domain=settings.AWS_ROUTE53_DOMAIN)
-    rds_security_group = get_rds_security_group(settings.RDS_DB_ID)
-    for addr in dead_addrs:
-        logger.info('Removing dead node (%s) RDS access.' % addr)
-        remove_security_group_rule(rds_security_group, addr, 5432)
-    for addr in addrs:
-        if addr not in dns_records:
-            logger.info('Adding new node (%s) RDS access.' % addr)
-        add_security_group_rule(rds_security_group, addr, 5432)
+@cluster_task('flynn_rds_security_group_update', mode='coalesce')
+def flynn_rds_security_group_update(cluster=None):
+    return _reconcile_summary(reconcile(['security_group']))
 
 
 @worker.task(name='flynn_log_gc')
-def flynn_log_gc():
+@cluster_task('flynn_log_gc', mode='skip')
+def flynn_log_gc(cluster=None):
     flynn_cli_init()
-    asg_instances = get_instances([settings.AWS_AUTOSCALING_GROUP])
-    running_instances = get_instances_by_state(asg_instances)
-    addrs = get_instance_public_addr(running_instances)
-    for addr in addrs:
-        logger.info('Clean up log on %s' %addr)
-        ssh_connect(addr, settings.SSH_USER, settings.SSH_KEY)
-        ssh_execute('sudo find /var/log/flynn -mtime +7 -iname *.log ! -iname flynn-host.log -delete')
-        ssh_close()
-    for app in get_apps():
-        app_id = get_app_id(app)
-        logger.info('Clean up %s (%s) logs' % (app, app_id))
-        execute("%s -a controller pg psql -- -c \" delete from job_cache where app_id='%s' and state!='up' andcreated_at < now() - interval '7 days'\"" % (settings.FLYNN_PATH, app_id))
+    addrs = get_inventory().public_addrs()
+    logger.info('Clean up log on %s' % addrs)
+    for result in run_on_hosts(addrs, 'sudo find /var/log/flynn -mtime +7 -iname *.log ! -iname flynn-host.log -delete'):
+        if result.exit_status != 0:
+            logger.error('Log clean up failed on %s (exit %s): %s' % (result.host, result.exit_status, result.error or result.stderr))
+    apps = app_catalog.apps()
+    logger.info('Clean up job cache of %s' % [app.name for app in apps])
+    result = cleanup_job_cache([app.id for app in apps])
+    if result.error:
+        logger.error('Job cache clean up failed after %d rows: %s' % (result.deleted, result.error))
+    logger.info('Job cache clean up removed %d rows in %d batches (%.1fs)' % (result.deleted, result.batches, result.duration))
 
 
 @worker.task(name='aws_elb_update')
-def aws_elb_update():
-    if settings.ELB is not '':
-        elbs = settings.ELB.split(',')
-        asg_instances = get_instances([settings.AWS_AUTOSCALING_GROUP])
-        running_instances = get_instances_by_state(asg_instances)
-        instances = []
-        for instance in running_instances:
-            instances.append(instance['InstanceId'])
-        for elb in elbs:
-            logger.info('Update ELB %s with instances %s' % (elb, instances))
-            register_instances_with_elb(elb, instances)
+@cluster_task('aws_elb_update', mode='coalesce')
+def aws_elb_update(cluster=None):
+    return _reconcile_summary(reconcile(['elb']))
+
+
+@worker.task(name='cluster_reconcile')
+@cluster_task('cluster_reconcile', mode='coalesce')
+def cluster_reconcile(cluster=None):
+    return _reconcile_summary(reconcile())
+
+
+@worker.task(name='flynn_event_ingest')
+@cluster_task('flynn_event_ingest', mode='skip')
+def flynn_event_ingest(cluster=None):
+    events, scheduled = ingest_events()
+    if scheduled:
+        logger.info('%d cluster events triggered %s' % (len(events), scheduled))
+    return len(events)
 
 
 @worker.task(name='flynn_backup')
-def flynn_backup():
-    flynn_backup_to_s3(settings.S3_BLOBSTORE)
+@cluster_task('flynn_backup', mode='skip')
+def flynn_backup(cluster=None):
+    if settings.BACKUP_MODE == 'incremental':
+        flynn_incremental_backup_to_s3(settings.S3_BLOBSTORE)
+    else:
+        flynn_backup_to_s3(settings.S3_BLOBSTORE)
+    if settings.BACKUP_RETENTION:
+        prune_backups(settings.S3_BLOBSTORE)
 
@@ -0,0 +1,71 @@
+import os
+import threading
+import time
+import boto3
+from botocore.config import Config
+from flynn_updater.core.clusters import settings
+from flynn_updater.core.metrics import AWS_CLIENT_INIT, instrument_client
+
+
+class ClientRegistry(object):
+    """Builds each boto3 client on first use and shares it between the threads of a process.
+
+    Clients are thrown away after a fork, a prefork worker child builds its own instead of
+    sharing the parent's connection pool.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pid = None
+        self._session = None
+        self._clients = {}
+
+    def _config(self):
+        return Config(max_pool_connections=settings.AWS_MAX_POOL_CONNECTIONS,
+                      connect_timeout=settings.AWS_CONNECT_TIMEOUT,
+                      read_timeout=settings.AWS_READ_TIMEOUT,
+                      retries={'mode': settings.AWS_RETRY_MODE, 'max_attempts': settings.AWS_MAX_ATTEMPTS})
+
+    def client(self, service):
+        # clusters may live in different regions
+        key = (service, settings.AWS_DEFAULT_REGION)
+        if self._pid == os.getpid():
+            client = self._clients.get(key)
+            if client is not None:
+                return client
+        with self._lock:
+            if self._pid != os.getpid():
+                # boto3's default session is not thread safe, each process gets its own
+                self._pid = os.getpid()
+                self._session = boto3.session.Session()
+                self._clients = {}
+            if key not in self._clients:
+                start = time.time()
+                client = self._session.client(service, region_name=key[1], config=self._config())
+                AWS_CLIENT_INIT.labels(service).observe(time.time() - start)
+                self._clients[key] = instrument_client(client)
+            return self._clients[key]
+
+    def lazy(self, service):
+        return LazyClient(self, service)
+
+    def clear(self):
+        with self._lock:
+            self._clients = {}
+
+
+class LazyClient(object):
+    """Module level stand-in for a client that is only built when it is first used."""
+
+    def __init__(self, registry, service):
+        self._registry = registry
+        self._service = service
+
+    def __getattr__(self, name):
+        return getattr(self._registry.client(self._service), name)
+
+    def __repr__(self):
+        return '<LazyClient %s>' % self._service
+
+
+clients = ClientRegistry()
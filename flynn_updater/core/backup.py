@@ -0,0 +1,366 @@
+import bisect
+import datetime
+import hashlib
+import json
+import threading
+import time
+from collections import namedtuple, deque
+from contextlib import contextmanager
+from botocore.exceptions import ClientError
+from flynn_updater.core.clusters import settings, ClusterThreadPoolExecutor
+from celery.utils.log import get_task_logger
+from flynn_updater.core.locks import LeaseLock
+from flynn_updater.core.utils import s3, get_backup_stream, get_backup_filename, stream_to_s3
+
+logger = get_task_logger(__name__)
+
+BACKUP_PREFIX = 'backup/'
+# kept outside backup/ so bootstrap.sh's `aws s3 ls backup/ | sort -r | head -n 1` only sees backups
+CATALOG_KEY = 'backup-index.json'
+CHUNK_PREFIX = 'backup-chunks/'
+MANIFEST_PREFIX = 'backup-manifests/'
+# chunks younger than this may belong to a backup whose manifest is not written yet
+SWEEP_GRACE = 24 * 3600
+
+CatalogEntry = namedtuple('CatalogEntry', ['key', 'kind', 'timestamp', 'size'])
+IncrementalBackupResult = namedtuple('IncrementalBackupResult', ['manifest', 'size', 'chunks', 'uploaded',
+                                                                 'uploaded_bytes', 'duration', 'sha256'])
+
+
+def _read_object(s3_bucket, key):
+    try:
+        return s3.get_object(Bucket=s3_bucket, Key=key)['Body'].read().decode('utf-8')
+    except ClientError as error:
+        if error.response['Error']['Code'] == 'NoSuchKey':
+            return None
+        raise
+
+
+def _list_entries(s3_bucket, prefix, kind):
+    entries = []
+    for page in s3.get_paginator('list_objects_v2').paginate(Bucket=s3_bucket, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            if kind == 'incremental' and not obj['Key'].endswith('.json'):
+                continue
+            entries.append(CatalogEntry(key=obj['Key'], kind=kind, timestamp=obj['LastModified'].timestamp(),
+                                        size=obj['Size']))
+    return entries
+
+
+def rebuild_catalog(s3_bucket):
+    """Recreate the catalog from a full listing; only needed once or after the index is lost."""
+    entries = _list_entries(s3_bucket, BACKUP_PREFIX, 'full') + _list_entries(s3_bucket, MANIFEST_PREFIX, 'incremental')
+    save_catalog(s3_bucket, entries)
+    return sorted(entries, key=lambda e: e.timestamp)
+
+
+def get_catalog(s3_bucket):
+    """Return every cataloged backup, oldest first, with a single GET."""
+    body = _read_object(s3_bucket, CATALOG_KEY)
+    if body is None:
+        return rebuild_catalog(s3_bucket)
+    return [CatalogEntry(*entry) for entry in json.loads(body)['backups']]
+
+
+def save_catalog(s3_bucket, entries: list):
+    entries = sorted(entries, key=lambda e: e.timestamp)
+    s3.put_object(Bucket=s3_bucket, Key=CATALOG_KEY, ContentType='application/json',
+                  Body=json.dumps({'version': 1, 'backups': [list(entry) for entry in entries]}).encode('utf-8'))
+
+
+@contextmanager
+def catalog_lock(s3_bucket, wait=60):
+    """Serialise read-modify-write updates of the catalog object between workers."""
+    lock = LeaseLock('backup-catalog:%s' % s3_bucket, ttl=60)
+    deadline = time.time() + wait
+    while not lock.acquire():
+        if time.time() > deadline:
+            raise RuntimeError('Backup catalog of %s still locked after %ds' % (s3_bucket, wait))
+        time.sleep(0.2)
+    try:
+        yield
+    finally:
+        lock.release()
+
+
+def add_to_catalog(s3_bucket, entry):
+    with catalog_lock(s3_bucket):
+        entries = [e for e in get_catalog(s3_bucket) if e.key != entry.key]
+        entries.append(entry)
+        save_catalog(s3_bucket, entries)
+
+
+def list_backups(s3_bucket, count=None, kind=None):
+    """Return the newest `count` backups, newest first."""
+    entries = [e for e in reversed(get_catalog(s3_bucket)) if kind is None or e.kind == kind]
+    return entries[:count] if count else entries
+
+
+def get_backup_at(s3_bucket, when, kind=None):
+    """Return the newest backup taken at or before `when` (a datetime or epoch seconds)."""
+    if isinstance(when, datetime.datetime):
+        when = when.timestamp()
+    entries = [e for e in get_catalog(s3_bucket) if kind is None or e.kind == kind]
+    index = bisect.bisect_right([e.timestamp for e in entries], when)
+    return entries[index - 1] if index else None
+
+
+def get_latest_backup(s3_bucket):
+    latest = list_backups(s3_bucket, 1, 'full')
+    return latest[0].key if latest else None
+
+
+def select_expired(entries: list, now=None, hourly=None, daily=None, weekly=None):
+    """Thin backups to every one from the last `hourly` hours, the newest per day for `daily`
+    days and the newest per ISO week for `weekly` weeks. Returns the entries to delete.
+    """
+    now = now or time.time()
+    hourly = settings.BACKUP_KEEP_HOURLY if hourly is None else hourly
+    daily = settings.BACKUP_KEEP_DAILY if daily is None else daily
+    weekly = settings.BACKUP_KEEP_WEEKLY if weekly is None else weekly
+    keep = set()
+    days = set()
+    weeks = set()
+    for entry in sorted(entries, key=lambda e: e.timestamp, reverse=True):
+        age = now - entry.timestamp
+        moment = datetime.datetime.utcfromtimestamp(entry.timestamp)
+        day, week = moment.date(), moment.isocalendar()[:2]
+        if age <= hourly * 3600:
+            keep.add(entry.key)
+        elif age <= daily * 86400 and day not in days:
+            keep.add(entry.key)
+        elif age <= weekly * 7 * 86400 and week not in weeks:
+            keep.add(entry.key)
+        else:
+            continue
+        # a kept backup covers its day and week, older ones there are not kept again
+        days.add(day)
+        weeks.add(week)
+    if entries:
+        keep.add(max(entries, key=lambda e: e.timestamp).key)
+    return [entry for entry in entries if entry.key not in keep]
+
+
+def _delete_keys(s3_bucket, keys: list):
+    deleted = set()
+    for i in range(0, len(keys), 1000):
+        response = s3.delete_objects(Bucket=s3_bucket, Delete={
+            'Objects': [{'Key': key} for key in keys[i:i + 1000]],
+            'Quiet': True
+        })
+        failed = set(error['Key'] for error in response.get('Errors', []))
+        for error in response.get('Errors', []):
+            logger.error('Backup prune failed for %s: %s' % (error['Key'], error.get('Message')))
+        deleted.update(key for key in keys[i:i + 1000] if key not in failed)
+    return deleted
+
+
+def sweep_chunks(s3_bucket, manifests: list):
+    """Delete the chunks none of `manifests` references, apart from ones uploaded within SWEEP_GRACE."""
+    with ClusterThreadPoolExecutor(max_workers=settings.BACKUP_UPLOAD_WORKERS) as executor:
+        referenced = set(digest for manifest in executor.map(lambda key: get_manifest(s3_bucket, key), manifests)
+                         for digest, _ in manifest['chunks'])
+    cutoff = time.time() - SWEEP_GRACE
+    unreferenced = []
+    for page in s3.get_paginator('list_objects_v2').paginate(Bucket=s3_bucket, Prefix=CHUNK_PREFIX):
+        for obj in page.get('Contents', []):
+            if obj['Key'].rsplit('/', 1)[-1] not in referenced and obj['LastModified'].timestamp() < cutoff:
+                unreferenced.append(obj['Key'])
+    deleted = _delete_keys(s3_bucket, unreferenced)
+    logger.info('Backup chunk sweep deleted %d chunks, %d still referenced' % (len(deleted), len(referenced)))
+    return sorted(deleted)
+
+
+def prune_backups(s3_bucket):
+    """Apply the retention policy per backup kind and delete expired objects in batches of 1000.
+
+    Chunks are shared between incremental backups, so they are swept afterwards: whatever the
+    remaining manifests do not reference goes.
+    """
+    entries = get_catalog(s3_bucket)
+    expired = []
+    for kind in ('full', 'incremental'):
+        expired.extend(select_expired([e for e in entries if e.kind == kind]))
+    deleted = _delete_keys(s3_bucket, [entry.key for entry in expired])
+    with catalog_lock(s3_bucket):
+        # re-read under the lock, a backup may have been added since
+        entries = [e for e in get_catalog(s3_bucket) if e.key not in deleted]
+        if deleted:
+            save_catalog(s3_bucket, entries)
+    logger.info('Backup retention pruned %d of %d backups' % (len(deleted), len(entries) + len(deleted)))
+    sweep_chunks(s3_bucket, [e.key for e in entries if e.kind == 'incremental'])
+    return sorted(deleted)
+
+
+def flynn_backup_to_s3(s3_bucket):
+    backup = get_backup_stream()
+    try:
+        if backup.status_code == 200:
+            backup_file = get_backup_filename(backup)
+            logger.info('Backup Flynn cluster %s to %s/backup/%s' % (settings.AWS_ROUTE53_DOMAIN, settings.S3_BLOBSTORE, backup_file))
+            result = stream_to_s3(backup, s3_bucket, '%s%s' % (BACKUP_PREFIX, backup_file))
+            logger.info('Backup %s uploaded: %d bytes in %d parts, %.1fs (%.2f MB/s), sha256 %s'
+                        % (result.key, result.size, result.parts, result.duration,
+                           result.size / 1024.0 / 1024.0 / max(result.duration, 0.001), result.sha256))
+            add_to_catalog(s3_bucket, CatalogEntry(key=result.key, kind='full', timestamp=time.time(), size=result.size))
+            return result
+        logger.error('Backup Flynn cluster %s failed: %s' % (settings.AWS_ROUTE53_DOMAIN, backup.status_code))
+    finally:
+        backup.close()
+
+
+# Maps every byte value to one pseudo-random bit; derived from sha256 so every worker cuts at the same offsets.
+ANCHOR_BITS = bytes(hashlib.sha256(bytes([i])).digest()[0] >> 7 for i in range(256))
+_ANCHOR_SEED = hashlib.sha256(b'flynn-updater backup chunks').digest()
+
+
+def chunk_anchor(bits):
+    """The bit pattern, one byte per bit, that marks a chunk boundary; it turns up every 2**bits bytes on average."""
+    return bytes((_ANCHOR_SEED[i // 8] >> (7 - i % 8)) & 1 for i in range(bits))
+
+
+def _find_cut(buffer, min_size, anchor, max_size):
+    # bytes.translate and bytes.find run in C, so the boundary search never loops over bytes in Python
+    end = min(len(buffer), max_size)
+    if end <= min_size:
+        return end
+    start = max(0, min_size - len(anchor))
+    found = buffer[start:end].translate(ANCHOR_BITS).find(anchor)
+    return end if found < 0 else start + found + len(anchor)
+
+
+def iter_chunks(blocks, min_size=None, avg_size=None, max_size=None):
+    """Split an iterable of byte blocks into content-defined chunks.
+
+    A chunk ends where the bytes before it map onto the anchor pattern, so boundaries depend
+    only on the bytes around them. Data unchanged between two backups yields the same chunks
+    even when content before it grows or shrinks.
+    """
+    min_size = min_size or settings.BACKUP_CHUNK_MIN * 1024
+    avg_size = avg_size or settings.BACKUP_CHUNK_AVG * 1024
+    max_size = max_size or settings.BACKUP_CHUNK_MAX * 1024
+    anchor = chunk_anchor(max(1, (avg_size - min_size).bit_length() - 1))
+    buffer = bytearray()
+    for block in blocks:
+        buffer.extend(block)
+        while len(buffer) >= max_size:
+            cut = _find_cut(buffer, min_size, anchor, max_size)
+            yield bytes(buffer[:cut])
+            del buffer[:cut]
+    while buffer:
+        cut = _find_cut(buffer, min_size, anchor, max_size)
+        yield bytes(buffer[:cut])
+        del buffer[:cut]
+
+
+def chunk_key(digest):
+    return '%s%s/%s' % (CHUNK_PREFIX, digest[:2], digest)
+
+
+def get_manifest(s3_bucket, key):
+    return json.loads(s3.get_object(Bucket=s3_bucket, Key=key)['Body'].read().decode('utf-8'))
+
+
+def get_known_chunks(s3_bucket):
+    latest = list_backups(s3_bucket, 1, 'incremental')
+    if not latest:
+        return set()
+    return set(digest for digest, _ in get_manifest(s3_bucket, latest[0].key)['chunks'])
+
+
+def _put_chunk(s3_bucket, digest, data):
+    s3.put_object(Bucket=s3_bucket, Key=chunk_key(digest), Body=data)
+    return len(data)
+
+
+def flynn_incremental_backup_to_s3(s3_bucket):
+    """Back up the cluster as deduplicated chunks plus a small manifest.
+
+    Chunks referenced by the previous manifest are not uploaded again.
+    """
+    backup = get_backup_stream()
+    try:
+        if backup.status_code != 200:
+            logger.error('Backup Flynn cluster %s failed: %s' % (settings.AWS_ROUTE53_DOMAIN, backup.status_code))
+            return None
+        backup_file = get_backup_filename(backup)
+        start = time.time()
+        known = get_known_chunks(s3_bucket)
+        sha256 = hashlib.sha256()
+        chunks = []
+        uploads = []
+        size = 0
+        slots = threading.BoundedSemaphore(settings.BACKUP_UPLOAD_WORKERS)
+        with ClusterThreadPoolExecutor(max_workers=settings.BACKUP_UPLOAD_WORKERS) as executor:
+            for data in iter_chunks(backup.iter_content(chunk_size=1024 * 1024)):
+                digest = hashlib.sha256(data).hexdigest()
+                sha256.update(data)
+                size += len(data)
+                chunks.append([digest, len(data)])
+                if digest in known:
+                    continue
+                known.add(digest)
+                slots.acquire()
+                future = executor.submit(_put_chunk, s3_bucket, digest, data)
+                future.add_done_callback(lambda f: slots.release())
+                uploads.append(future)
+            uploaded_bytes = sum(future.result() for future in uploads)
+
+        manifest_key = '%s%s.json' % (MANIFEST_PREFIX, backup_file)
+        manifest = {
+            'version': 1,
+            'name': backup_file,
+            'created_at': datetime.datetime.utcnow().isoformat() + 'Z',
+            'size': size,
+            'sha256': sha256.hexdigest(),
+            'chunks': chunks
+        }
+        s3.put_object(Bucket=s3_bucket, Key=manifest_key, Body=json.dumps(manifest).encode('utf-8'),
+                      ContentType='application/json')
+        add_to_catalog(s3_bucket, CatalogEntry(key=manifest_key, kind='incremental', timestamp=time.time(), size=size))
+        result = IncrementalBackupResult(manifest=manifest_key, size=size, chunks=len(chunks), uploaded=len(uploads),
+                                         uploaded_bytes=uploaded_bytes, duration=time.time() - start,
+                                         sha256=sha256.hexdigest())
+        logger.info('Incremental backup %s: %d bytes in %d chunks, uploaded %d chunks (%d bytes) in %.1fs'
+                    % (result.manifest, result.size, result.chunks, result.uploaded, result.uploaded_bytes, result.duration))
+        return result
+    finally:
+        backup.close()
+
+
+def _get_chunk(s3_bucket, digest):
+    data = s3.get_object(Bucket=s3_bucket, Key=chunk_key(digest))['Body'].read()
+    if hashlib.sha256(data).hexdigest() != digest:
+        raise ValueError('Chunk %s is corrupt' % digest)
+    return data
+
+
+def iter_incremental_backup(s3_bucket, manifest_key, prefetch=None):
+    """Yield the original backup bytes chunk by chunk, fetching up to `prefetch` chunks ahead."""
+    manifest = get_manifest(s3_bucket, manifest_key)
+    prefetch = prefetch or settings.BACKUP_UPLOAD_WORKERS
+    sha256 = hashlib.sha256()
+    pending = deque()
+    digests = iter(manifest['chunks'])
+    with ClusterThreadPoolExecutor(max_workers=prefetch) as executor:
+        for digest, _ in digests:
+            pending.append(executor.submit(_get_chunk, s3_bucket, digest))
+            if len(pending) >= prefetch:
+                break
+        while pending:
+            data = pending.popleft().result()
+            for digest, _ in digests:
+                pending.append(executor.submit(_get_chunk, s3_bucket, digest))
+                break
+            sha256.update(data)
+            yield data
+    if sha256.hexdigest() != manifest['sha256']:
+        raise ValueError('Restored backup %s does not match manifest checksum' % manifest_key)
+
+
+def restore_incremental_backup(s3_bucket, manifest_key, fileobj):
+    size = 0
+    for data in iter_incremental_backup(s3_bucket, manifest_key):
+        fileobj.write(data)
+        size += len(data)
+    return size
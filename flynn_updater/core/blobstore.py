@@ -0,0 +1,180 @@
+import json
+import time
+from collections import namedtuple, OrderedDict
+from concurrent.futures import as_completed
+from celery.utils.log import get_task_logger
+from flynn_updater.core.cache import get_redis, cache_key
+from flynn_updater.core.clusters import settings, ClusterThreadPoolExecutor
+from flynn_updater.core.shell import run
+
+logger = get_task_logger(__name__)
+
+S3_BACKEND = 's3main'
+
+BlobstoreObject = namedtuple('BlobstoreObject', ['name', 'size'])
+# objects and bytes are totals since the migration started, including earlier resumed runs
+MigrationResult = namedtuple('MigrationResult', ['prefixes', 'migrated', 'failed', 'in_flight', 'resumed', 'objects',
+                                                 'bytes', 'duration'])
+
+
+def list_blobstore_objects(backend=S3_BACKEND):
+    """Live blobstore files not yet stored on `backend`, read from the blobstore database in one query."""
+    query = ("SELECT name, size FROM files WHERE deleted_at IS NULL AND backend <> '%s' ORDER BY name;\n"
+             % backend)
+    result = run('%s -a blobstore pg psql -- -X -q -t -A -F "|" -v ON_ERROR_STOP=1' % settings.FLYNN_PATH,
+                 input=query)
+    if result.returncode != 0 or result.timed_out:
+        raise RuntimeError('Listing blobstore files failed: %s' % ' '.join(result.stderr).strip())
+    objects = []
+    for line in result.stdout:
+        if '|' in line:
+            name, size = line.rsplit('|', 1)
+            objects.append(BlobstoreObject(name, int(size or 0)))
+    return objects
+
+
+def partition(objects: list, max_objects=None):
+    """Split sorted objects into name prefixes holding at most `max_objects` each where possible.
+
+    Prefixes are refined one character at a time, so together they cover every object exactly once.
+    A prefix that is itself a file name is not split further.
+    """
+    max_objects = max_objects or settings.BLOBSTORE_PREFIX_OBJECTS
+    groups = OrderedDict()
+    if not objects:
+        return groups
+    pending = [('', objects)]
+    while pending:
+        prefix, members = pending.pop(0)
+        if len(members) <= max_objects or any(obj.name == prefix for obj in members):
+            groups[prefix] = members
+            continue
+        children = OrderedDict()
+        for obj in members:
+            children.setdefault(obj.name[:len(prefix) + 1], []).append(obj)
+        pending.extend(children.items())
+    return groups
+
+
+class MigrationCheckpoint(object):
+    """Marks a migration as unfinished and keeps its running totals in Redis across worker restarts."""
+
+    def __init__(self):
+        self.key = cache_key('blobstore', 'migration')
+
+    def load(self):
+        return json.loads(get_redis().get(self.key) or 'null')
+
+    def start(self):
+        state = self.load()
+        resumed = state is not None
+        state = state or {'objects': 0, 'bytes': 0, 'started': time.time()}
+        self.save(state)
+        return state, resumed
+
+    def save(self, state):
+        get_redis().set(self.key, json.dumps(state), ex=settings.BLOBSTORE_CHECKPOINT_TTL)
+
+    def clear(self):
+        get_redis().delete(self.key)
+
+    def in_progress(self):
+        return self.load() is not None
+
+
+class InFlightPrefixes(object):
+    """Prefixes with a migrate job that may still be running on the cluster, kept in Redis.
+
+    Killing `flynn run` on a timeout leaves the job itself running, so a timed-out prefix
+    stays marked until BLOBSTORE_INFLIGHT_TTL has passed and is not planned again meanwhile.
+    Marks are only written by migrate_blobstore, which runs on one worker at a time.
+    """
+
+    def __init__(self):
+        self.key = cache_key('blobstore', 'in-flight')
+
+    def active(self):
+        now = time.time()
+        marks = get_redis().hgetall(self.key) or {}
+        expired = [prefix for prefix, until in marks.items() if float(until) <= now]
+        if expired:
+            get_redis().hdel(self.key, *expired)
+        return set(marks) - set(expired)
+
+    def mark(self, prefixes):
+        until = time.time() + settings.BLOBSTORE_MIGRATE_TIMEOUT + settings.BLOBSTORE_INFLIGHT_TTL
+        if prefixes:
+            get_redis().hmset(self.key, {prefix: until for prefix in prefixes})
+
+    def clear(self, prefix):
+        get_redis().hdel(self.key, prefix)
+
+    @staticmethod
+    def overlaps(prefix, active):
+        # partitions change between runs, a new prefix may sit inside or around an in-flight one
+        return any(prefix.startswith(other) or other.startswith(prefix) for other in active)
+
+
+def _migrate_prefix(prefix, in_flight):
+    result = run([settings.FLYNN_PATH, '-a', 'blobstore', 'run', '/bin/flynn-blobstore', 'migrate', '--delete',
+                  '--prefix=%s' % prefix], shell=False, timeout=settings.BLOBSTORE_MIGRATE_TIMEOUT)
+    if result.timed_out:
+        # the job may still be running on the cluster, leave the prefix marked
+        return 'timed out after %.0fs' % result.duration
+    in_flight.clear(prefix)
+    if result.returncode != 0:
+        return ' '.join(result.stderr).strip() or 'exit status %s' % result.returncode
+    return None
+
+
+def migrate_blobstore(max_workers=None):
+    """Move every blobstore file onto S3, one `flynn-blobstore migrate --prefix` job per partition.
+
+    Migrated files leave the listing, so a run only ever plans what is still left. That makes a
+    restarted or partly failed migration pick up where it stopped. Prefixes overlapping a job
+    that may still be running are left for a later run. The checkpoint stays in place until a
+    run finishes with nothing failed or skipped, so the task knows to come back to it.
+    """
+    start = time.time()
+    checkpoint = MigrationCheckpoint()
+    state, resumed = checkpoint.start()
+    in_flight = InFlightPrefixes()
+    active = in_flight.active()
+    groups = partition(list_blobstore_objects())
+    skipped = [prefix for prefix in groups if in_flight.overlaps(prefix, active)]
+    for prefix in skipped:
+        del groups[prefix]
+    total_objects = sum(len(members) for members in groups.values())
+    total_bytes = sum(obj.size for members in groups.values() for obj in members)
+    logger.info('Blobstore migration%s: %d objects (%d bytes) left in %d prefixes, %d prefixes still in flight'
+                % (' resumed' if resumed else '', total_objects, total_bytes, len(groups), len(skipped)))
+
+    migrated, failed, objects, size = 0, 0, 0, 0
+    if groups:
+        in_flight.mark(list(groups))
+        workers = min(len(groups), max_workers or settings.BLOBSTORE_MIGRATE_WORKERS)
+        with ClusterThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(_migrate_prefix, prefix, in_flight): (prefix, members)
+                       for prefix, members in groups.items()}
+            for future in as_completed(futures):
+                prefix, members = futures[future]
+                error = future.result()
+                if error:
+                    failed += 1
+                    logger.error('Blobstore migration of %r failed: %s' % (prefix, error))
+                    continue
+                migrated += 1
+                objects += len(members)
+                size += sum(obj.size for obj in members)
+                state['objects'] += len(members)
+                state['bytes'] += sum(obj.size for obj in members)
+                checkpoint.save(state)
+                elapsed = max(time.time() - start, 0.001)
+                logger.info('Blobstore migration: %d/%d prefixes, %d/%d objects, %.1f objects/s, %.2f MB/s'
+                            % (migrated, len(groups), objects, total_objects, objects / elapsed,
+                               size / elapsed / 1024 / 1024))
+    if not failed and not skipped:
+        checkpoint.clear()
+    return MigrationResult(prefixes=len(groups), migrated=migrated, failed=failed, in_flight=len(skipped),
+                           resumed=resumed, objects=state['objects'], bytes=state['bytes'],
+                           duration=time.time() - start)
@@ -0,0 +1,18 @@
+import redis
+from django.conf import settings
+from flynn_updater.core.clusters import current_cluster, DEFAULT_CLUSTER
+
+_redis = None
+
+
+def get_redis():
+    global _redis
+    if _redis is None:
+        _redis = redis.StrictRedis.from_url(settings.REDIS_URL, decode_responses=True)
+    return _redis
+
+
+def cache_key(*parts):
+    cluster = current_cluster().name
+    prefix = ['flynn_updater'] if cluster == DEFAULT_CLUSTER else ['flynn_updater', cluster]
+    return ':'.join(prefix + [str(part) for part in parts])
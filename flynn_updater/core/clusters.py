@@ -0,0 +1,159 @@
+import json
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import wraps
+from django.conf import settings as django_settings
+from django.core.exceptions import ImproperlyConfigured
+
+DEFAULT_CLUSTER = 'default'
+
+# settings a cluster entry in CLUSTERS_CONFIG may override, everything else is shared
+CLUSTER_SETTINGS = (
+    'AWS_DEFAULT_REGION', 'AWS_ROUTE53_ZONE', 'AWS_ROUTE53_DOMAIN', 'AWS_AUTOSCALING_GROUP',
+    'FLYNN_PIN', 'FLYNN_KEY', 'FLYNN_BACKEND', 'FLYNN_DISCOVERY_TOKEN', 'SSH_USER', 'SSH_KEY', 'SSH_PORT',
+    'S3_BLOBSTORE', 'BACKUP_MODE', 'BACKUP_RETENTION', 'BACKUP_KEEP_HOURLY', 'BACKUP_KEEP_DAILY',
+    'BACKUP_KEEP_WEEKLY', 'RDS_DB_ID', 'DB_USER', 'DB_PASSWORD', 'DB_OPTS', 'DB_PORT', 'RDS_ALLOWED_CIDRS',
+    'ELB', 'CLUSTER_PRIVATE', 'CLUSTER_RECONCILE', 'RECONCILE_ACTIONS', 'EVENT_QUEUE_URL',
+    'CLUSTER_MAX_CONCURRENCY',
+)
+
+
+class Cluster(object):
+
+    def __init__(self, name, overrides=None):
+        self.name = name
+        self.overrides = overrides or {}
+
+    @property
+    def home(self):
+        """HOME for the flynn CLI, so every cluster keeps its own ~/.flynnrc. None keeps the worker's."""
+        if not self.overrides:
+            return None
+        return os.path.join(django_settings.CLUSTER_HOME_DIR, self.name)
+
+    def __repr__(self):
+        return '<Cluster %s>' % self.name
+
+
+def load_clusters(path=None):
+    """Read the cluster registry, a JSON object mapping cluster names to setting overrides.
+
+    Without CLUSTERS_CONFIG the worker manages the one cluster described by its own settings.
+    """
+    path = django_settings.CLUSTERS_CONFIG if path is None else path
+    if not path:
+        return OrderedDict([(DEFAULT_CLUSTER, Cluster(DEFAULT_CLUSTER))])
+    with open(path) as config:
+        entries = json.load(config, object_pairs_hook=OrderedDict)
+    clusters = OrderedDict()
+    for name, overrides in entries.items():
+        unknown = set(overrides) - set(CLUSTER_SETTINGS)
+        if unknown:
+            raise ImproperlyConfigured('Cluster %s sets unsupported settings: %s' % (name, ', '.join(sorted(unknown))))
+        clusters[name] = Cluster(name, overrides)
+    if not clusters:
+        raise ImproperlyConfigured('%s does not define any clusters' % path)
+    return clusters
+
+
+_clusters = None
+_clusters_lock = threading.Lock()
+# the active cluster is per thread, a thread pool worker gets it from ClusterThreadPoolExecutor
+_local = threading.local()
+
+
+def _active():
+    return getattr(_local, 'cluster', None)
+
+
+def get_clusters():
+    global _clusters
+    with _clusters_lock:
+        if _clusters is None:
+            _clusters = load_clusters()
+        return _clusters
+
+
+def get_cluster(name=None):
+    clusters = get_clusters()
+    if name is None:
+        return next(iter(clusters.values()))
+    if name not in clusters:
+        raise KeyError('Unknown cluster %s' % name)
+    return clusters[name]
+
+
+def current_cluster():
+    return _active() or get_cluster()
+
+
+@contextmanager
+def _activate(cluster):
+    previous, _local.cluster = _active(), cluster
+    try:
+        yield cluster
+    finally:
+        _local.cluster = previous
+
+
+def use_cluster(name=None):
+    """Point settings at one cluster, in the calling thread, for the duration of a task."""
+    return _activate(get_cluster(name))
+
+
+def bind_cluster(func):
+    """Wrap `func` to run under the cluster active now, whichever thread ends up calling it."""
+    cluster = _active()
+
+    @wraps(func)
+    def bound(*args, **kwargs):
+        with _activate(cluster):
+            return func(*args, **kwargs)
+    return bound
+
+
+class ClusterThreadPoolExecutor(ThreadPoolExecutor):
+    """ThreadPoolExecutor whose calls run under the cluster active where they were submitted.
+
+    Worker threads do not inherit the submitting thread's cluster, and they outlive a single
+    task, so each call carries it instead.
+    """
+
+    def submit(self, fn, *args, **kwargs):
+        return super(ClusterThreadPoolExecutor, self).submit(bind_cluster(fn), *args, **kwargs)
+
+
+class ClusterSettings(object):
+    """Django settings with the active cluster's overrides laid on top."""
+
+    def __getattr__(self, name):
+        cluster = _active()
+        if cluster is not None and name in cluster.overrides:
+            return cluster.overrides[name]
+        return getattr(django_settings, name)
+
+    def __setattr__(self, name, value):
+        setattr(django_settings, name, value)
+
+
+settings = ClusterSettings()
+
+
+class SettingDefault(object):
+    """Class attribute that falls back to a setting when the instance holds no value of its own in `attr`.
+
+    Module-level singletons such as the SSH pool are created on import, before Django is configured,
+    so the setting is read on each use instead of in __init__.
+    """
+
+    def __init__(self, attr, setting):
+        self.attr = attr
+        self.setting = setting
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        return getattr(instance, self.attr) or getattr(settings, self.setting)
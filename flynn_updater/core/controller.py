@@ -0,0 +1,73 @@
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from flynn_updater.core.clusters import settings
+
+
+class ControllerError(Exception):
+    pass
+
+
+class ControllerClient(object):
+    """Flynn controller API client sharing one keep-alive session per process."""
+
+    def __init__(self, domain, key, pool_size=10, timeout=30):
+        self.url = 'https://controller.%s' % domain
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.auth = ('', key)
+        # the controller serves the cluster's self-signed certificate, as in flynn_backup_to_s3
+        self.session.verify = False
+        self.session.headers.update({'Accept': 'application/json'})
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+
+    def _request(self, method, path, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        response = self.session.request(method, self.url + path, **kwargs)
+        if response.status_code >= 400:
+            raise ControllerError('%s %s: %s %s' % (method, path, response.status_code, response.text))
+        if response.content:
+            return response.json()
+        return None
+
+    def get_apps(self):
+        return self._request('GET', '/apps')
+
+    def get_app(self, app):
+        return self._request('GET', '/apps/%s' % app)
+
+    def get_app_releases(self, app):
+        return self._request('GET', '/apps/%s/releases' % app) or []
+
+    def get_app_release(self, app):
+        return self._request('GET', '/apps/%s/release' % app)
+
+    def get_release(self, release_id):
+        return self._request('GET', '/releases/%s' % release_id)
+
+    def create_release(self, release: dict):
+        release = dict(release)
+        release.pop('id', None)
+        release.pop('created_at', None)
+        return self._request('POST', '/releases', json=release)
+
+    def deploy_release(self, app, release_id):
+        return self._request('POST', '/apps/%s/deploy' % app, json={'id': release_id})
+
+    def delete_release(self, app, release_id):
+        return self._request('DELETE', '/apps/%s/releases/%s' % (app, release_id))
+
+
+_clients = {}
+_lock = threading.Lock()
+
+
+def get_controller(domain=None, key=None):
+    domain = domain or settings.AWS_ROUTE53_DOMAIN
+    key = key or settings.FLYNN_KEY
+    with _lock:
+        if (domain, key) not in _clients:
+            _clients[(domain, key)] = ControllerClient(domain, key, pool_size=settings.FLYNN_API_POOL_SIZE,
+                                                       timeout=settings.FLYNN_API_TIMEOUT)
+        return _clients[(domain, key)]
@@ -0,0 +1,198 @@
+import json
+import queue
+from collections import namedtuple, OrderedDict
+from celery import current_app
+from flynn_updater.core.clusters import settings, current_cluster
+from celery.utils.log import get_task_logger
+from flynn_updater.core.cache import get_redis, cache_key
+from flynn_updater.core.utils import sqs, complete_lifecycle_action
+
+logger = get_task_logger(__name__)
+
+ClusterEvent = namedtuple('ClusterEvent', ['kind', 'instance_id', 'asg', 'hook', 'token'])
+
+# tasks to converge after a node joins or leaves the cluster
+EVENT_TASKS = {
+    'launch': ['flynn_dns_update', 'aws_elb_update', 'flynn_update_discoverd_peers'],
+    'terminate': ['flynn_dns_update', 'aws_elb_update', 'flynn_update_discoverd_peers', 'flynn_demote_dead_node'],
+}
+# RDS access is opt-in, only converged on events where the security_group action is enabled
+SECURITY_GROUP_TASK = 'flynn_rds_security_group_update'
+# replaces all of the above when CLUSTER_RECONCILE is on
+RECONCILE_TASK = 'cluster_reconcile'
+EC2_STATES = {'running': 'launch', 'shutting-down': 'terminate', 'terminated': 'terminate', 'stopped': 'terminate'}
+
+
+def parse_event(body):
+    """Turn an ASG lifecycle hook, ASG notification or EC2 state-change message into a ClusterEvent.
+
+    SNS envelopes are unwrapped; anything else returns None.
+    """
+    try:
+        message = json.loads(body)
+        if isinstance(message, dict) and 'TopicArn' in message and 'Message' in message:
+            message = json.loads(message['Message'])
+    except (TypeError, ValueError):
+        return None
+    if not isinstance(message, dict):
+        return None
+    detail = message.get('detail') or {}
+    if 'LifecycleTransition' in message or 'LifecycleTransition' in detail:
+        hook = message if 'LifecycleTransition' in message else detail
+        kind = 'launch' if 'LAUNCHING' in hook['LifecycleTransition'] else 'terminate'
+        return ClusterEvent(kind, hook.get('EC2InstanceId'), hook.get('AutoScalingGroupName'),
+                            hook.get('LifecycleHookName'), hook.get('LifecycleActionToken'))
+    event = message.get('Event', '')
+    if event in ('autoscaling:EC2_INSTANCE_LAUNCH', 'autoscaling:EC2_INSTANCE_TERMINATE'):
+        kind = 'launch' if event.endswith('LAUNCH') else 'terminate'
+        return ClusterEvent(kind, message.get('EC2InstanceId'), message.get('AutoScalingGroupName'), None, None)
+    if message.get('detail-type') in ('EC2 Instance Launch Successful', 'EC2 Instance Terminate Successful'):
+        kind = 'launch' if 'Launch' in message['detail-type'] else 'terminate'
+        return ClusterEvent(kind, detail.get('EC2InstanceId'), detail.get('AutoScalingGroupName'), None, None)
+    if message.get('detail-type') == 'EC2 Instance State-change Notification' and detail.get('state') in EC2_STATES:
+        return ClusterEvent(EC2_STATES[detail['state']], detail.get('instance-id'), None, None, None)
+    return None
+
+
+class SQSEventSource(object):
+
+    def __init__(self, queue_url, wait=10):
+        self.queue_url = queue_url
+        self.wait = wait
+
+    def receive(self):
+        messages = sqs.receive_message(QueueUrl=self.queue_url, MaxNumberOfMessages=10,
+                                       WaitTimeSeconds=self.wait).get('Messages', [])
+        return [(message['ReceiptHandle'], message['Body']) for message in messages]
+
+    def ack(self, handles: list):
+        for i in range(0, len(handles), 10):
+            sqs.delete_message_batch(QueueUrl=self.queue_url, Entries=[
+                {'Id': str(n), 'ReceiptHandle': handle} for n, handle in enumerate(handles[i:i + 10])
+            ])
+
+
+class LocalEventSource(object):
+    """In-process stand-in for SQS, used for local runs and tests."""
+
+    def __init__(self):
+        self.messages = queue.Queue()
+
+    def put(self, body):
+        self.messages.put(body if isinstance(body, str) else json.dumps(body))
+
+    def receive(self):
+        received = []
+        while len(received) < 10:
+            try:
+                received.append((None, self.messages.get_nowait()))
+            except queue.Empty:
+                break
+        return received
+
+    def ack(self, handles: list):
+        pass
+
+
+local_source = LocalEventSource()
+
+
+def get_event_source():
+    if settings.EVENT_QUEUE_URL.startswith('local://'):
+        return local_source
+    return SQSEventSource(settings.EVENT_QUEUE_URL)
+
+
+def dispatch(events: list, debounce=None):
+    """Schedule the tasks the events call for, at most once per task per debounce window.
+
+    The first event in a window schedules the task `debounce` seconds out; later events in the
+    same window are absorbed because that run will see their effect.
+    """
+    debounce = settings.EVENT_DEBOUNCE if debounce is None else debounce
+    tasks = OrderedDict()
+    if settings.CLUSTER_RECONCILE:
+        # like the beat schedule, one reconcile pass converges every action from a single inventory
+        if events:
+            tasks[RECONCILE_TASK] = True
+    else:
+        for event in events:
+            for task in EVENT_TASKS[event.kind]:
+                tasks[task] = True
+        if tasks and 'security_group' in settings.RECONCILE_ACTIONS:
+            tasks[SECURITY_GROUP_TASK] = True
+    scheduled = []
+    for task in tasks:
+        if get_redis().set(cache_key('debounce', task), 1, nx=True, ex=max(1, debounce)):
+            current_app.send_task(task, kwargs={'cluster': current_cluster().name}, countdown=debounce)
+            scheduled.append(task)
+    return scheduled
+
+
+def remember_lifecycle_action(event):
+    """Hold on to a lifecycle hook token until the task converging on its node can complete it."""
+    get_redis().set(cache_key('lifecycle', event.instance_id),
+                    json.dumps({'kind': event.kind, 'asg': event.asg, 'hook': event.hook, 'token': event.token}),
+                    ex=settings.LIFECYCLE_ACTION_TTL)
+
+
+def complete_lifecycle_actions(kind, instance_ids: list):
+    """CONTINUE the held `kind` lifecycle hooks of `instance_ids`, once the cluster has caught up with them.
+
+    Instances without a held hook are skipped, so callers can pass every node they converged.
+    """
+    if not instance_ids:
+        return []
+    keys = [cache_key('lifecycle', instance_id) for instance_id in instance_ids]
+    pipe = get_redis().pipeline()
+    for key in keys:
+        pipe.get(key)
+    completed = []
+    for instance_id, key, held in zip(instance_ids, keys, pipe.execute()):
+        if held is None:
+            continue
+        action = json.loads(held)
+        if action['kind'] != kind:
+            continue
+        try:
+            complete_lifecycle_action(action['asg'], action['hook'], action['token'], instance_id)
+        except Exception as error:
+            # the token stays until it expires, the next converging run retries it
+            logger.error('Lifecycle action for %s not completed: %s' % (instance_id, error))
+            continue
+        get_redis().delete(key)
+        logger.info('Lifecycle action for %s completed' % instance_id)
+        completed.append(instance_id)
+    return completed
+
+
+def ingest_events(source=None, max_batches=10):
+    """Drain the event source and schedule the tasks the events call for.
+
+    Messages are acked only once their tasks are queued, a failed dispatch leaves them on the
+    queue to be redelivered. Lifecycle hooks are completed later by the tasks themselves.
+    """
+    source = source or get_event_source()
+    events, scheduled = [], []
+    for _ in range(max_batches):
+        messages = source.receive()
+        if not messages:
+            break
+        batch = []
+        for handle, body in messages:
+            event = parse_event(body)
+            if event is None:
+                logger.info('Ignoring unrecognised event: %s' % body)
+            elif event.asg and event.asg != settings.AWS_AUTOSCALING_GROUP:
+                logger.info('Ignoring event for %s' % event.asg)
+            else:
+                logger.info('Cluster event: %s %s' % (event.kind, event.instance_id))
+                batch.append(event)
+        for event in batch:
+            if event.token:
+                remember_lifecycle_action(event)
+        if batch:
+            scheduled.extend(task for task in dispatch(batch) if task not in scheduled)
+        source.ack([handle for handle, _ in messages if handle])
+        events.extend(batch)
+    return events, scheduled
@@ -0,0 +1,176 @@
+import threading
+import uuid
+from functools import wraps
+from celery import current_app
+from celery.utils.log import get_task_logger
+from redis import RedisError
+from flynn_updater.core.cache import get_redis, cache_key
+from flynn_updater.core.clusters import settings, use_cluster, current_cluster
+from flynn_updater.core.metrics import TASK_LOCKS
+
+logger = get_task_logger(__name__)
+
+# only the holder's token may extend or drop a lease
+RENEW_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('pexpire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+RELEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+class LeaseLock(object):
+    """Redis lease held by one worker at a time.
+
+    A heartbeat thread extends the lease every third of its ttl while it is held, so a worker
+    that dies mid-task gives the lock up once the lease runs out instead of blocking forever.
+    """
+
+    def __init__(self, name, ttl=None):
+        self.key = cache_key('lock', name)
+        self.ttl = ttl or settings.TASK_LOCK_TTL
+        self.token = None
+        self.lost = False
+        self._stop = threading.Event()
+        self._heartbeat = None
+
+    def acquire(self):
+        token = uuid.uuid4().hex
+        if not get_redis().set(self.key, token, nx=True, px=int(self.ttl * 1000)):
+            return False
+        self.token = token
+        self.lost = False
+        self._stop.clear()
+        self._heartbeat = threading.Thread(target=self._renew, name='lease %s' % self.key, daemon=True)
+        self._heartbeat.start()
+        return True
+
+    def _renew(self):
+        renew = get_redis().register_script(RENEW_SCRIPT)
+        while not self._stop.wait(self.ttl / 3.0):
+            try:
+                if not renew(keys=[self.key], args=[self.token, int(self.ttl * 1000)]):
+                    self.lost = True
+                    logger.error('Lease %s expired before it could be renewed' % self.key)
+                    return
+            except RedisError as e:
+                # keep trying, the lease is still good until it expires
+                logger.warning('Lease %s renewal failed: %s' % (self.key, e))
+
+    def release(self):
+        if self.token is None:
+            return False
+        self._stop.set()
+        self._heartbeat.join()
+        token, self.token = self.token, None
+        try:
+            return bool(get_redis().register_script(RELEASE_SCRIPT)(keys=[self.key], args=[token]))
+        except RedisError as e:
+            logger.warning('Lease %s release failed, it expires on its own: %s' % (self.key, e))
+            return False
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+def single_flight(name, mode='skip', ttl=None):
+    """Run the wrapped task body on at most one worker at a time.
+
+    mode='skip' drops a run that finds the task already running. mode='coalesce' leaves a
+    pending mark instead and the running copy queues exactly one follow-up run when it
+    finishes, however many runs arrived meanwhile.
+    """
+    if mode not in ('skip', 'coalesce'):
+        raise ValueError('Unknown single flight mode %s' % mode)
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            pending = cache_key('lock', name, 'pending')
+            lock = LeaseLock(name, ttl)
+            if not lock.acquire():
+                if mode == 'skip':
+                    TASK_LOCKS.labels(name, 'skipped').inc()
+                    logger.info('%s is already running, skipped' % name)
+                    return None
+                # no expiry: it must outlive a holder that runs past the lease ttl. The next holder
+                # clears it when it starts and again when it finishes, so it cannot go stale.
+                get_redis().set(pending, 1)
+                # the holder may have finished between the failed acquire and the mark
+                if not lock.acquire():
+                    TASK_LOCKS.labels(name, 'coalesced').inc()
+                    logger.info('%s is already running, coalesced into a follow-up run' % name)
+                    return None
+            TASK_LOCKS.labels(name, 'acquired').inc()
+            try:
+                if mode == 'coalesce':
+                    get_redis().delete(pending)
+                return func(*args, **kwargs)
+            finally:
+                if lock.lost:
+                    TASK_LOCKS.labels(name, 'lost').inc()
+                lock.release()
+                if mode == 'coalesce' and get_redis().delete(pending):
+                    current_app.send_task(name, args=args, kwargs=kwargs)
+        return wrapper
+    return decorator
+
+
+def _cluster_slot(name):
+    """Hold one of the active cluster's CLUSTER_MAX_CONCURRENCY slots while the wrapped body runs.
+
+    A run that finds every slot taken is queued again CLUSTER_RETRY_DELAY seconds later, unless
+    an earlier run already queued one that has not started yet.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not settings.CLUSTER_MAX_CONCURRENCY:
+                return func(*args, **kwargs)
+            slots = (LeaseLock('slot:%d' % n) for n in range(settings.CLUSTER_MAX_CONCURRENCY))
+            slot = next((slot for slot in slots if slot.acquire()), None)
+            if slot is not None:
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    slot.release()
+            # expires before the deferred run is due, so that run may defer itself again
+            delay = max(settings.CLUSTER_RETRY_DELAY, 1)
+            if not get_redis().set(cache_key('lock', name, 'deferred'), 1, nx=True, ex=delay):
+                TASK_LOCKS.labels(name, 'dropped').inc()
+                logger.info('%s is busy and %s already has a deferred run, dropped' % (current_cluster().name, name))
+                return None
+            TASK_LOCKS.labels(name, 'deferred').inc()
+            logger.info('%s has %d tasks running, %s deferred'
+                        % (current_cluster().name, settings.CLUSTER_MAX_CONCURRENCY, name))
+            current_app.send_task(name, args=args, kwargs=kwargs, countdown=delay)
+            return None
+        return wrapper
+    return decorator
+
+
+def cluster_task(name, mode='skip'):
+    """Run the wrapped task against the cluster named by its `cluster` argument, see single_flight for `mode`.
+
+    At most CLUSTER_MAX_CONCURRENCY tasks (0 for no limit) run against one cluster at a time, so a
+    few slow clusters cannot take the whole worker pool. The single-flight check comes first, so
+    a run that would be skipped or coalesced never waits for a slot.
+    """
+    def decorator(func):
+        guarded = single_flight(name, mode)(_cluster_slot(name)(func))
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with use_cluster(kwargs.get('cluster')):
+                return guarded(*args, **kwargs)
+        return wrapper
+    return decorator
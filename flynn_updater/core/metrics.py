@@ -0,0 +1,133 @@
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from prometheus_client import Counter, Histogram, CollectorRegistry, REGISTRY, CONTENT_TYPE_LATEST, generate_latest, \
+    multiprocess
+
+TASK_DURATION = Histogram('flynn_updater_task_duration_seconds', 'Celery task run time.', ['task', 'state'],
+                          buckets=(0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600))
+AWS_CALL_DURATION = Histogram('flynn_updater_aws_call_duration_seconds', 'AWS API call latency, retries included.',
+                              ['service', 'operation'])
+AWS_CALLS = Counter('flynn_updater_aws_calls_total', 'AWS API calls.', ['service', 'operation', 'status'])
+AWS_CLIENT_INIT = Histogram('flynn_updater_aws_client_init_seconds', 'Time to build a boto3 client.', ['service'],
+                            buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5))
+AWS_THROTTLES = Counter('flynn_updater_aws_throttles_total', 'Throttled AWS API attempts.', ['service', 'operation'])
+COMMAND_DURATION = Histogram('flynn_updater_command_duration_seconds', 'Local CLI command run time.', ['command'],
+                             buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 600))
+COMMAND_CALLS = Counter('flynn_updater_commands_total', 'Local CLI commands.', ['command', 'status'])
+SSH_DURATION = Histogram('flynn_updater_ssh_command_duration_seconds', 'Remote SSH command run time.', ['host'],
+                         buckets=(0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 600, 1800))
+SSH_CALLS = Counter('flynn_updater_ssh_commands_total', 'Remote SSH commands.', ['host', 'status'])
+TASK_LOCKS = Counter('flynn_updater_task_locks_total', 'Single-flight task lock outcomes.', ['task', 'outcome'])
+
+THROTTLE_CODES = ('Throttling', 'ThrottlingException', 'ThrottledException', 'RequestThrottledException',
+                  'TooManyRequestsException', 'RequestLimitExceeded', 'SlowDown', 'PriorRequestNotComplete')
+# key in botocore's per-request context, which before-call and after-call share
+STARTED = 'flynn_updater_started'
+
+
+def _error_code(parsed):
+    if isinstance(parsed, dict):
+        return (parsed.get('Error') or {}).get('Code')
+    return None
+
+
+def instrument_client(client):
+    """Record latency, outcome and throttling of every call made through a boto3 client."""
+    service = client.meta.service_model.service_name
+
+    def before_call(model, context=None, **kwargs):
+        # kept on the request itself, a call that raises leaves nothing behind
+        if context is not None:
+            context[STARTED] = time.time()
+
+    def after_call(http_response, parsed, model, context=None, **kwargs):
+        started = (context or {}).pop(STARTED, None)
+        if started is not None:
+            AWS_CALL_DURATION.labels(service, model.name).observe(time.time() - started)
+        code = _error_code(parsed)
+        if code in THROTTLE_CODES:
+            status = 'throttled'
+        elif code or http_response.status_code >= 400:
+            status = 'error'
+        else:
+            status = 'ok'
+        AWS_CALLS.labels(service, model.name, status).inc()
+
+    def needs_retry(response=None, operation=None, **kwargs):
+        if response is not None and operation is not None and _error_code(response[1]) in THROTTLE_CODES:
+            AWS_THROTTLES.labels(service, operation.name).inc()
+
+    client.meta.events.register('before-call', before_call)
+    client.meta.events.register('after-call', after_call)
+    client.meta.events.register('needs-retry', needs_retry)
+    return client
+
+
+def command_label(cmd, flynn_path=None):
+    """Label a shell command by its executable and, for the flynn CLI, its subcommand."""
+    tokens = cmd.split() if isinstance(cmd, str) else list(cmd)
+    if not tokens:
+        return ''
+    name = os.path.basename(tokens[0])
+    if flynn_path and tokens[0] == flynn_path:
+        rest = iter(tokens[1:])
+        for token in rest:
+            if token in ('-a', '-c'):
+                next(rest, None)
+            elif not token.startswith('-'):
+                return '%s %s' % (name, token)
+    return name
+
+
+def observe_command(cmd, duration, ok, flynn_path=None):
+    label = command_label(cmd, flynn_path)
+    COMMAND_DURATION.labels(label).observe(duration)
+    COMMAND_CALLS.labels(label, 'ok' if ok else 'error').inc()
+
+
+def observe_ssh(host, duration, ok):
+    SSH_DURATION.labels(host).observe(duration)
+    SSH_CALLS.labels(host, 'ok' if ok else 'error').inc()
+
+
+def get_registry():
+    if 'prometheus_multiproc_dir' in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return registry
+    return REGISTRY
+
+
+def render():
+    return generate_latest(get_registry())
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        output = render()
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE_LATEST)
+        self.end_headers()
+        self.wfile.write(output)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port, addr=''):
+    """Serve the metrics over HTTP from a daemon thread.
+
+    prometheus_client's start_http_server only reads this process's registry. Run from the
+    worker's main process with prometheus_multiproc_dir set, this serves every pool child.
+    """
+    server = HTTPServer((addr, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    return server
+
+
+def mark_process_dead(pid):
+    if 'prometheus_multiproc_dir' in os.environ:
+        multiprocess.mark_process_dead(pid)
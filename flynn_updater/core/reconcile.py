@@ -0,0 +1,263 @@
+import hashlib
+import json
+import time
+import random
+from collections import namedtuple
+from flynn_updater.core.clusters import settings, ClusterThreadPoolExecutor
+from celery.utils.log import get_task_logger
+from flynn_updater.core.cache import get_redis, cache_key
+from flynn_updater.core.utils import get_inventory, dns_reconcile, sync_elb_instances, get_rds_security_group, \
+    reconcile_security_group, InstanceRecord
+from flynn_updater.core.shell import flynn_cli_init, use_api, get_app_release_json, update_app_release, \
+    get_app_current_release
+from flynn_updater.core.ssh import run_on_host
+from flynn_updater.core.events import complete_lifecycle_actions
+
+logger = get_task_logger(__name__)
+
+PlanAction = namedtuple('PlanAction', ['name', 'func', 'args'])
+ActionOutcome = namedtuple('ActionOutcome', ['name', 'ok', 'result', 'error', 'duration'])
+DemotionResult = namedtuple('DemotionResult', ['instance_id', 'private_ip', 'peer', 'attempts', 'ok', 'error'])
+DiscoverdPeersResult = namedtuple('DiscoverdPeersResult', ['changed', 'peers', 'added', 'removed', 'release', 'reason'])
+
+ACTIONS = ('dns', 'elb', 'discoverd', 'security_group', 'demote')
+DISCOVERD_PORT = 1111
+
+
+def reconcile_dns(addrs: list):
+    result = dns_reconcile(zone_id=settings.AWS_ROUTE53_ZONE, domain=settings.AWS_ROUTE53_DOMAIN, addrs=addrs)
+    if result.changed:
+        logger.info('DNS update: %s (%s) with record %s' % (settings.AWS_ROUTE53_DOMAIN, settings.AWS_ROUTE53_ZONE, result.records))
+    else:
+        logger.info('DNS unchanged (%s): %s (%s) with record %s' % (result.reason, settings.AWS_ROUTE53_DOMAIN, settings.AWS_ROUTE53_ZONE, result.records))
+    return result
+
+
+def reconcile_elb(elbs: list, instances: list, departed: list):
+    results = sync_elb_instances(elbs, instances, departed)
+    for result in results:
+        if result.error:
+            logger.error('ELB %s update failed: %s' % (result.elb, result.error))
+        elif result.registered or result.deregistered:
+            logger.info('Update ELB %s: registered %s, deregistered %s' % (result.elb, result.registered, result.deregistered))
+        else:
+            logger.info('ELB %s already in sync with instances %s' % (result.elb, instances))
+    return results
+
+
+def parse_peers(value):
+    return set(peer.rsplit(':', 1)[0] for peer in (value or '').split(',') if peer.strip())
+
+
+def peers_fingerprint(addrs):
+    return hashlib.sha1(','.join(sorted(set(addrs))).encode('utf-8')).hexdigest()
+
+
+def reconcile_discoverd(addrs: list):
+    """Make DISCOVERD_PEERS list exactly the running nodes, adding joined and dropping departed ones.
+
+    The peer set and release last seen in sync are cached for DISCOVERD_CACHE_TTL seconds. While
+    the nodes stay the same, a tick on the API backend only compares the current release id with
+    the cached one, which also catches a release deployed out of band. On the CLI backend that
+    lookup is a process spawn, so the cache is trusted until it expires.
+    """
+    desired = set(addrs)
+    fingerprint = peers_fingerprint(desired)
+    key = cache_key('discoverd', 'peers')
+    cached = json.loads(get_redis().get(key) or '{}')
+    if cached.get('peers') == fingerprint and cached.get('release') \
+            and (not use_api() or cached['release'] == get_app_current_release('discoverd')):
+        return DiscoverdPeersResult(changed=False, peers=sorted(desired), added=[], removed=[],
+                                    release=cached['release'], reason='cached')
+    if not use_api():
+        flynn_cli_init()
+
+    discoverd = get_app_release_json('discoverd')
+    current = parse_peers(discoverd['env'].get('DISCOVERD_PEERS'))
+    added, removed = sorted(desired - current), sorted(current - desired)
+    release = discoverd.get('id')
+    if added or removed:
+        for addr in added:
+            logger.info('discoverd found new node: %s' % addr)
+        for addr in removed:
+            logger.info('discoverd lost node: %s' % addr)
+        discoverd['env']['DISCOVERD_PEERS'] = ','.join('%s:%d' % (addr, DISCOVERD_PORT) for addr in sorted(desired))
+        created = update_app_release('discoverd', discoverd)
+        # the CLI does not hand back the new release, look its id up
+        release = created['id'] if isinstance(created, dict) else get_app_current_release('discoverd')
+        logger.info('discoverd updated with %s' % discoverd['env']['DISCOVERD_PEERS'])
+    get_redis().set(key, json.dumps({'peers': fingerprint, 'release': release}), ex=settings.DISCOVERD_CACHE_TTL)
+    return DiscoverdPeersResult(changed=bool(added or removed), peers=sorted(desired), added=added, removed=removed,
+                                release=release, reason='updated' if added or removed else 'in-sync')
+
+
+def reconcile_rds_access(addrs: list):
+    rds_security_group = get_rds_security_group(settings.RDS_DB_ID)
+    result = reconcile_security_group(rds_security_group, addrs, int(settings.DB_PORT), keep_cidrs=settings.RDS_ALLOWED_CIDRS)
+    for cidr in result.revoked:
+        logger.info('Removed dead node (%s) RDS access.' % cidr)
+    for cidr in result.authorized:
+        logger.info('Added new node (%s) RDS access.' % cidr)
+    return result
+
+
+def remember_private_addrs(inventory):
+    """Record the private IP of every running node and return all recorded ones by instance id.
+
+    A terminated instance no longer reports its private IP, this is where the demotion finds it.
+    """
+    key = cache_key('nodes', 'private-ip')
+    known = get_redis().hgetall(key) or {}
+    seen = {record.instance_id: record.private_ip for record in inventory.by_state('running') if record.private_ip}
+    changed = {instance_id: ip for instance_id, ip in seen.items() if known.get(instance_id) != ip}
+    if changed:
+        get_redis().hmset(key, changed)
+        known.update(changed)
+    return known
+
+
+def forget_private_addrs(instance_ids: list):
+    if instance_ids:
+        get_redis().hdel(cache_key('nodes', 'private-ip'), *instance_ids)
+
+
+def _demote(instance, peers: list):
+    """Demote one dead node, moving on to the next peer after each failed attempt.
+
+    The ledger key is claimed before the first attempt, so a node is demoted once even when two
+    runs overlap, and released again if every attempt fails so the next run retries it.
+    """
+    key = cache_key('demoted', instance.instance_id)
+    claim = json.dumps({'state': 'demoting', 'private_ip': instance.private_ip})
+    if not get_redis().set(key, claim, nx=True, ex=settings.DEMOTE_TIMEOUT * settings.DEMOTE_ATTEMPTS):
+        return None
+    logger.info('Dead node detected: %s' % instance.instance_id)
+    error = None
+    for attempt in range(settings.DEMOTE_ATTEMPTS):
+        peer = peers[attempt % len(peers)]
+        result = run_on_host(peer, 'sudo flynn-host demote --force %s' % instance.private_ip,
+                             timeout=settings.DEMOTE_TIMEOUT)
+        if result.error is None and result.exit_status == 0:
+            get_redis().set(key, json.dumps({'state': 'demoted', 'private_ip': instance.private_ip, 'peer': peer,
+                                             'demoted_at': time.time()}), ex=settings.DEMOTION_LEDGER_TTL)
+            logger.info('Dead node removed: %s (via %s)' % (instance.instance_id, peer))
+            return DemotionResult(instance.instance_id, instance.private_ip, peer, attempt + 1, True, None)
+        error = result.error or ' '.join(result.stderr).strip() or 'exit status %s' % result.exit_status
+        logger.warning('Demoting %s via %s failed (attempt %d): %s' % (instance.instance_id, peer, attempt + 1, error))
+    get_redis().delete(key)
+    logger.error('Dead node %s not removed after %d attempts: %s' % (instance.instance_id, settings.DEMOTE_ATTEMPTS, error))
+    return DemotionResult(instance.instance_id, instance.private_ip, None, settings.DEMOTE_ATTEMPTS, False, error)
+
+
+def demote_dead_nodes(dead_instances: list, addrs: list):
+    """Demote dead nodes not yet in the ledger, in parallel and spread over the healthy peers.
+
+    Terminate lifecycle hooks held for these nodes are completed once they are out of the cluster.
+    """
+    pipe = get_redis().pipeline()
+    for instance in dead_instances:
+        pipe.get(cache_key('demoted', instance.instance_id))
+    entries = pipe.execute()
+    pending = [instance for instance, entry in zip(dead_instances, entries) if entry is None]
+    demoted = [instance.instance_id for instance, entry in zip(dead_instances, entries)
+               if entry is not None and json.loads(entry).get('state') == 'demoted']
+    results = []
+    if pending:
+        peers = list(addrs)
+        random.shuffle(peers)
+        with ClusterThreadPoolExecutor(max_workers=min(len(pending), settings.DEMOTE_WORKERS)) as executor:
+            # each node starts on a different peer and falls back to the ones after it
+            futures = [executor.submit(_demote, instance, peers[n % len(peers):] + peers[:n % len(peers)])
+                       for n, instance in enumerate(pending)]
+            results = [result for result in (future.result() for future in futures) if result is not None]
+    demoted += [result.instance_id for result in results if result.ok]
+    forget_private_addrs(demoted)
+    complete_lifecycle_actions('terminate', demoted)
+    return results
+
+
+def build_plan(inventory, actions=None, known_addrs=None):
+    """Work out every reconcile action from one inventory snapshot.
+
+    Actions that would act on an empty node list are left out so an API hiccup
+    cannot strip DNS, ELBs or security groups of every node. `known_addrs` maps instance
+    ids to the private IPs they had while running; terminated nodes and nodes gone from
+    the ASG are demoted by that address.
+    """
+    known_addrs = known_addrs or {}
+    actions = actions or settings.RECONCILE_ACTIONS
+    private_addrs = inventory.private_addrs()
+    public_addrs = inventory.public_addrs()
+    dns_addrs = inventory.addrs(private=settings.CLUSTER_PRIVATE)
+    plan = []
+    if 'dns' in actions and dns_addrs:
+        plan.append(PlanAction('dns', reconcile_dns, (dns_addrs,)))
+    if 'elb' in actions and settings.ELB and inventory.instance_ids():
+        plan.append(PlanAction('elb', reconcile_elb,
+                               (settings.ELB.split(','), inventory.instance_ids(), inventory.departed_ids())))
+    if 'discoverd' in actions and private_addrs:
+        plan.append(PlanAction('discoverd', reconcile_discoverd, (private_addrs,)))
+    if 'security_group' in actions and public_addrs:
+        plan.append(PlanAction('security_group', reconcile_rds_access, (public_addrs,)))
+    # nodes held in Terminating:Wait are demoted while they can still be reached
+    dead_instances = inventory.leaving()
+    for record in inventory.by_state('terminated'):
+        private_ip = record.private_ip or known_addrs.get(record.instance_id)
+        if private_ip:
+            dead_instances.append(record._replace(private_ip=private_ip))
+    dead_instances += [InstanceRecord(instance_id, 'terminated', private_ip, None, None)
+                       for instance_id, private_ip in sorted(known_addrs.items())
+                       if inventory.get(instance_id) is None]
+    if 'demote' in actions and dead_instances and private_addrs:
+        plan.append(PlanAction('demote', demote_dead_nodes, (dead_instances, private_addrs)))
+    return plan
+
+
+def _run_action(action):
+    start = time.time()
+    try:
+        return ActionOutcome(action.name, True, action.func(*action.args), None, time.time() - start)
+    except Exception as error:
+        logger.error('Reconcile %s failed: %s' % (action.name, error))
+        return ActionOutcome(action.name, False, None, str(error), time.time() - start)
+
+
+def _serialize(value):
+    if hasattr(value, '_asdict'):
+        return {k: _serialize(v) for k, v in value._asdict().items()}
+    if isinstance(value, (list, tuple)):
+        return [_serialize(v) for v in value]
+    return value
+
+
+def record_outcomes(outcomes: list):
+    """Store the latest outcome of each action under flynn_updater:reconcile:<action>."""
+    now = time.time()
+    pipe = get_redis().pipeline()
+    for outcome in outcomes:
+        pipe.set(cache_key('reconcile', outcome.name),
+                 json.dumps(dict(_serialize(outcome), timestamp=now), default=str))
+    pipe.execute()
+
+
+def execute_plan(plan: list, max_workers=None):
+    """Run independent plan actions concurrently and record their outcomes."""
+    if not plan:
+        return []
+    with ClusterThreadPoolExecutor(max_workers=min(len(plan), max_workers or len(ACTIONS))) as executor:
+        outcomes = list(executor.map(_run_action, plan))
+    record_outcomes(outcomes)
+    return outcomes
+
+
+def reconcile(actions=None):
+    inventory = get_inventory()
+    plan = build_plan(inventory, actions, remember_private_addrs(inventory))
+    if actions and len(plan) < len(actions):
+        skipped = set(actions) - set(action.name for action in plan)
+        logger.info('Reconcile skipped %s: nothing to act on' % sorted(skipped))
+    outcomes = execute_plan(plan)
+    # a launching node may go into service once discoverd lists it as a peer
+    if any(outcome.name == 'discoverd' and outcome.ok for outcome in outcomes):
+        complete_lifecycle_actions('launch', inventory.instance_ids())
+    return outcomes
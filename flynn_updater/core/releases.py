@@ -0,0 +1,68 @@
+import time
+from collections import namedtuple, OrderedDict
+from flynn_updater.core.clusters import settings, ClusterThreadPoolExecutor
+from celery.utils.log import logger
+from flynn_updater.core.shell import get_app_release, get_app_current_release, delete_app_release
+
+ReleaseGCReport = namedtuple('ReleaseGCReport', ['app', 'releases', 'kept', 'deleted', 'failed', 'duration'])
+
+
+def select_stale_releases(releases: list, current, keep=0):
+    """Return the releases to delete, keeping the current one and the `keep` newest others.
+
+    Releases are expected newest first, as listed by the controller and `flynn release -q`.
+    """
+    others = [release for release in releases if release and release != current]
+    return others[keep:]
+
+
+def _collect(app):
+    start = time.time()
+    try:
+        return app, get_app_release(app), get_app_current_release(app), time.time() - start, None
+    except Exception as error:
+        return app, [], None, time.time() - start, error
+
+
+def _delete(app, release):
+    start = time.time()
+    try:
+        delete_app_release(app, release)
+        return app, release, time.time() - start, None
+    except Exception as error:
+        return app, release, time.time() - start, error
+
+
+def gc_releases(apps: list, keep=None, max_workers=None):
+    """Delete stale releases of every app and return one ReleaseGCReport per app.
+
+    Release lists and current releases for all apps are fetched in one concurrent pass,
+    then deletions run through a bounded worker pool.
+    """
+    keep = settings.RELEASE_GC_KEEP if keep is None else keep
+    max_workers = max_workers or settings.RELEASE_GC_WORKERS
+    stats = OrderedDict()
+    with ClusterThreadPoolExecutor(max_workers=max_workers) as executor:
+        deletions = []
+        for app, releases, current, duration, error in executor.map(_collect, apps):
+            if error is not None or not current:
+                logger.error('Release GC skipped %s: %s' % (app, error or 'no current release'))
+                continue
+            stale = select_stale_releases(releases, current, keep)
+            stats[app] = {'releases': len([r for r in releases if r]), 'stale': len(stale),
+                          'deleted': 0, 'failed': 0, 'duration': duration}
+            deletions.extend(executor.submit(_delete, app, release) for release in stale)
+
+        for future in deletions:
+            app, release, duration, error = future.result()
+            stats[app]['duration'] += duration
+            if error is None:
+                stats[app]['deleted'] += 1
+                logger.info('Release deleted: %s (%s)' % (app, release))
+            else:
+                stats[app]['failed'] += 1
+                logger.error('Release delete failed: %s (%s): %s' % (app, release, error))
+
+    return [ReleaseGCReport(app=app, releases=s['releases'], kept=s['releases'] - s['stale'],
+                            deleted=s['deleted'], failed=s['failed'], duration=s['duration'])
+            for app, s in stats.items()]
@@ -1,74 +1,275 @@
+import os
+import signal
 import subprocess
 import json
-from django.conf import settings
+import tempfile
+import threading
+import time
+from collections import namedtuple
+from flynn_updater.core.clusters import settings, current_cluster, ClusterThreadPoolExecutor, SettingDefault
 from celery.utils.log import logger
+from flynn_updater.core.controller import get_controller
+from flynn_updater.core.metrics import observe_command
 
+BatchDeleteResult = namedtuple('BatchDeleteResult', ['deleted', 'batches', 'duration', 'error'])
+AppRecord = namedtuple('AppRecord', ['id', 'name', 'meta'])
+CommandResult = namedtuple('CommandResult', ['cmd', 'returncode', 'stdout', 'stderr', 'duration', 'timed_out'])
+# seconds to collect the output of a killed command
+KILL_GRACE = 5
 
-def execute(cmd, shell=True):
-    run = None
+
+def use_api():
+    return settings.FLYNN_BACKEND == 'api'
+
+
+def cli_env():
+    """Environment for local commands; clusters from CLUSTERS_CONFIG get their own flynn CLI config."""
+    home = current_cluster().home
+    return None if home is None else dict(os.environ, HOME=home)
+
+
+def run(cmd, shell=True, timeout=None, input=None):
+    """Run a command, draining stdout and stderr together, and kill its process group on timeout."""
+    timeout = timeout or settings.COMMAND_TIMEOUT
+    start = time.time()
+    process = subprocess.Popen(cmd, shell=shell, stdin=subprocess.PIPE if input is not None else None,
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True,
+                               start_new_session=True, env=cli_env())
+    timed_out = False
     try:
-        run = subprocess.Popen(cmd, shell=shell, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
-        output = run.stdout.read().rstrip().split("\n")
-    except subprocess.CalledProcessError:
-        error = run.stderr.read().rstrip().split("\n")
-        logger.error(error)
-        return error
-    return output
+        stdout, stderr = process.communicate(input=input, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        timed_out = True
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            # the whole group exited between the timeout and the kill
+            pass
+        try:
+            stdout, stderr = process.communicate(timeout=KILL_GRACE)
+        except subprocess.TimeoutExpired:
+            # a descendant that left the process group still holds the pipes, stop waiting for them
+            for pipe in (process.stdout, process.stderr, process.stdin):
+                if pipe is not None:
+                    pipe.close()
+            process.wait()
+            stdout, stderr = '', ''
+    observe_command(cmd, time.time() - start, process.returncode == 0 and not timed_out, settings.FLYNN_PATH)
+    return CommandResult(cmd=cmd, returncode=process.returncode, stdout=stdout.rstrip().split("\n"),
+                         stderr=stderr.rstrip().split("\n"), duration=time.time() - start, timed_out=timed_out)
+
+
+def run_many(cmds: list, shell=True, timeout=None, max_workers=None):
+    """Run commands concurrently and return their CommandResults in order."""
+    if not cmds:
+        return []
+    with ClusterThreadPoolExecutor(max_workers=min(len(cmds), max_workers or settings.COMMAND_MAX_WORKERS)) as executor:
+        futures = [executor.submit(run, cmd, shell, timeout) for cmd in cmds]
+        return [future.result() for future in futures]
+
+
+def execute(cmd, shell=True, timeout=None):
+    result = run(cmd, shell=shell, timeout=timeout)
+    if result.timed_out:
+        logger.error('Command timed out after %.0fs: %s' % (result.duration, cmd))
+    elif result.returncode != 0:
+        logger.error(result.stderr)
+    return result.stdout
 
 
 def flynn_cli_init():
+    home = current_cluster().home
     if not execute('ls %s' % settings.FLYNN_PATH)[0]:
         execute(settings.FLYNN_CLI_INSTALL)
-        execute(settings.FLYNN_CLI_SETUP)
+        if home is None:
+            execute(settings.FLYNN_CLI_SETUP)
+    if home is not None and not os.path.exists(os.path.join(home, '.flynnrc')):
+        # .flynnrc holds the cluster's FLYNN_KEY
+        os.makedirs(home, mode=0o700, exist_ok=True)
+        os.chmod(home, 0o700)
+        execute('%s cluster add -p %s default %s %s'
+                % (settings.FLYNN_PATH, settings.FLYNN_PIN, settings.AWS_ROUTE53_DOMAIN, settings.FLYNN_KEY))
 
 
 def flynn_cli_update():
     return execute('%s update' % settings.FLYNN_PATH)
 
 
+def batched_delete(app, table, where, batch_size=None, timeout=None):
+    """Delete matching rows from an app's database in LIMIT-sized batches.
+
+    Each batch is its own non-interactive `psql -c` call, so locks and WAL stay bounded and
+    nothing waits on a session's pipes; it stops at the first batch smaller than batch_size.
+    """
+    batch_size = batch_size or settings.DB_DELETE_BATCH_SIZE
+    statement = ('WITH deleted AS (DELETE FROM %s WHERE ctid = ANY(ARRAY(SELECT ctid FROM %s WHERE %s LIMIT %d)) '
+                 'RETURNING 1) SELECT count(*) FROM deleted;' % (table, table, where, batch_size))
+    cmd = [settings.FLYNN_PATH, '-a', app, 'pg', 'psql', '--', '-X', '-q', '-t', '-A', '-v', 'ON_ERROR_STOP=1',
+           '-c', statement]
+    start = time.time()
+    deleted, batches, error = 0, 0, None
+    while True:
+        result = run(cmd, shell=False, timeout=timeout)
+        if result.timed_out or result.returncode != 0:
+            error = 'batch %d failed: %s' % (batches + 1, 'timed out' if result.timed_out else
+                                             ' '.join(result.stderr).strip() or 'exit status %s' % result.returncode)
+            break
+        try:
+            count = int(result.stdout[-1].strip())
+        except (IndexError, ValueError):
+            error = 'batch %d returned %r' % (batches + 1, '\n'.join(result.stdout))
+            break
+        batches += 1
+        deleted += count
+        if count < batch_size:
+            break
+    return BatchDeleteResult(deleted=deleted, batches=batches, duration=time.time() - start, error=error)
+
+
+def cleanup_job_cache(app_ids: list, days=7):
+    ids = ', '.join("'%s'" % app_id.replace("'", "''") for app_id in app_ids if app_id)
+    if not ids:
+        return BatchDeleteResult(deleted=0, batches=0, duration=0, error=None)
+    where = "app_id IN (%s) AND state != 'up' AND created_at < now() - interval '%d days'" % (ids, days)
+    return batched_delete('controller', 'job_cache', where)
+
+
+class AppCatalog(object):
+    """App names, IDs and metadata fetched in one pass per cluster and reused for `ttl` seconds.
+
+    The cache lives in process memory, so each prefork child keeps its own copy and fetches it
+    on its first use.
+    """
+
+    ttl = SettingDefault('_ttl', 'APP_CATALOG_TTL')
+
+    def __init__(self, ttl=None):
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        # cluster name -> (fetched at, apps by name)
+        self._apps = {}
+
+    @staticmethod
+    def _fetch():
+        if use_api():
+            return [AppRecord(app['id'], app['name'], app.get('meta') or {}) for app in get_controller().get_apps()]
+        rows = [line.split() for line in execute('%s apps' % settings.FLYNN_PATH)[1:] if line.strip()]
+        metas = run_many(['%s -a %s meta' % (settings.FLYNN_PATH, row[1]) for row in rows])
+        apps = []
+        for row, meta in zip(rows, metas):
+            pairs = [line.split(None, 1) for line in meta.stdout[1:] if line.strip()]
+            apps.append(AppRecord(row[0], row[1], {pair[0]: pair[1].strip() for pair in pairs if len(pair) == 2}))
+        return apps
+
+    def _load(self):
+        cluster = current_cluster().name
+        with self._lock:
+            fetched_at, apps = self._apps.get(cluster, (0, None))
+            if apps is None or time.time() - fetched_at > self.ttl:
+                apps = {app.name: app for app in self._fetch()}
+                self._apps[cluster] = (time.time(), apps)
+            return apps
+
+    def apps(self):
+        return list(self._load().values())
+
+    def get(self, name):
+        return self._load().get(name)
+
+    def invalidate(self):
+        with self._lock:
+            self._apps = {}
+
+
+app_catalog = AppCatalog()
+
+
 def get_apps():
-    return execute('%s apps | grep -v NAME | awk \'{print $2}\'' % settings.FLYNN_PATH)
+    return [app.name for app in app_catalog.apps()]
 
 
 def get_app_id(app):
-    return execute('%s apps | grep %s | awk \'{print $1}\'' % (settings.FLYNN_PATH, app))[0]
+    record = app_catalog.get(app)
+    return record.id if record else None
 
 
 def get_non_system_apps():
-    apps = []
-    for app in get_apps():
-        if not int(execute('%s -a %s meta | grep flynn-system-app | grep -c true' % (settings.FLYNN_PATH, app))[0]):
-            apps.append(app)
-    return apps
+    return [app.name for app in app_catalog.apps() if app.meta.get('flynn-system-app') != 'true']
 
 
 def get_app_release(app):
+    if use_api():
+        return [release['id'] for release in get_controller().get_app_releases(app)]
     return execute('%s -a %s release -q' % (settings.FLYNN_PATH, app))
 
 
 def get_app_current_release(app):
+    if use_api():
+        # the app record carries its release id, no need to fetch the release itself
+        controller = get_controller()
+        return controller.get_app(app).get('release_id') or controller.get_app_release(app)['id']
     return json.loads(execute('%s -a %s release show --json' % (settings.FLYNN_PATH, app))[0])['id']
 
 
 def delete_app_release(app, release):
-    return execute('%s -a %s release delete -y %s' % (settings.FLYNN_PATH, app, release))
+    if use_api():
+        return get_controller().delete_release(app, release)
+    result = run([settings.FLYNN_PATH, '-a', app, 'release', 'delete', '-y', release], shell=False)
+    if result.timed_out or result.returncode != 0:
+        raise RuntimeError('Deleting the %s release %s failed: %s' % (
+            app, release, 'timed out' if result.timed_out else
+            ' '.join(result.stderr).strip() or 'exit status %s' % result.returncode))
+    return result.stdout
 
 
 def get_app_env(app):
+    if use_api():
+        env = get_controller().get_app_release(app).get('env') or {}
+        return ['%s=%s' % (k, v) for k, v in sorted(env.items())]
     return execute('%s -a %s env' % (settings.FLYNN_PATH, app))
 
 
 def get_app_release_json(app, id=''):
+    if use_api():
+        if id:
+            return get_controller().get_release(id)
+        return get_controller().get_app_release(app)
     return json.loads(execute('%s -a %s release show --json %s' % (settings.FLYNN_PATH, app, id))[0])
 
 
+def deploy_app_release(app, release: dict):
+    controller = get_controller()
+    created = controller.create_release(release)
+    controller.deploy_release(app, created['id'])
+    return created
+
+
 def update_app_release(app, release: json, id='', clean=False):
-    file_path = '/tmp/%s-release.json' % app
-    file_cmd = 'echo \'%s\' > %s' % (json.dumps(release), file_path)
-    execute(file_cmd)
-    return execute('%s -a %s release update %s %s' % (settings.FLYNN_PATH, app, file_path, id))
+    if use_api():
+        if id:
+            release = dict(get_controller().get_release(id), **release)
+        return deploy_app_release(app, release)
+    with tempfile.NamedTemporaryFile('w', prefix='%s-release-' % app, suffix='.json') as release_file:
+        json.dump(release, release_file)
+        release_file.flush()
+        result = run([settings.FLYNN_PATH, '-a', app, 'release', 'update', release_file.name] + ([id] if id else []),
+                     shell=False)
+    if result.timed_out or result.returncode != 0:
+        raise RuntimeError('Updating the %s release failed: %s'
+                           % (app, ' '.join(result.stderr).strip() or 'exit status %s' % result.returncode))
+    return result.stdout
 
 
 def set_app_env(app, envs: list):
+    if use_api():
+        release = get_controller().get_app_release(app)
+        env = dict(release.get('env') or {})
+        for envar in envs:
+            name, value = envar.split('=', 1)
+            env[name] = value.strip('"\'')
+        if env == release.get('env'):
+            return release
+        release['env'] = env
+        return deploy_app_release(app, release)
     envars = ' \\'.join(envs)
     return execute('%s -a %s env set %s' % (settings.FLYNN_PATH, app, envars))
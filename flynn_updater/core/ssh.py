@@ -1,27 +1,268 @@
 import paramiko
 import io
+import select
+import socket
+import threading
+import time
+from collections import namedtuple
+from flynn_updater.core.clusters import settings, ClusterThreadPoolExecutor, SettingDefault
 from celery.utils.log import logger
+from flynn_updater.core.metrics import observe_ssh
 
-ssh = paramiko.SSHClient()
-ssh.load_system_host_keys()
-ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+HostResult = namedtuple('HostResult', ['host', 'exit_status', 'stdout', 'stderr', 'duration', 'error'])
+
+
+class SSHPool(object):
+    """Thread-safe pool of authenticated SSH clients keyed by (host, port, user, key).
+
+    Clusters may share node addresses, for example in overlapping private networks, so a
+    client is only reused for the exact credentials and port it was opened with.
+    """
+
+    idle_timeout = SettingDefault('_idle_timeout', 'SSH_IDLE_TIMEOUT')
+
+    def __init__(self, idle_timeout=None):
+        self._idle_timeout = idle_timeout
+        self._lock = threading.Lock()
+        self._clients = {}
+        self._host_locks = {}
+        self._keys = {}
+
+    def _load_key(self, key):
+        with self._lock:
+            if key not in self._keys:
+                self._keys[key] = paramiko.RSAKey.from_private_key(io.StringIO(key))
+            return self._keys[key]
+
+    def _host_lock(self, pool_key):
+        with self._lock:
+            return self._host_locks.setdefault(pool_key, threading.Lock())
+
+    @staticmethod
+    def _is_healthy(client):
+        transport = client.get_transport()
+        if transport is None or not transport.is_active():
+            return False
+        try:
+            transport.send_ignore()
+        except Exception:
+            return False
+        return True
+
+    def get(self, host, user, key, port=None):
+        port = port or settings.SSH_PORT
+        pool_key = (host, port, user, key)
+        self.evict_idle()
+        with self._host_lock(pool_key):
+            with self._lock:
+                entry = self._clients.get(pool_key)
+            if entry is not None and self._is_healthy(entry[0]):
+                with self._lock:
+                    entry[1] = time.time()
+                    entry[2] += 1
+                return entry[0]
+            if entry is not None:
+                self._discard(pool_key)
+            client = paramiko.SSHClient()
+            client.load_system_host_keys()
+            client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+            client.connect(host, port=port, username=user, pkey=self._load_key(key),
+                           timeout=settings.SSH_CONNECT_TIMEOUT)
+            client.get_transport().set_keepalive(settings.SSH_KEEPALIVE)
+            with self._lock:
+                # [client, last used, leases held]
+                self._clients[pool_key] = [client, time.time(), 1]
+            return client
+
+    def release(self, client):
+        with self._lock:
+            for entry in self._clients.values():
+                if entry[0] is client:
+                    entry[1] = time.time()
+                    entry[2] = max(0, entry[2] - 1)
+
+    def _discard(self, pool_key):
+        with self._lock:
+            entry = self._clients.pop(pool_key, None)
+        if entry is not None:
+            entry[0].close()
+
+    def discard_client(self, client):
+        with self._lock:
+            stale = [pool_key for pool_key, entry in self._clients.items() if entry[0] is client]
+        for pool_key in stale:
+            self._discard(pool_key)
+
+    def evict_idle(self):
+        now = time.time()
+        with self._lock:
+            idle = [pool_key for pool_key, entry in self._clients.items()
+                    if not entry[2] and now - entry[1] > self.idle_timeout]
+            evicted = [self._clients.pop(pool_key) for pool_key in idle]
+        for entry in evicted:
+            entry[0].close()
+
+    def close_all(self):
+        with self._lock:
+            entries = list(self._clients.values())
+            self._clients.clear()
+        for entry in entries:
+            entry[0].close()
+
+
+class SSHStream(object):
+    """Iterate over ('stdout' | 'stderr', line) pairs as a remote command produces them.
+
+    Both channels are drained together so a chatty stderr cannot stall stdout, and nothing
+    is buffered beyond the current partial line. exit_status is set once iteration ends.
+    """
+
+    def __init__(self, client, command, timeout=None, bufsize=32768):
+        self.command = command
+        self.timeout = timeout
+        self.bufsize = bufsize
+        self.exit_status = None
+        self.host = client.get_transport().getpeername()[0]
+        self.started = time.time()
+        self.channel = client.get_transport().open_session()
+        self.channel.exec_command(command)
+
+    def _split(self, name, pending, data):
+        pending[name] += data
+        *lines, pending[name] = pending[name].split(b'\n')
+        return [(name, line.decode('utf-8', 'replace').rstrip('\r')) for line in lines]
+
+    def __iter__(self):
+        channel = self.channel
+        deadline = time.time() + self.timeout if self.timeout else None
+        pending = {'stdout': b'', 'stderr': b''}
+        try:
+            while True:
+                # checked every pass, a command that never stops writing must still time out
+                if deadline is not None and time.time() > deadline:
+                    raise socket.timeout('%s timed out after %ss' % (self.command, self.timeout))
+                received = False
+                if channel.recv_ready():
+                    received = True
+                    yield from self._split('stdout', pending, channel.recv(self.bufsize))
+                if channel.recv_stderr_ready():
+                    received = True
+                    yield from self._split('stderr', pending, channel.recv_stderr(self.bufsize))
+                if received:
+                    continue
+                if channel.exit_status_ready():
+                    break
+                select.select([channel], [], [], 0.1)
+            # data that raced the exit status is already buffered locally
+            while channel.recv_ready():
+                yield from self._split('stdout', pending, channel.recv(self.bufsize))
+            while channel.recv_stderr_ready():
+                yield from self._split('stderr', pending, channel.recv_stderr(self.bufsize))
+            for name in ('stdout', 'stderr'):
+                if pending[name]:
+                    yield name, pending[name].decode('utf-8', 'replace').rstrip('\r')
+            self.exit_status = channel.recv_exit_status()
+        finally:
+            channel.close()
+            observe_ssh(self.host, time.time() - self.started, self.exit_status == 0)
+
+    def drain(self, on_line=None):
+        for name, line in self:
+            if on_line is not None:
+                on_line(name, line)
+        return self.exit_status
+
+
+def log_line(host):
+    def on_line(name, line):
+        if name == 'stderr':
+            logger.error('%s: %s' % (host, line))
+        else:
+            logger.info('%s: %s' % (host, line))
+    return on_line
+
+
+ssh_pool = SSHPool()
+_local = threading.local()
 
 
 def ssh_connect(host, user, key):
-    private_key = paramiko.RSAKey.from_private_key(io.StringIO(key))
+    ssh_close()
     try:
-        ssh.connect(host, username=user, pkey=private_key)
+        _local.client = ssh_pool.get(host, user, key)
     except Exception as error:
+        _local.client = None
         logger.error(error)
+    return _local.client
 
 
-def ssh_execute(command):
+def ssh_execute(command, client=None):
+    client = client or getattr(_local, 'client', None)
+    output = {'stdout': [], 'stderr': []}
     try:
-        stdin, stdout, stderr = ssh.exec_command(command)
+        for name, line in SSHStream(client, command):
+            output[name].append(line)
+        return output['stdout'], output['stderr']
     except Exception as error:
         logger.error(error)
-    return [out.replace("\n", '') for out in stdout.readlines()], [err.replace("\n", '') for err in stderr.readlines()]
+        if client is not None and not SSHPool._is_healthy(client):
+            ssh_pool.discard_client(client)
+        return [], [str(error)]
+
+
+def ssh_stream(command, client=None, timeout=None):
+    return SSHStream(client or getattr(_local, 'client', None), command, timeout=timeout)
 
 
 def ssh_close():
-    ssh.close()
+    """Release the thread's connection back to the pool; the transport stays open for reuse."""
+    client = getattr(_local, 'client', None)
+    if client is not None:
+        ssh_pool.release(client)
+    _local.client = None
+
+
+def _run_on_host(host, command, user, key, timeout, on_line, capture):
+    start = time.time()
+    client = None
+    output = {'stdout': [], 'stderr': []}
+    try:
+        client = ssh_pool.get(host, user, key)
+        stream = SSHStream(client, command, timeout=timeout)
+        for name, line in stream:
+            if on_line is not None:
+                on_line(name, line)
+            if capture:
+                output[name].append(line)
+        return HostResult(host, stream.exit_status, output['stdout'], output['stderr'], time.time() - start, None)
+    except Exception as error:
+        logger.error('%s: %s' % (host, error))
+        if client is not None and not SSHPool._is_healthy(client):
+            ssh_pool.discard_client(client)
+        return HostResult(host, None, [], [], time.time() - start, str(error))
+    finally:
+        if client is not None:
+            ssh_pool.release(client)
+
+
+def run_on_host(host, command, user=None, key=None, timeout=None, on_line=None, capture=True):
+    """Run a command on one host through the pool and return its HostResult."""
+    return _run_on_host(host, command, user or settings.SSH_USER, key or settings.SSH_KEY,
+                        timeout or settings.SSH_COMMAND_TIMEOUT, on_line, capture)
+
+
+def run_on_hosts(hosts: list, command, user=None, key=None, timeout=None, max_workers=None, on_line=None, capture=True):
+    """Run a command on every host concurrently and return one HostResult per host, in host order.
+
+    on_line is a factory called with each host that returns a (stream, line) callback, e.g. log_line.
+    Pass capture=False to stream output through on_line without keeping it in the results.
+    """
+    user = user or settings.SSH_USER
+    key = key or settings.SSH_KEY
+    timeout = timeout or settings.SSH_COMMAND_TIMEOUT
+    if not hosts:
+        return []
+    with ClusterThreadPoolExecutor(max_workers=min(len(hosts), max_workers or settings.SSH_MAX_WORKERS)) as executor:
+        futures = [executor.submit(_run_on_host, host, command, user, key, timeout,
+                                   on_line(host) if on_line else None, capture) for host in hosts]
+        return [future.result() for future in futures]
@@ -1,19 +1,25 @@
+import base64
 import datetime
-import boto3
+import hashlib
+import threading
+import time
 import json
 import requests
-import io
-from django.conf import settings
+from collections import namedtuple
+from botocore.exceptions import ClientError
+from flynn_updater.core.clusters import settings, ClusterThreadPoolExecutor
 from celery.utils.log import get_task_logger
+from flynn_updater.core.cache import get_redis, cache_key
+from flynn_updater.core.aws import clients
 
 logger = get_task_logger(__name__)
-asg = boto3.client('autoscaling')
-ec2 = boto3.resource('ec2')
-dns = boto3.client('route53')
-rds = boto3.client('rds')
-elb = boto3.client('elb')
-s3 = boto3.client('s3')
-s3_res = boto3.resource('s3')
+asg = clients.lazy('autoscaling')
+ec2 = clients.lazy('ec2')
+dns = clients.lazy('route53')
+rds = clients.lazy('rds')
+elb = clients.lazy('elb')
+s3 = clients.lazy('s3')
+sqs = clients.lazy('sqs')
 
 
 def get_instances(asg_id: list):
@@ -21,30 +27,110 @@ def get_instances(asg_id: list):
     return asg_instances
 
 
+BackupResult = namedtuple('BackupResult', ['key', 'size', 'parts', 'duration', 'etag', 'sha256'])
+SecurityGroupReconcileResult = namedtuple('SecurityGroupReconcileResult', ['authorized', 'revoked'])
+# marks the security group rules reconcile_security_group owns
+NODE_RULE_DESCRIPTION = 'flynn-updater node'
+ElbSyncResult = namedtuple('ElbSyncResult', ['elb', 'registered', 'deregistered', 'error'])
+DnsReconcileResult = namedtuple('DnsReconcileResult', ['changed', 'records', 'reason'])
+# EC2 states of an instance that is on its way out of the cluster
+TERMINAL_STATES = ('shutting-down', 'terminated', 'stopping', 'stopped')
+InstanceRecord = namedtuple('InstanceRecord', ['instance_id', 'state', 'private_ip', 'public_ip', 'lifecycle'])
+
+
+class ClusterInventory(object):
+    """Point-in-time view of the ASG instances built from batched DescribeInstances calls."""
+
+    # DescribeInstances accepts at most 200 values per filter.
+    FILTER_CHUNK = 200
+
+    def __init__(self, records: list):
+        self.records = records
+        self._by_id = {record.instance_id: record for record in records}
+
+    @classmethod
+    def from_instances(cls, instances: list):
+        instance_ids = [instance['InstanceId'] for instance in instances]
+        lifecycle = {instance['InstanceId']: instance.get('LifecycleState') for instance in instances}
+        found = {}
+        paginator = ec2.get_paginator('describe_instances')
+        for i in range(0, len(instance_ids), cls.FILTER_CHUNK):
+            chunk = instance_ids[i:i + cls.FILTER_CHUNK]
+            pages = paginator.paginate(Filters=[{'Name': 'instance-id', 'Values': chunk}])
+            for page in pages:
+                for reservation in page['Reservations']:
+                    for instance in reservation['Instances']:
+                        found[instance['InstanceId']] = InstanceRecord(
+                            instance_id=instance['InstanceId'],
+                            state=instance['State']['Name'],
+                            private_ip=instance.get('PrivateIpAddress'),
+                            public_ip=instance.get('PublicIpAddress'),
+                            lifecycle=lifecycle.get(instance['InstanceId'])
+                        )
+        # keep the ASG ordering so callers see a stable node list
+        return cls([found[instance_id] for instance_id in instance_ids if instance_id in found])
+
+    @classmethod
+    def from_asg(cls, asg_id):
+        return cls.from_instances(get_instances([asg_id]))
+
+    def get(self, instance_id):
+        return self._by_id.get(instance_id)
+
+    @staticmethod
+    def is_leaving(record):
+        # a node held in Terminating:Wait by a lifecycle hook is still running but already leaving
+        return (record.lifecycle or '').startswith('Terminating')
+
+    def by_state(self, state: str = 'running'):
+        return [record for record in self.records
+                if state in record.state and not (state == 'running' and self.is_leaving(record))]
+
+    def leaving(self):
+        return [record for record in self.records if 'running' in record.state and self.is_leaving(record)]
+
+    def departed_ids(self):
+        """ASG members in a terminal state or held in Terminating:Wait."""
+        return [record.instance_id for record in self.records
+                if record.state in TERMINAL_STATES or self.is_leaving(record)]
+
+    def instance_ids(self, state: str = 'running'):
+        return [record.instance_id for record in self.by_state(state)]
+
+    def private_addrs(self, state: str = 'running'):
+        return [record.private_ip for record in self.by_state(state) if record.private_ip]
+
+    def public_addrs(self, state: str = 'running'):
+        return [record.public_ip for record in self.by_state(state) if record.public_ip]
+
+    def addrs(self, state: str = 'running', private=False):
+        if private:
+            return self.private_addrs(state)
+        return self.public_addrs(state)
+
+
+def get_inventory(asg_id=None):
+    return ClusterInventory.from_asg(asg_id or settings.AWS_AUTOSCALING_GROUP)
+
+
 def get_instance_state(instance):
-    return ec2.Instance(instance['InstanceId']).state
+    return ClusterInventory.from_instances([instance]).get(instance['InstanceId']).state
 
 
 def get_instances_by_state(instances: list, state: str = 'running'):
-    instances_by_state = []
-    for instance in instances:
-        if state in get_instance_state(instance)['Name']:
-            instances_by_state.append(instance)
-    return instances_by_state
+    inventory = ClusterInventory.from_instances(instances)
+    return [instance for instance in instances
+            if inventory.get(instance['InstanceId']) and state in inventory.get(instance['InstanceId']).state]
 
 
 def get_instance_public_addr(instances: list):
-    instances_addr = []
-    for instance in instances:
-        instances_addr.append(ec2.Instance(instance['InstanceId']).public_ip_address)
-    return instances_addr
+    inventory = ClusterInventory.from_instances(instances)
+    return [inventory.get(instance['InstanceId']).public_ip for instance in instances if inventory.get(instance['InstanceId'])]
 
 
 def get_instance_private_addr(instances: list):
-    instances_addr = []
-    for instance in instances:
-        instances_addr.append(ec2.Instance(instance['InstanceId']).private_ip_address)
-    return instances_addr
+    inventory = ClusterInventory.from_instances(instances)
+    return [inventory.get(instance['InstanceId']).private_ip for instance in instances if inventory.get(instance['InstanceId'])]
 
 
 def dns_update(zone_id, records: list, domain, record_type='A', ttl=60):
@@ -65,6 +151,45 @@ def dns_update(zone_id, records: list, domain, record_type='A', ttl=60):
     )
 
 
+def get_dns_records(zone_id, domain, record_type='A'):
+    record_sets = dns.list_resource_record_sets(
+        HostedZoneId=zone_id,
+        StartRecordName=domain,
+        StartRecordType=record_type,
+        MaxItems='1'
+    )['ResourceRecordSets']
+    for record_set in record_sets:
+        if record_set['Name'].rstrip('.') == domain.rstrip('.') and record_set['Type'] == record_type:
+            return record_set
+    return None
+
+
+def dns_fingerprint(addrs: list, record_type='A', ttl=60):
+    payload = '%s|%s|%s' % (record_type, ttl, ','.join(sorted(set(addrs))))
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+
+def dns_reconcile(zone_id, addrs: list, domain, record_type='A', ttl=60):
+    """UPSERT the record set only when the sorted address set differs from what Route53 serves."""
+    addrs = sorted(set(addrs))
+    fingerprint = dns_fingerprint(addrs, record_type, ttl)
+    key = cache_key('dns', zone_id, domain, record_type)
+    if get_redis().get(key) == fingerprint:
+        return DnsReconcileResult(changed=False, records=addrs, reason='cached')
+
+    current = get_dns_records(zone_id, domain, record_type)
+    if current is not None:
+        current_addrs = [record['Value'] for record in current.get('ResourceRecords', [])]
+        if dns_fingerprint(current_addrs, current['Type'], current.get('TTL')) == fingerprint:
+            get_redis().set(key, fingerprint, ex=settings.DNS_CACHE_TTL)
+            return DnsReconcileResult(changed=False, records=addrs, reason='in-sync')
+
+    dns_update(zone_id=zone_id, domain=domain, records=[{'Value': addr} for addr in addrs],
+               record_type=record_type, ttl=ttl)
+    get_redis().set(key, fingerprint, ex=settings.DNS_CACHE_TTL)
+    return DnsReconcileResult(changed=True, records=addrs, reason='updated')
+
+
 def get_discovery_instances(discovery_token):
     instances = requests.get('%s/%s/instances' % (settings.FLYNN_DISCOVERY_URL, discovery_token)).json()
     return instances
@@ -75,6 +200,16 @@ def update_discovery_instances(discovery_token, instance_data: dict):
     return requests.post('%s/%s/instances' % (settings.FLYNN_DISCOVERY_URL, discovery_token), data=json.dumps(instance_data), headers=headers)
 
 
+def complete_lifecycle_action(asg_id, hook, token, instance_id, result='CONTINUE'):
+    return asg.complete_lifecycle_action(
+        AutoScalingGroupName=asg_id,
+        LifecycleHookName=hook,
+        LifecycleActionToken=token,
+        LifecycleActionResult=result,
+        InstanceId=instance_id
+    )
+
+
 def get_rds_endpoint(rds_id):
     return rds.describe_db_instances(DBInstanceIdentifier=rds_id)['DBInstances'][0]['Endpoint']['Address']
 
@@ -84,16 +219,15 @@ def get_rds_security_group(rds_id):
 
 
 def get_security_group_rules(sg_id):
-    security_group = ec2.SecurityGroup(sg_id)
-    return security_group.ip_permissions
+    return ec2.describe_security_groups(GroupIds=[sg_id])['SecurityGroups'][0]['IpPermissions']
 
 
 def add_security_group_rule(sg_id, ip, port, proto='tcp'):
-    security_group = ec2.SecurityGroup(sg_id)
     rules = get_security_group_rules(sg_id)
     for rule in rules:
         if '%s/32' % ip not in [i['CidrIp'] for i in rule['IpRanges']]:
-            security_group.authorize_ingress(
+            ec2.authorize_security_group_ingress(
+                GroupId=sg_id,
                 IpProtocol=proto,
                 FromPort=port,
                 ToPort=port,
@@ -102,11 +236,11 @@ def add_security_group_rule(sg_id, ip, port, proto='tcp'):
 
 
 def remove_security_group_rule(sg_id, ip, port, proto='tcp'):
-    security_group = ec2.SecurityGroup(sg_id)
     rules = get_security_group_rules(sg_id)
     for rule in rules:
         if '%s/32' % ip in [i['CidrIp'] for i in rule['IpRanges']] and port is rule['ToPort']:
-            security_group.revoke_ingress(
+            ec2.revoke_security_group_ingress(
+                GroupId=sg_id,
                 IpProtocol=proto,
                 FromPort=port,
                 ToPort=port,
@@ -114,6 +248,44 @@ def remove_security_group_rule(sg_id, ip, port, proto='tcp'):
             )
 
 
+def reconcile_security_group(sg_id, ips: list, port, proto='tcp', keep_cidrs=()):
+    """Make the group's node ingress rules for one port match `ips` (as /32s), and add any missing `keep_cidrs`.
+
+    One describe call, then at most one batched call each to authorize, describe and revoke. Node
+    rules carry NODE_RULE_DESCRIPTION and only rules carrying it are ever revoked, so ranges operators
+    added by hand are left alone. An undescribed rule for a running node is adopted by describing it.
+    """
+    nodes = set('%s/32' % ip for ip in ips)
+    group = ec2.describe_security_groups(GroupIds=[sg_id])['SecurityGroups'][0]
+    current, managed = set(), set()
+    for permission in group['IpPermissions']:
+        if permission.get('IpProtocol') == proto and permission.get('FromPort') == port and permission.get('ToPort') == port:
+            for ip_range in permission.get('IpRanges', []):
+                current.add(ip_range['CidrIp'])
+                if ip_range.get('Description') == NODE_RULE_DESCRIPTION and ip_range['CidrIp'].endswith('/32'):
+                    managed.add(ip_range['CidrIp'])
+    authorize = sorted((nodes | set(keep_cidrs)) - current)
+    adopt = sorted((nodes & current) - managed)
+    revoke = sorted(managed - nodes - set(keep_cidrs))
+    if authorize:
+        ec2.authorize_security_group_ingress(GroupId=sg_id, IpPermissions=[{
+            'IpProtocol': proto, 'FromPort': port, 'ToPort': port,
+            'IpRanges': [dict({'CidrIp': cidr}, **({'Description': NODE_RULE_DESCRIPTION} if cidr in nodes else {}))
+                         for cidr in authorize]
+        }])
+    if adopt:
+        ec2.update_security_group_rule_descriptions_ingress(GroupId=sg_id, IpPermissions=[{
+            'IpProtocol': proto, 'FromPort': port, 'ToPort': port,
+            'IpRanges': [{'CidrIp': cidr, 'Description': NODE_RULE_DESCRIPTION} for cidr in adopt]
+        }])
+    if revoke:
+        ec2.revoke_security_group_ingress(GroupId=sg_id, IpPermissions=[{
+            'IpProtocol': proto, 'FromPort': port, 'ToPort': port,
+            'IpRanges': [{'CidrIp': cidr} for cidr in revoke]
+        }])
+    return SecurityGroupReconcileResult(authorized=authorize, revoked=revoke)
+
+
 def get_route53_records(zone_id, domain, record_type='A'):
     return dns.test_dns_answer(HostedZoneId=zone_id, RecordName=domain, RecordType=record_type)['RecordData']
 
@@ -128,15 +300,131 @@ def register_instances_with_elb(elb_id, instances: list):
     )
 
 
-def flynn_backup_to_s3(s3_bucket):
-    backup = requests.get('https://controller.%s/backup?key=%s' % (settings.AWS_ROUTE53_DOMAIN, settings.FLYNN_KEY), verify=False)
-    if backup.status_code == 200:
-        backup_file = backup.headers['Content-Disposition'].split('; ')[1].split('=')[1].split('"')[1]
-        backup_data = io.BytesIO(backup.content)
-        logger.info('Backup Flynn cluster %s to %s/backup/%s' % (settings.AWS_ROUTE53_DOMAIN, settings.S3_BLOBSTORE, backup_file))
-        return s3.upload_fileobj(backup_data, s3_bucket, 'backup/%s' % backup_file)
-
+def deregister_instances_from_elb(elb_id, instances: list):
+    return elb.deregister_instances_from_load_balancer(
+        LoadBalancerName=elb_id,
+        Instances=[{'InstanceId': i} for i in instances]
+    )
 
-def get_latest_backup(s3_bucket):
-    return sorted(s3_res.Bucket(s3_bucket).objects.all().filter(Prefix='backup/'), key=lambda k: k.last_modified, reverse=True)[0].key
 
+def _describe_elbs(elb_ids: list):
+    try:
+        return elb.describe_load_balancers(LoadBalancerNames=elb_ids)['LoadBalancerDescriptions']
+    except ClientError as error:
+        if error.response['Error']['Code'] != 'LoadBalancerNotFound':
+            raise
+    if len(elb_ids) == 1:
+        logger.error('ELB %s not found' % elb_ids[0])
+        return []
+    # one missing name fails the whole batch, look the others up on their own
+    return [description for elb_id in elb_ids for description in _describe_elbs([elb_id])]
+
+
+def get_elb_instances(elb_ids: list):
+    """Return the registered instance ids per ELB; ELBs that do not exist are left out."""
+    members = {}
+    # DescribeLoadBalancers accepts at most 20 names per call.
+    for i in range(0, len(elb_ids), 20):
+        for description in _describe_elbs(elb_ids[i:i + 20]):
+            members[description['LoadBalancerName']] = [i['InstanceId'] for i in description['Instances']]
+    return members
+
+
+def _sync_elb(elb_id, current: list, instances: list, departed: list):
+    register = sorted(set(instances) - set(current))
+    # only ASG nodes known to be leaving are taken out, never manually added or still pending ones
+    deregister = sorted(set(current) & set(departed))
+    try:
+        if register:
+            register_instances_with_elb(elb_id, register)
+        if deregister:
+            deregister_instances_from_elb(elb_id, deregister)
+    except Exception as error:
+        logger.error('ELB %s sync failed: %s' % (elb_id, error))
+        return ElbSyncResult(elb=elb_id, registered=[], deregistered=[], error=str(error))
+    return ElbSyncResult(elb=elb_id, registered=register, deregistered=deregister, error=None)
+
+
+def sync_elb_instances(elb_ids: list, instances: list, departed: list = ()):
+    """Register missing and deregister departed instances on every ELB concurrently."""
+    members = get_elb_instances(elb_ids)
+    results = [ElbSyncResult(elb=elb_id, registered=[], deregistered=[], error='LoadBalancerNotFound')
+               for elb_id in elb_ids if elb_id not in members]
+    found = [elb_id for elb_id in elb_ids if elb_id in members]
+    with ClusterThreadPoolExecutor(max_workers=max(1, min(len(found), settings.ELB_SYNC_WORKERS))) as pool:
+        futures = [pool.submit(_sync_elb, elb_id, members[elb_id], instances, departed) for elb_id in found]
+        return [future.result() for future in futures] + results
+
+
+def _iter_parts(response, part_size):
+    buffer = bytearray()
+    for chunk in response.iter_content(chunk_size=1024 * 1024):
+        buffer.extend(chunk)
+        while len(buffer) >= part_size:
+            yield bytes(buffer[:part_size])
+            del buffer[:part_size]
+    if buffer:
+        yield bytes(buffer)
+
+
+def _upload_part(s3_bucket, key, upload_id, number, data):
+    # S3 rejects a part whose body does not match Content-MD5. The ETag is only the MD5 for
+    # unencrypted and SSE-S3 objects, so it is not compared here.
+    part = s3.upload_part(
+        Bucket=s3_bucket,
+        Key=key,
+        UploadId=upload_id,
+        PartNumber=number,
+        Body=data,
+        ContentMD5=base64.b64encode(hashlib.md5(data).digest()).decode('ascii')
+    )
+    return {'PartNumber': number, 'ETag': part['ETag']}
+
+
+def stream_to_s3(response, s3_bucket, key, part_size=None, max_workers=None):
+    """Copy a streaming HTTP response into an S3 multipart upload.
+
+    At most max_workers parts are in flight, so memory stays around (max_workers + 1) * part_size
+    regardless of the response size. Every part is sent with Content-MD5, which S3 checks as it
+    receives it, and the returned sha256 covers the whole stream.
+    """
+    part_size = part_size or settings.BACKUP_PART_SIZE * 1024 * 1024
+    max_workers = max_workers or settings.BACKUP_UPLOAD_WORKERS
+    start = time.time()
+    sha256 = hashlib.sha256()
+    size = 0
+    slots = threading.BoundedSemaphore(max_workers)
+    upload_id = s3.create_multipart_upload(Bucket=s3_bucket, Key=key)['UploadId']
+    try:
+        futures = []
+        with ClusterThreadPoolExecutor(max_workers=max_workers) as executor:
+            for number, data in enumerate(_iter_parts(response, part_size), 1):
+                sha256.update(data)
+                size += len(data)
+                slots.acquire()
+                future = executor.submit(_upload_part, s3_bucket, key, upload_id, number, data)
+                future.add_done_callback(lambda f: slots.release())
+                futures.append(future)
+                del data
+            parts = [future.result() for future in futures]
+        if not parts:
+            raise ValueError('Empty stream for %s' % key)
+        completed = s3.complete_multipart_upload(
+            Bucket=s3_bucket,
+            Key=key,
+            UploadId=upload_id,
+            MultipartUpload={'Parts': parts}
+        )
+    except Exception:
+        s3.abort_multipart_upload(Bucket=s3_bucket, Key=key, UploadId=upload_id)
+        raise
+    return BackupResult(key=key, size=size, parts=len(parts), duration=time.time() - start,
+                        etag=completed['ETag'].strip('"'), sha256=sha256.hexdigest())
+
+
+def get_backup_stream():
+    return requests.get('https://controller.%s/backup?key=%s' % (settings.AWS_ROUTE53_DOMAIN, settings.FLYNN_KEY), verify=False, stream=True)
+
+
+def get_backup_filename(backup):
+    return backup.headers['Content-Disposition'].split('; ')[1].split('=')[1].split('"')[1]
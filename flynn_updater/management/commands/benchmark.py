@@ -0,0 +1,49 @@
+import os
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from flynn_updater.benchmarks.runner import SIZES, TASKS, run_benchmarks, format_results, save_baseline, \
+    load_baseline, compare, measure_startup
+
+
+class Command(BaseCommand):
+    help = 'Run the Celery tasks against simulated clusters and compare them with a saved baseline.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=list(SIZES),
+                            help='cluster sizes to simulate, in nodes')
+        parser.add_argument('--tasks', nargs='+', default=TASKS, choices=TASKS)
+        parser.add_argument('--latency', type=float, default=0.0,
+                            help='simulated AWS round trip per call, in milliseconds')
+        parser.add_argument('--baseline', default=os.path.join(settings.BASE_DIR, 'benchmarks', 'baseline.json'))
+        parser.add_argument('--save-baseline', action='store_true',
+                            help='store this run as the new baseline instead of comparing against it')
+        parser.add_argument('--tolerance', type=float, default=0.25,
+                            help='allowed relative slowdown in wall time and peak memory')
+        parser.add_argument('--startup', action='store_true',
+                            help='only measure how long a worker process takes to import the Celery app')
+
+    def handle(self, *args, **options):
+        if options['startup']:
+            self.stdout.write('Worker startup: %.3fs (median of 5)' % measure_startup())
+            return
+
+        def progress(result):
+            self.stderr.write('%s@%d %.3fs' % (result.task, result.nodes, result.wall))
+
+        results = run_benchmarks(sizes=options['sizes'], tasks=options['tasks'],
+                                 latency=options['latency'] / 1000.0, progress=progress)
+        self.stdout.write(format_results(results))
+
+        if options['save_baseline']:
+            save_baseline(options['baseline'], results)
+            self.stdout.write('Saved baseline to %s' % options['baseline'])
+            return
+        if not os.path.exists(options['baseline']):
+            self.stdout.write('No baseline at %s, run with --save-baseline to create one' % options['baseline'])
+            return
+        regressions = compare(results, load_baseline(options['baseline']), options['tolerance'])
+        for regression in regressions:
+            self.stdout.write(regression)
+        if regressions:
+            raise CommandError('%d regressions against %s' % (len(regressions), options['baseline']))
+        self.stdout.write('No regressions against %s' % options['baseline'])
@@ -131,6 +131,11 @@ env = environ.Env()
 AWS_ACCESS_KEY_ID = env('AWS_ACCESS_KEY_ID')
 AWS_SECRET_ACCESS_KEY = env('AWS_SECRET_ACCESS_KEY')
 AWS_DEFAULT_REGION = env('AWS_DEFAULT_REGION')
+AWS_MAX_POOL_CONNECTIONS = env.int('AWS_MAX_POOL_CONNECTIONS', default=25)
+AWS_CONNECT_TIMEOUT = env.int('AWS_CONNECT_TIMEOUT', default=10)
+AWS_READ_TIMEOUT = env.int('AWS_READ_TIMEOUT', default=60)
+AWS_RETRY_MODE = env('AWS_RETRY_MODE', default='adaptive')
+AWS_MAX_ATTEMPTS = env.int('AWS_MAX_ATTEMPTS', default=10)
 AWS_ROUTE53_ZONE = env('AWS_ROUTE53_ZONE')
 AWS_ROUTE53_DOMAIN = env('AWS_ROUTE53_DOMAIN')
 AWS_AUTOSCALING_GROUP = env('AWS_AUTOSCALING_GROUP')
@@ -138,21 +143,80 @@ FLYNN_PIN = env('FLYNN_PIN')
 FLYNN_KEY = env('FLYNN_KEY')
 SSH_USER = env('SSH_USER', default='ubuntu')
 SSH_KEY = env('SSH_KEY')
+SSH_PORT = env.int('SSH_PORT', default=22)
+SSH_CONNECT_TIMEOUT = env.int('SSH_CONNECT_TIMEOUT', default=15)
+SSH_KEEPALIVE = env.int('SSH_KEEPALIVE', default=30)
+SSH_IDLE_TIMEOUT = env.int('SSH_IDLE_TIMEOUT', default=300)
+SSH_COMMAND_TIMEOUT = env.int('SSH_COMMAND_TIMEOUT', default=1800)
+SSH_MAX_WORKERS = env.int('SSH_MAX_WORKERS', default=16)
 TIMEZONE = env('TIMEZONE', default='UTC')
 REDIS_URL = env('REDIS_URL', default='redis://localhost:6379/0')
 DEBUG = env('DEBUG', default=False)
 DJANGO_LOG_LEVEL = env('DJANGO_LOG_LEVEL', default='INFO')
 S3_BLOBSTORE = env('S3_BLOBSTORE')
+BACKUP_PART_SIZE = env.int('BACKUP_PART_SIZE', default=32)
+BACKUP_UPLOAD_WORKERS = env.int('BACKUP_UPLOAD_WORKERS', default=4)
+BACKUP_MODE = env('BACKUP_MODE', default='full')
+BACKUP_CHUNK_MIN = env.int('BACKUP_CHUNK_MIN', default=256)
+BACKUP_CHUNK_AVG = env.int('BACKUP_CHUNK_AVG', default=1024)
+BACKUP_CHUNK_MAX = env.int('BACKUP_CHUNK_MAX', default=4096)
+BACKUP_RETENTION = env.bool('BACKUP_RETENTION', default=False)
+BACKUP_KEEP_HOURLY = env.int('BACKUP_KEEP_HOURLY', default=24)
+BACKUP_KEEP_DAILY = env.int('BACKUP_KEEP_DAILY', default=7)
+BACKUP_KEEP_WEEKLY = env.int('BACKUP_KEEP_WEEKLY', default=4)
 FLYNN_DISCOVERY_TOKEN = env('FLYNN_DISCOVERY_TOKEN')
 FLYNN_DISCOVERY_URL = env('FLYNN_DISCOVERY_URL', default='https://discovery.flynn.io/clusters')
 FLYNN_PATH = env('FLYNN_PATH', default='/app/flynn')
+FLYNN_BACKEND = env('FLYNN_BACKEND', default='api')
+COMMAND_TIMEOUT = env.int('COMMAND_TIMEOUT', default=600)
+COMMAND_MAX_WORKERS = env.int('COMMAND_MAX_WORKERS', default=8)
+DB_DELETE_BATCH_SIZE = env.int('DB_DELETE_BATCH_SIZE', default=5000)
+BLOBSTORE_MIGRATE_TIMEOUT = env.int('BLOBSTORE_MIGRATE_TIMEOUT', default=3600)
+BLOBSTORE_MIGRATE_WORKERS = env.int('BLOBSTORE_MIGRATE_WORKERS', default=4)
+BLOBSTORE_PREFIX_OBJECTS = env.int('BLOBSTORE_PREFIX_OBJECTS', default=500)
+BLOBSTORE_CHECKPOINT_TTL = env.int('BLOBSTORE_CHECKPOINT_TTL', default=7 * 24 * 3600)
+# how long after its timeout a migrate job is assumed to still be running on the cluster
+BLOBSTORE_INFLIGHT_TTL = env.int('BLOBSTORE_INFLIGHT_TTL', default=3600)
+FLYNN_API_POOL_SIZE = env.int('FLYNN_API_POOL_SIZE', default=10)
+FLYNN_API_TIMEOUT = env.int('FLYNN_API_TIMEOUT', default=30)
+APP_CATALOG_TTL = env.int('APP_CATALOG_TTL', default=300)
+RELEASE_GC_KEEP = env.int('RELEASE_GC_KEEP', default=0)
+RELEASE_GC_WORKERS = env.int('RELEASE_GC_WORKERS', default=8)
 RDS_DB_ID = env('RDS_DB_ID')
 DB_USER = env('DB_USER')
 DB_PASSWORD = env('DB_PASSWORD')
 DB_OPTS = env('DB_OPTS', default='?sslmode=require')
 DB_PORT = env('DB_PORT', default=5432)
+RDS_ALLOWED_CIDRS = env.list('RDS_ALLOWED_CIDRS', default=[])
 ELB = env('ELB', default='')
+ELB_SYNC_WORKERS = env.int('ELB_SYNC_WORKERS', default=8)
 CLUSTER_PRIVATE = env('CLUSTER_PRIVATE', default=False)
+CLUSTER_RECONCILE = env.bool('CLUSTER_RECONCILE', default=False)
+RECONCILE_ACTIONS = env.list('RECONCILE_ACTIONS', default=['dns', 'elb', 'discoverd', 'demote'])
+EVENT_QUEUE_URL = env('EVENT_QUEUE_URL', default='')
+EVENT_POLL_INTERVAL = env.int('EVENT_POLL_INTERVAL', default=15)
+EVENT_DEBOUNCE = env.int('EVENT_DEBOUNCE', default=10)
+EVENT_SAFETY_INTERVAL = env.int('EVENT_SAFETY_INTERVAL', default=600)
+# how long a held lifecycle hook is remembered, the ASG default heartbeat timeout
+LIFECYCLE_ACTION_TTL = env.int('LIFECYCLE_ACTION_TTL', default=3600)
+DNS_CACHE_TTL = env.int('DNS_CACHE_TTL', default=600)
+# on the CLI backend also how long a discoverd release deployed out of band can go unnoticed
+DISCOVERD_CACHE_TTL = env.int('DISCOVERD_CACHE_TTL', default=600)
+DEMOTE_WORKERS = env.int('DEMOTE_WORKERS', default=4)
+DEMOTE_ATTEMPTS = env.int('DEMOTE_ATTEMPTS', default=3)
+DEMOTE_TIMEOUT = env.int('DEMOTE_TIMEOUT', default=300)
+DEMOTION_LEDGER_TTL = env.int('DEMOTION_LEDGER_TTL', default=30 * 24 * 3600)
+TASK_LOCK_TTL = env.int('TASK_LOCK_TTL', default=60)
+CLUSTERS_CONFIG = env('CLUSTERS_CONFIG', default='')
+# holds each cluster's .flynnrc with its FLYNN_KEY, created private to the worker's user
+CLUSTER_HOME_DIR = env('CLUSTER_HOME_DIR', default=os.path.join(os.path.expanduser('~'), '.flynn-updater', 'clusters'))
+CLUSTER_MAX_CONCURRENCY = env.int('CLUSTER_MAX_CONCURRENCY', default=4)
+CLUSTER_RETRY_DELAY = env.int('CLUSTER_RETRY_DELAY', default=30)
+# the celery worker serves /metrics, unauthenticated, on this address and port; off while the port is 0.
+# Set prometheus_multiproc_dir to an empty, writable directory before the worker starts, or only the
+# main process's metrics are served.
+METRICS_PORT = env.int('METRICS_PORT', default=0)
+METRICS_ADDR = env('METRICS_ADDR', default='127.0.0.1')
 
 FLYNN_CLI_INSTALL = 'L=%s && curl -sSL -A "`uname -sp`" https://dl.flynn.io/cli | zcat >$L && chmod +x $L' % FLYNN_PATH
 FLYNN_CLI_SETUP = '%s cluster add -p %s default %s %s' % (FLYNN_PATH, FLYNN_PIN, AWS_ROUTE53_DOMAIN, FLYNN_KEY)
@@ -0,0 +1,81 @@
+import datetime
+import random
+from django.test import SimpleTestCase
+from flynn_updater.core.backup import iter_chunks, _find_cut, chunk_anchor, select_expired, CatalogEntry
+
+MIN, AVG, MAX = 1024, 4096, 16384
+
+
+def random_bytes(size, seed=0):
+    return random.Random(seed).getrandbits(8 * size).to_bytes(size, 'big')
+
+
+def blocks(data, size):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+def chunk(data, block_size=65536):
+    return list(iter_chunks(blocks(data, block_size), min_size=MIN, avg_size=AVG, max_size=MAX))
+
+
+class ChunkingTest(SimpleTestCase):
+
+    def test_chunks_rebuild_the_input(self):
+        data = random_bytes(512 * 1024)
+        self.assertEqual(b''.join(chunk(data)), data)
+
+    def test_chunk_sizes_stay_within_bounds(self):
+        chunks = chunk(random_bytes(512 * 1024))
+        for data in chunks[:-1]:
+            self.assertGreaterEqual(len(data), MIN)
+            self.assertLessEqual(len(data), MAX)
+        self.assertLessEqual(len(chunks[-1]), MAX)
+
+    def test_boundaries_do_not_depend_on_block_size(self):
+        data = random_bytes(256 * 1024)
+        self.assertEqual(chunk(data, 1000), chunk(data, 65536))
+
+    def test_insert_only_changes_nearby_chunks(self):
+        data = random_bytes(512 * 1024)
+        before = chunk(data)
+        after = chunk(data[:5000] + b'inserted' + data[5000:])
+        self.assertGreaterEqual(len(set(before) & set(after)), len(before) - 2)
+
+    def test_input_without_an_anchor_is_cut_at_max_size(self):
+        self.assertEqual([len(data) for data in chunk(bytes(3 * MAX))], [MAX, MAX, MAX])
+
+    def test_short_buffer_is_one_cut(self):
+        self.assertEqual(_find_cut(bytearray(MIN - 1), MIN, chunk_anchor(12), MAX), MIN - 1)
+
+
+# a Wednesday, ISO week 5 of 2024 runs from Monday the 29th to Sunday February 4th
+NOW = datetime.datetime(2024, 1, 31, 12, 0, tzinfo=datetime.timezone.utc).timestamp()
+
+
+def backup(key, hours_ago):
+    return CatalogEntry(key=key, kind='full', timestamp=NOW - hours_ago * 3600, size=0)
+
+
+class RetentionTest(SimpleTestCase):
+
+    def expired(self, entries, **policy):
+        return sorted(entry.key for entry in select_expired(entries, now=NOW, **policy))
+
+    def test_keeps_everything_within_the_hourly_window(self):
+        entries = [backup('b%d' % n, n) for n in range(5)]
+        self.assertEqual(self.expired(entries, hourly=5, daily=0, weekly=0), [])
+
+    def test_keeps_the_newest_backup_per_day(self):
+        entries = [backup('today', 2), backup('yesterday-late', 14), backup('yesterday-early', 20)]
+        self.assertEqual(self.expired(entries, hourly=1, daily=3, weekly=0), ['yesterday-early'])
+
+    def test_weekly_skips_weeks_covered_by_a_daily(self):
+        entries = [backup('wed', 6), backup('mon', 50), backup('last-wed', 7 * 24), backup('last-tue', 8 * 24)]
+        self.assertEqual(self.expired(entries, hourly=1, daily=1, weekly=2), ['last-tue', 'mon'])
+
+    def test_always_keeps_the_newest_backup(self):
+        entries = [backup('old', 1000), backup('older', 2000)]
+        self.assertEqual(self.expired(entries, hourly=1, daily=1, weekly=1), ['older'])
+
+    def test_no_backups(self):
+        self.assertEqual(select_expired([], now=NOW, hourly=1, daily=1, weekly=1), [])
@@ -0,0 +1,34 @@
+from django.test import SimpleTestCase
+from flynn_updater.core.blobstore import partition, BlobstoreObject
+
+
+def objects(*names):
+    return [BlobstoreObject(name, 1) for name in sorted(names)]
+
+
+class PartitionTest(SimpleTestCase):
+
+    def test_no_objects(self):
+        self.assertEqual(list(partition([], max_objects=2).items()), [])
+
+    def test_small_listing_is_one_group(self):
+        listing = objects('/slugs/a', '/slugs/b')
+        self.assertEqual(list(partition(listing, max_objects=2).items()), [('', listing)])
+
+    def test_groups_cover_every_object_once(self):
+        listing = objects(*['/%s/%02x.tgz' % (kind, n) for kind in ('slugs', 'layers') for n in range(40)])
+        groups = partition(listing, max_objects=8)
+        self.assertEqual(sorted(obj for members in groups.values() for obj in members), listing)
+        for prefix, members in groups.items():
+            self.assertLessEqual(len(members), 8)
+            self.assertTrue(all(obj.name.startswith(prefix) for obj in members))
+
+    def test_prefixes_do_not_overlap(self):
+        listing = objects(*['/slugs/%03d' % n for n in range(100)])
+        prefixes = list(partition(listing, max_objects=10))
+        for prefix in prefixes:
+            self.assertEqual([p for p in prefixes if p.startswith(prefix)], [prefix])
+
+    def test_prefix_that_is_a_file_name_is_not_split(self):
+        listing = objects('/a', '/a1', '/a2')
+        self.assertEqual(list(partition(listing, max_objects=2).items()), [('/a', listing)])
@@ -0,0 +1,104 @@
+import json
+from unittest import mock
+from django.test import SimpleTestCase, override_settings
+from flynn_updater.benchmarks.fakes import FakeRedis
+from flynn_updater.core.events import parse_event, dispatch, ClusterEvent
+
+HOOK = {
+    'LifecycleHookName': 'flynn-drain',
+    'AutoScalingGroupName': 'flynn-asg',
+    'EC2InstanceId': 'i-1',
+    'LifecycleActionToken': 'token-1',
+    'LifecycleTransition': 'autoscaling:EC2_INSTANCE_TERMINATING',
+}
+
+
+def sns(message):
+    return json.dumps({'TopicArn': 'arn:aws:sns:us-east-1:123456789012:flynn', 'Message': json.dumps(message)})
+
+
+class ParseEventTest(SimpleTestCase):
+
+    def test_lifecycle_hook(self):
+        self.assertEqual(parse_event(json.dumps(HOOK)),
+                         ClusterEvent('terminate', 'i-1', 'flynn-asg', 'flynn-drain', 'token-1'))
+
+    def test_launching_hook_from_eventbridge(self):
+        detail = dict(HOOK, LifecycleTransition='autoscaling:EC2_INSTANCE_LAUNCHING')
+        event = parse_event(json.dumps({'detail-type': 'EC2 Instance-launch Lifecycle Action', 'detail': detail}))
+        self.assertEqual(event, ClusterEvent('launch', 'i-1', 'flynn-asg', 'flynn-drain', 'token-1'))
+
+    def test_sns_envelope_is_unwrapped(self):
+        self.assertEqual(parse_event(sns(HOOK)), parse_event(json.dumps(HOOK)))
+
+    def test_asg_notification(self):
+        message = {'Event': 'autoscaling:EC2_INSTANCE_LAUNCH', 'EC2InstanceId': 'i-2',
+                   'AutoScalingGroupName': 'flynn-asg'}
+        self.assertEqual(parse_event(sns(message)), ClusterEvent('launch', 'i-2', 'flynn-asg', None, None))
+
+    def test_ec2_state_change(self):
+        message = {'detail-type': 'EC2 Instance State-change Notification',
+                   'detail': {'instance-id': 'i-3', 'state': 'shutting-down'}}
+        self.assertEqual(parse_event(json.dumps(message)), ClusterEvent('terminate', 'i-3', None, None, None))
+
+    def test_ec2_state_without_a_cluster_change(self):
+        message = {'detail-type': 'EC2 Instance State-change Notification',
+                   'detail': {'instance-id': 'i-3', 'state': 'pending'}}
+        self.assertIsNone(parse_event(json.dumps(message)))
+
+    def test_unknown_message(self):
+        self.assertIsNone(parse_event(sns({'Event': 'autoscaling:TEST_NOTIFICATION'})))
+
+    def test_invalid_json(self):
+        self.assertIsNone(parse_event('not json'))
+        self.assertIsNone(parse_event(None))
+
+    def test_json_that_is_not_an_object(self):
+        self.assertIsNone(parse_event('["i-1"]'))
+        self.assertIsNone(parse_event(sns('Test notification')))
+
+
+LAUNCH = ClusterEvent('launch', 'i-1', 'flynn-asg', None, None)
+TERMINATE = ClusterEvent('terminate', 'i-2', 'flynn-asg', None, None)
+
+
+@override_settings(RECONCILE_ACTIONS=['dns', 'elb', 'discoverd', 'demote'])
+class DispatchTest(SimpleTestCase):
+
+    def setUp(self):
+        patches = [mock.patch('flynn_updater.core.cache._redis', FakeRedis()),
+                   mock.patch('flynn_updater.core.events.current_app')]
+        patches[0].start()
+        self.send_task = patches[1].start().send_task
+        for patch in patches:
+            self.addCleanup(patch.stop)
+
+    def sent(self):
+        return [call[0][0] for call in self.send_task.call_args_list]
+
+    @override_settings(CLUSTER_RECONCILE=False)
+    def test_events_schedule_each_task(self):
+        self.assertEqual(dispatch([LAUNCH, TERMINATE], debounce=5),
+                         ['flynn_dns_update', 'aws_elb_update', 'flynn_update_discoverd_peers',
+                          'flynn_demote_dead_node'])
+        self.send_task.assert_any_call('flynn_demote_dead_node', kwargs={'cluster': 'default'}, countdown=5)
+
+    @override_settings(CLUSTER_RECONCILE=False, RECONCILE_ACTIONS=['dns', 'security_group'])
+    def test_security_group_task_is_opt_in(self):
+        self.assertIn('flynn_rds_security_group_update', dispatch([LAUNCH], debounce=5))
+
+    @override_settings(CLUSTER_RECONCILE=True)
+    def test_reconcile_replaces_the_per_resource_tasks(self):
+        self.assertEqual(dispatch([LAUNCH, TERMINATE], debounce=5), ['cluster_reconcile'])
+        self.assertEqual(self.sent(), ['cluster_reconcile'])
+
+    @override_settings(CLUSTER_RECONCILE=True)
+    def test_events_in_one_window_schedule_one_reconcile(self):
+        dispatch([LAUNCH], debounce=5)
+        self.assertEqual(dispatch([TERMINATE], debounce=5), [])
+        self.assertEqual(self.sent(), ['cluster_reconcile'])
+
+    @override_settings(CLUSTER_RECONCILE=True)
+    def test_no_events_schedule_nothing(self):
+        self.assertEqual(dispatch([], debounce=5), [])
+        self.send_task.assert_not_called()
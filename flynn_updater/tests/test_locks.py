@@ -0,0 +1,145 @@
+import time
+from unittest import mock
+from django.test import SimpleTestCase, override_settings
+from flynn_updater.benchmarks.fakes import FakeRedis
+from flynn_updater.core.cache import get_redis, cache_key
+from flynn_updater.core.locks import LeaseLock, single_flight, cluster_task
+
+
+class FakeRedisTestCase(SimpleTestCase):
+    """Runs each test against a fresh FakeRedis with task sends recorded instead of queued."""
+
+    def setUp(self):
+        self.held = []
+        patches = [mock.patch('flynn_updater.core.cache._redis', FakeRedis()),
+                   mock.patch('flynn_updater.core.locks.current_app')]
+        self.send_task = patches[1].start().send_task
+        patches[0].start()
+        for patch in patches:
+            self.addCleanup(patch.stop)
+
+    def tearDown(self):
+        for lock in self.held:
+            lock.release()
+
+    def hold(self, name, ttl=None):
+        lock = LeaseLock(name, ttl)
+        self.assertTrue(lock.acquire())
+        self.held.append(lock)
+        return lock
+
+
+class LeaseLockTest(FakeRedisTestCase):
+
+    def test_one_holder_at_a_time(self):
+        self.hold('lease')
+        self.assertFalse(LeaseLock('lease').acquire())
+
+    def test_heartbeat_keeps_the_lease_past_its_ttl(self):
+        lock = self.hold('lease', ttl=0.3)
+        time.sleep(0.6)
+        self.assertFalse(LeaseLock('lease').acquire())
+        self.assertFalse(lock.lost)
+
+    def test_lease_of_a_dead_holder_expires(self):
+        lock = LeaseLock('lease', ttl=0.2)
+        self.assertTrue(lock.acquire())
+        # what a killed worker leaves behind: the lease, without the heartbeat
+        lock._stop.set()
+        lock._heartbeat.join()
+        time.sleep(0.3)
+        successor = self.hold('lease')
+        self.assertFalse(lock.release())
+        self.assertEqual(get_redis().get(successor.key), successor.token)
+
+    def test_lost_lease_is_noticed(self):
+        lock = self.hold('lease', ttl=0.3)
+        get_redis().delete(lock.key)
+        time.sleep(0.4)
+        self.assertTrue(lock.lost)
+
+
+class SingleFlightTest(FakeRedisTestCase):
+
+    def test_unknown_mode(self):
+        with self.assertRaises(ValueError):
+            single_flight('bench_task', mode='queue')
+
+    def test_skip_drops_a_run_while_one_is_running(self):
+        calls = []
+        task = single_flight('bench_task', mode='skip')(lambda: calls.append(1))
+        self.hold('bench_task')
+        self.assertIsNone(task())
+        self.assertEqual(calls, [])
+        self.send_task.assert_not_called()
+
+    def test_coalesce_queues_one_follow_up(self):
+        calls = []
+
+        @single_flight('bench_task', mode='coalesce')
+        def task(cluster=None):
+            calls.append(cluster)
+            if len(calls) == 1:
+                # runs arriving while this one holds the lock
+                task(cluster='a')
+                task(cluster='a')
+
+        task(cluster='a')
+        self.assertEqual(calls, ['a'])
+        self.send_task.assert_called_once_with('bench_task', args=(), kwargs={'cluster': 'a'})
+        self.assertIsNone(get_redis().get(cache_key('lock', 'bench_task', 'pending')))
+
+    def test_coalesce_without_contention_queues_nothing(self):
+        task = single_flight('bench_task', mode='coalesce')(lambda: 'done')
+        self.assertEqual(task(), 'done')
+        self.assertEqual(task(), 'done')
+        self.send_task.assert_not_called()
+
+    def test_lock_is_released_when_the_task_fails(self):
+        def fail():
+            raise RuntimeError('boom')
+        task = single_flight('bench_task', mode='skip')(fail)
+        with self.assertRaises(RuntimeError):
+            task()
+        self.assertIsNone(get_redis().get(cache_key('lock', 'bench_task')))
+
+
+@override_settings(CLUSTER_MAX_CONCURRENCY=1, CLUSTER_RETRY_DELAY=30)
+class ClusterTaskTest(FakeRedisTestCase):
+
+    def task(self, mode):
+        calls = []
+
+        @cluster_task('bench_task', mode=mode)
+        def task(cluster=None):
+            calls.append(cluster)
+            return 'done'
+        return task, calls
+
+    def test_runs_with_a_free_slot(self):
+        task, calls = self.task('skip')
+        self.assertEqual(task(), 'done')
+        self.assertEqual(calls, [None])
+        self.assertIsNone(get_redis().get(cache_key('lock', 'slot:0')))
+
+    def test_running_skip_task_is_dropped_not_deferred(self):
+        task, calls = self.task('skip')
+        self.hold('bench_task')
+        self.hold('slot:0')
+        self.assertIsNone(task())
+        self.assertEqual(calls, [])
+        self.send_task.assert_not_called()
+
+    def test_busy_cluster_defers_one_run(self):
+        task, calls = self.task('skip')
+        self.hold('slot:0')
+        for _ in range(3):
+            self.assertIsNone(task())
+        self.assertEqual(calls, [])
+        self.send_task.assert_called_once_with('bench_task', args=(), kwargs={}, countdown=30)
+
+    def test_deferred_run_keeps_its_cluster(self):
+        task, _ = self.task('coalesce')
+        self.hold('slot:0')
+        task(cluster=None)
+        self.assertEqual(self.send_task.call_args[1]['kwargs'], {'cluster': None})
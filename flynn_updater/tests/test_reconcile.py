@@ -0,0 +1,109 @@
+from unittest import mock
+from django.test import SimpleTestCase, override_settings
+from flynn_updater.benchmarks.fakes import FakeRedis
+from flynn_updater.core.reconcile import parse_peers, build_plan, reconcile_discoverd, ACTIONS
+from flynn_updater.core.utils import ClusterInventory, InstanceRecord
+
+
+def node(n, state='running', lifecycle='InService', private=True):
+    return InstanceRecord('i-%d' % n, state, '10.0.0.%d' % n if private else None, '54.0.0.%d' % n, lifecycle)
+
+
+def plan_args(inventory, known_addrs=None):
+    return {action.name: action.args for action in build_plan(inventory, ACTIONS, known_addrs)}
+
+
+class ParsePeersTest(SimpleTestCase):
+
+    def test_strips_ports(self):
+        self.assertEqual(parse_peers('10.0.0.1:1111,10.0.0.2:1111'), {'10.0.0.1', '10.0.0.2'})
+
+    def test_skips_blank_entries(self):
+        self.assertEqual(parse_peers('10.0.0.1:1111,, '), {'10.0.0.1'})
+
+    def test_empty_value(self):
+        self.assertEqual(parse_peers(''), set())
+        self.assertEqual(parse_peers(None), set())
+
+    def test_duplicates_collapse(self):
+        self.assertEqual(parse_peers('10.0.0.1:1111,10.0.0.1:1112'), {'10.0.0.1'})
+
+
+@override_settings(ELB='elb-a,elb-b', CLUSTER_PRIVATE=False)
+class BuildPlanTest(SimpleTestCase):
+
+    def test_empty_inventory_plans_nothing(self):
+        self.assertEqual(build_plan(ClusterInventory([]), ACTIONS, {'i-9': '10.0.0.9'}), [])
+
+    def test_running_nodes_feed_every_action(self):
+        args = plan_args(ClusterInventory([node(1), node(2)]))
+        self.assertEqual(sorted(args), ['discoverd', 'dns', 'elb', 'security_group'])
+        self.assertEqual(args['dns'], (['54.0.0.1', '54.0.0.2'],))
+        self.assertEqual(args['discoverd'], (['10.0.0.1', '10.0.0.2'],))
+        self.assertEqual(args['elb'], (['elb-a', 'elb-b'], ['i-1', 'i-2'], []))
+
+    def test_terminated_node_is_demoted_by_its_remembered_address(self):
+        inventory = ClusterInventory([node(1), node(2, state='terminated', private=False)])
+        dead, peers = plan_args(inventory, {'i-1': '10.0.0.1', 'i-2': '10.0.0.2'})['demote']
+        self.assertEqual(dead, [node(2, state='terminated')])
+        self.assertEqual(peers, ['10.0.0.1'])
+
+    def test_terminated_node_without_an_address_is_skipped(self):
+        inventory = ClusterInventory([node(1), node(2, state='terminated', private=False)])
+        self.assertNotIn('demote', plan_args(inventory))
+
+    def test_node_gone_from_the_asg_is_demoted(self):
+        dead, _ = plan_args(ClusterInventory([node(1)]), {'i-1': '10.0.0.1', 'i-3': '10.0.0.3'})['demote']
+        self.assertEqual(dead, [InstanceRecord('i-3', 'terminated', '10.0.0.3', None, None)])
+
+    def test_terminating_node_leaves_the_cluster(self):
+        leaving = node(2, lifecycle='Terminating:Wait')
+        args = plan_args(ClusterInventory([node(1), leaving]))
+        self.assertEqual(args['dns'], (['54.0.0.1'],))
+        self.assertEqual(args['discoverd'], (['10.0.0.1'],))
+        self.assertEqual(args['elb'], (['elb-a', 'elb-b'], ['i-1'], ['i-2']))
+        self.assertEqual(args['demote'], ([leaving], ['10.0.0.1']))
+
+
+class ReconcileDiscoverdTest(SimpleTestCase):
+
+    def setUp(self):
+        self.release = {'id': 'release-1', 'env': {'DISCOVERD_PEERS': '10.0.0.1:1111,10.0.0.2:1111'}}
+        patches = [mock.patch('flynn_updater.core.cache._redis', FakeRedis())]
+        patches += [mock.patch('flynn_updater.core.reconcile.%s' % name) for name in (
+            'flynn_cli_init', 'get_app_current_release', 'get_app_release_json', 'update_app_release')]
+        patches[0].start()
+        self.cli_init, self.current_release, self.release_json, self.update = [p.start() for p in patches[1:]]
+        for patch in patches:
+            self.addCleanup(patch.stop)
+        self.current_release.return_value = 'release-1'
+        self.release_json.side_effect = lambda app: dict(self.release, env=dict(self.release['env']))
+
+    def test_peers_already_in_sync_are_left_alone(self):
+        self.assertEqual(reconcile_discoverd(['10.0.0.1', '10.0.0.2']).reason, 'in-sync')
+        self.update.assert_not_called()
+
+    def test_changed_nodes_update_the_release(self):
+        self.update.return_value = {'id': 'release-2'}
+        result = reconcile_discoverd(['10.0.0.1', '10.0.0.3'])
+        self.assertEqual((result.added, result.removed, result.release), (['10.0.0.3'], ['10.0.0.2'], 'release-2'))
+        self.assertEqual(self.update.call_args[0][1]['env']['DISCOVERD_PEERS'], '10.0.0.1:1111,10.0.0.3:1111')
+
+    @override_settings(FLYNN_BACKEND='cli')
+    def test_cli_tick_with_the_same_nodes_runs_nothing(self):
+        reconcile_discoverd(['10.0.0.1', '10.0.0.2'])
+        for mocked in (self.cli_init, self.current_release, self.release_json):
+            mocked.reset_mock()
+        self.assertEqual(reconcile_discoverd(['10.0.0.2', '10.0.0.1']).reason, 'cached')
+        for mocked in (self.cli_init, self.current_release, self.release_json):
+            mocked.assert_not_called()
+
+    @override_settings(FLYNN_BACKEND='api')
+    def test_api_tick_notices_an_out_of_band_release(self):
+        reconcile_discoverd(['10.0.0.1', '10.0.0.2'])
+        self.assertEqual(reconcile_discoverd(['10.0.0.1', '10.0.0.2']).reason, 'cached')
+        self.current_release.return_value = 'release-9'
+        self.release = {'id': 'release-9', 'env': {'DISCOVERD_PEERS': '10.0.0.1:1111'}}
+        self.update.return_value = {'id': 'release-10'}
+        result = reconcile_discoverd(['10.0.0.1', '10.0.0.2'])
+        self.assertEqual((result.reason, result.added), ('updated', ['10.0.0.2']))
@@ -0,0 +1,35 @@
+from unittest import mock
+from django.test import SimpleTestCase, override_settings
+from flynn_updater.core.releases import gc_releases
+from flynn_updater.core.shell import CommandResult
+
+
+def command_result(cmd, returncode=0, stderr='', timed_out=False):
+    return CommandResult(cmd=cmd, returncode=returncode, stdout=[''], stderr=[stderr], duration=0.1,
+                         timed_out=timed_out)
+
+
+@override_settings(FLYNN_BACKEND='cli', FLYNN_PATH='flynn')
+@mock.patch('flynn_updater.core.releases.get_app_current_release', lambda app: 'r1')
+@mock.patch('flynn_updater.core.releases.get_app_release', lambda app: ['r3', 'r2', 'r1'])
+class ReleaseGCTest(SimpleTestCase):
+
+    def gc(self, run):
+        with mock.patch('flynn_updater.core.shell.run', side_effect=run) as patched:
+            return gc_releases(['web'], keep=0, max_workers=2), patched
+
+    def test_cli_deletes(self):
+        (report,), run = self.gc(lambda cmd, shell: command_result(cmd))
+        self.assertEqual((report.deleted, report.failed, report.kept), (2, 0, 1))
+        self.assertEqual(sorted(call[0][0][-1] for call in run.call_args_list), ['r2', 'r3'])
+
+    def test_failed_cli_deletes_are_counted(self):
+        (report,), _ = self.gc(lambda cmd, shell: command_result(cmd, returncode=1, stderr='release in use'))
+        self.assertEqual((report.deleted, report.failed), (0, 2))
+
+    def test_timed_out_cli_delete_is_counted(self):
+        def run(cmd, shell):
+            timed_out = cmd[-1] == 'r3'
+            return command_result(cmd, returncode=-9 if timed_out else 0, timed_out=timed_out)
+        (report,), _ = self.gc(run)
+        self.assertEqual((report.deleted, report.failed), (1, 1))
@@ -0,0 +1,68 @@
+import socket
+import time
+from django.test import SimpleTestCase
+from flynn_updater.core.ssh import SSHStream
+
+
+class ChattyChannel(object):
+    """A channel whose command writes output without pause until it exits after `runtime` seconds."""
+
+    def __init__(self, runtime=3):
+        self.exits_at = time.time() + runtime
+        self.closed = False
+
+    def exec_command(self, command):
+        pass
+
+    def recv_ready(self):
+        return time.time() < self.exits_at
+
+    def recv(self, size):
+        return b'still going\n'
+
+    def recv_stderr_ready(self):
+        return False
+
+    def exit_status_ready(self):
+        return not self.recv_ready()
+
+    def recv_exit_status(self):
+        return 0
+
+    def close(self):
+        self.closed = True
+
+
+class FakeTransport(object):
+
+    def __init__(self, channel):
+        self.channel = channel
+
+    def getpeername(self):
+        return ('10.0.0.1', 22)
+
+    def open_session(self):
+        return self.channel
+
+
+class FakeClient(object):
+
+    def __init__(self, channel):
+        self.transport = FakeTransport(channel)
+
+    def get_transport(self):
+        return self.transport
+
+
+class SSHStreamTest(SimpleTestCase):
+
+    def test_command_that_keeps_writing_times_out(self):
+        channel = ChattyChannel()
+        stream = SSHStream(FakeClient(channel), 'volume gc', timeout=0.2)
+        start = time.time()
+        with self.assertRaises(socket.timeout):
+            for _ in stream:
+                pass
+        self.assertLess(time.time() - start, 1)
+        self.assertTrue(channel.closed)
+        self.assertIsNone(stream.exit_status)
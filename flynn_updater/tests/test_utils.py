@@ -0,0 +1,234 @@
+import base64
+import hashlib
+import uuid
+from unittest import mock
+from botocore.exceptions import ClientError
+from django.test import SimpleTestCase
+from flynn_updater.benchmarks.fakes import FakeRedis
+from flynn_updater.core.utils import stream_to_s3, reconcile_security_group, dns_reconcile, sync_elb_instances, \
+    NODE_RULE_DESCRIPTION
+
+
+class Response(object):
+
+    def __init__(self, data):
+        self.data = data
+
+    def iter_content(self, chunk_size=1024 * 1024):
+        for i in range(0, len(self.data), chunk_size):
+            yield self.data[i:i + chunk_size]
+
+
+class KMSBucket(object):
+    """Multipart uploads to an SSE-KMS bucket: Content-MD5 is checked, ETags are not MD5s."""
+
+    def __init__(self):
+        self.parts = {}
+        self.objects = {}
+        self.aborted = []
+
+    def create_multipart_upload(self, Bucket, Key):
+        return {'UploadId': 'upload-1'}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body, ContentMD5):
+        if base64.b64encode(hashlib.md5(Body).digest()).decode('ascii') != ContentMD5:
+            raise ValueError('BadDigest')
+        etag = '"%s"' % uuid.uuid4().hex
+        self.parts[etag] = Body
+        return {'ETag': etag}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        parts = sorted(MultipartUpload['Parts'], key=lambda part: part['PartNumber'])
+        self.objects[Key] = b''.join(self.parts[part['ETag']] for part in parts)
+        return {'ETag': '"%s-%d"' % (uuid.uuid4().hex, len(parts))}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.aborted.append(Key)
+
+
+class StreamToS3Test(SimpleTestCase):
+
+    def setUp(self):
+        self.bucket = KMSBucket()
+        patch = mock.patch('flynn_updater.core.utils.s3', self.bucket)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def test_upload_to_a_kms_encrypted_bucket(self):
+        data = bytes(range(256)) * 1000
+        result = stream_to_s3(Response(data), 'backups', 'flynn.tar', part_size=64 * 1024, max_workers=2)
+        self.assertEqual(self.bucket.objects['flynn.tar'], data)
+        self.assertEqual((result.size, result.parts), (len(data), 4))
+        self.assertEqual(result.sha256, hashlib.sha256(data).hexdigest())
+
+    def test_rejected_part_aborts_the_upload(self):
+        self.bucket.upload_part = mock.Mock(side_effect=ValueError('BadDigest'))
+        with self.assertRaises(ValueError):
+            stream_to_s3(Response(b'x' * 200000), 'backups', 'flynn.tar', part_size=64 * 1024, max_workers=2)
+        self.assertEqual(self.bucket.aborted, ['flynn.tar'])
+
+    def test_empty_stream_aborts_the_upload(self):
+        with self.assertRaises(ValueError):
+            stream_to_s3(Response(b''), 'backups', 'flynn.tar')
+        self.assertEqual(self.bucket.aborted, ['flynn.tar'])
+
+
+def security_group(*ranges):
+    return {'SecurityGroups': [{'GroupId': 'sg-1', 'IpPermissions': [
+        {'IpProtocol': 'tcp', 'FromPort': 5432, 'ToPort': 5432, 'IpRanges': list(ranges)},
+        {'IpProtocol': 'tcp', 'FromPort': 22, 'ToPort': 22, 'IpRanges': [{'CidrIp': '54.0.0.9/32'}]},
+    ]}]}
+
+
+def node_rule(cidr):
+    return {'CidrIp': cidr, 'Description': NODE_RULE_DESCRIPTION}
+
+
+class ReconcileSecurityGroupTest(SimpleTestCase):
+
+    def reconcile(self, group, ips, keep_cidrs=()):
+        ec2 = mock.Mock()
+        ec2.describe_security_groups.return_value = group
+        with mock.patch('flynn_updater.core.utils.ec2', ec2):
+            return reconcile_security_group('sg-1', ips, 5432, keep_cidrs=keep_cidrs), ec2
+
+    def ranges(self, call):
+        return [r for permission in call[1]['IpPermissions'] for r in permission['IpRanges']]
+
+    def test_only_departed_node_rules_are_revoked(self):
+        group = security_group(node_rule('54.0.0.1/32'), node_rule('54.0.0.2/32'), {'CidrIp': '10.0.0.0/16'},
+                               {'CidrIp': '203.0.113.7/32', 'Description': 'bastion'})
+        result, ec2 = self.reconcile(group, ['54.0.0.1'])
+        self.assertEqual(result.revoked, ['54.0.0.2/32'])
+        self.assertEqual(self.ranges(ec2.revoke_security_group_ingress.call_args), [{'CidrIp': '54.0.0.2/32'}])
+
+    def test_new_nodes_are_authorized_as_node_rules(self):
+        group = security_group({'CidrIp': '10.0.0.0/16'})
+        result, ec2 = self.reconcile(group, ['54.0.0.1'], keep_cidrs=['10.1.0.0/16'])
+        self.assertEqual(result.authorized, ['10.1.0.0/16', '54.0.0.1/32'])
+        self.assertEqual(self.ranges(ec2.authorize_security_group_ingress.call_args),
+                         [{'CidrIp': '10.1.0.0/16'}, node_rule('54.0.0.1/32')])
+        ec2.revoke_security_group_ingress.assert_not_called()
+
+    def test_undescribed_rule_of_a_running_node_is_adopted(self):
+        result, ec2 = self.reconcile(security_group({'CidrIp': '54.0.0.1/32'}), ['54.0.0.1'])
+        self.assertEqual((result.authorized, result.revoked), ([], []))
+        self.assertEqual(self.ranges(ec2.update_security_group_rule_descriptions_ingress.call_args),
+                         [node_rule('54.0.0.1/32')])
+
+    def test_in_sync_group_makes_no_changes(self):
+        result, ec2 = self.reconcile(security_group(node_rule('54.0.0.1/32'), {'CidrIp': '10.0.0.0/16'}), ['54.0.0.1'])
+        self.assertEqual((result.authorized, result.revoked), ([], []))
+        self.assertEqual([call[0] for call in ec2.method_calls], ['describe_security_groups'])
+
+
+def record_set(addrs, ttl=60, name='flynn.example.com.'):
+    return {'ResourceRecordSets': [{'Name': name, 'Type': 'A', 'TTL': ttl,
+                                    'ResourceRecords': [{'Value': addr} for addr in addrs]}]}
+
+
+class DnsReconcileTest(SimpleTestCase):
+
+    def setUp(self):
+        self.dns = mock.Mock()
+        self.dns.list_resource_record_sets.return_value = record_set(['54.0.0.1', '54.0.0.2'])
+        patches = [mock.patch('flynn_updater.core.utils.dns', self.dns),
+                   mock.patch('flynn_updater.core.cache._redis', FakeRedis())]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def reconcile(self, addrs):
+        return dns_reconcile('Z1', addrs, 'flynn.example.com')
+
+    def changes(self):
+        return self.dns.change_resource_record_sets.call_args[1]['ChangeBatch']['Changes']
+
+    def test_records_already_served_are_left_alone(self):
+        result = self.reconcile(['54.0.0.2', '54.0.0.1', '54.0.0.1'])
+        self.assertEqual((result.changed, result.reason), (False, 'in-sync'))
+        self.dns.change_resource_record_sets.assert_not_called()
+
+    def test_unchanged_fingerprint_skips_route53(self):
+        self.reconcile(['54.0.0.1', '54.0.0.2'])
+        self.dns.reset_mock()
+        result = self.reconcile(['54.0.0.2', '54.0.0.1'])
+        self.assertEqual((result.changed, result.reason), (False, 'cached'))
+        self.assertEqual(self.dns.method_calls, [])
+
+    def test_changed_addresses_upsert_the_one_record_set(self):
+        result = self.reconcile(['54.0.0.3', '54.0.0.1'])
+        self.assertEqual((result.changed, result.records), (True, ['54.0.0.1', '54.0.0.3']))
+        (change,) = self.changes()
+        self.assertEqual(change['Action'], 'UPSERT')
+        self.assertEqual(change['ResourceRecordSet']['ResourceRecords'], [{'Value': '54.0.0.1'}, {'Value': '54.0.0.3'}])
+
+    def test_changed_ttl_is_updated(self):
+        self.dns.list_resource_record_sets.return_value = record_set(['54.0.0.1', '54.0.0.2'], ttl=300)
+        self.assertTrue(self.reconcile(['54.0.0.1', '54.0.0.2']).changed)
+        self.assertEqual(self.changes()[0]['ResourceRecordSet']['TTL'], 60)
+
+    def test_missing_record_set_is_created(self):
+        self.dns.list_resource_record_sets.return_value = record_set(['54.0.0.9'], name='other.example.com.')
+        self.assertTrue(self.reconcile(['54.0.0.1']).changed)
+        self.assertEqual([change['Action'] for change in self.changes()], ['UPSERT'])
+
+    def test_new_addresses_after_a_cached_run_are_updated(self):
+        self.reconcile(['54.0.0.1', '54.0.0.2'])
+        self.assertEqual(self.reconcile(['54.0.0.1']).reason, 'updated')
+
+
+class LoadBalancers(object):
+    """Classic ELB API over a dict of load balancer name -> registered instance ids."""
+
+    def __init__(self, members):
+        self.members = members
+        self.calls = []
+
+    def describe_load_balancers(self, LoadBalancerNames):
+        missing = [name for name in LoadBalancerNames if name not in self.members]
+        if missing:
+            error = {'Error': {'Code': 'LoadBalancerNotFound', 'Message': missing[0]}}
+            raise ClientError(error, 'DescribeLoadBalancers')
+        return {'LoadBalancerDescriptions': [{
+            'LoadBalancerName': name, 'Instances': [{'InstanceId': i} for i in sorted(self.members[name])]
+        } for name in LoadBalancerNames]}
+
+    def register_instances_with_load_balancer(self, LoadBalancerName, Instances):
+        self.calls.append(('register', LoadBalancerName))
+        self.members[LoadBalancerName].update(i['InstanceId'] for i in Instances)
+
+    def deregister_instances_from_load_balancer(self, LoadBalancerName, Instances):
+        self.calls.append(('deregister', LoadBalancerName))
+        self.members[LoadBalancerName].difference_update(i['InstanceId'] for i in Instances)
+
+
+class SyncElbInstancesTest(SimpleTestCase):
+
+    def sync(self, members, instances, departed=()):
+        self.elb = LoadBalancers(members)
+        with mock.patch('flynn_updater.core.utils.elb', self.elb):
+            results = sync_elb_instances(sorted(members) + ['gone'], instances, departed)
+        return {result.elb: result for result in results}
+
+    def test_joined_node_is_registered(self):
+        results = self.sync({'web': {'i-1'}}, ['i-1', 'i-2'])
+        self.assertEqual((results['web'].registered, results['web'].deregistered), (['i-2'], []))
+        self.assertEqual(self.elb.members['web'], {'i-1', 'i-2'})
+
+    def test_only_departed_nodes_are_deregistered(self):
+        # i-3 was registered by hand, i-4 is still pending in the ASG
+        results = self.sync({'web': {'i-1', 'i-2', 'i-3', 'i-4'}}, ['i-1'], departed=['i-2'])
+        self.assertEqual((results['web'].registered, results['web'].deregistered), ([], ['i-2']))
+        self.assertEqual(self.elb.members['web'], {'i-1', 'i-3', 'i-4'})
+
+    def test_in_sync_elb_is_left_alone(self):
+        results = self.sync({'web': {'i-1', 'i-2'}, 'api': {'i-1', 'i-2'}}, ['i-1', 'i-2'], departed=['i-9'])
+        self.assertEqual([(r.registered, r.deregistered, r.error) for r in results.values() if r.elb != 'gone'],
+                         [([], [], None)] * 2)
+        self.assertEqual(self.elb.calls, [])
+
+    def test_missing_elb_is_reported_and_the_others_synced(self):
+        results = self.sync({'web': set()}, ['i-1'])
+        self.assertEqual(results['gone'].error, 'LoadBalancerNotFound')
+        self.assertEqual(results['web'].registered, ['i-1'])
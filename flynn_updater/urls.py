@@ -15,7 +15,9 @@ Including another URLconf
 """
 from django.conf.urls import url
 from django.contrib import admin
+from flynn_updater import views
 
 urlpatterns = [
     url(r'^admin/', admin.site.urls),
+    url(r'^metrics$', views.metrics, name='metrics'),
 ]
@@ -0,0 +1,7 @@
+from django.http import HttpResponse
+from prometheus_client import CONTENT_TYPE_LATEST
+from flynn_updater.core.metrics import render
+
+
+def metrics(request):
+    return HttpResponse(render(), content_type=CONTENT_TYPE_LATEST)